@@ -0,0 +1,142 @@
+"""
+Snapshots of activity readers that load by memory mapping.
+
+`cache_resources.py` used to pickle a whole `MinuteLevelActivityReader`,
+which takes about as long to unpickle as to rebuild and needs twice the
+memory while doing so. A snapshot is a directory instead:
+
+    <path>/
+        manifest.json             reader class, attributes, columns and a
+                                  hash of the reader's dataset_args
+        values.npy                float32 (T, F) rows, one block per participant
+        times.npy                 int64 (T,) timestamps in ns
+        participants.feather      participant_id, offset, evenly_spaced
+        participant_dates.feather participant_id, end_date of valid windows
+
+Loading memory maps the arrays into an `ActivityArrayStore`, so it takes
+seconds, and datasets read windows straight from the mapped pages unless
+they ask for `storage: frame`. The reader's pandas frame is only rebuilt if
+something asks for `activity_data`. Whether a snapshot matches a set of
+dataset_args is a comparison of hashes.
+"""
+import hashlib
+import inspect
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.data.task_datasets import (ActivityArrayStore, DayLevelActivityReader,
+                                    MinuteLevelActivityReader)
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+SNAPSHOT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+READERS = {"MinuteLevelActivityReader": MinuteLevelActivityReader,
+           "DayLevelActivityReader": DayLevelActivityReader}
+
+# Reader arguments that change what a reader contains
+HASHED_ARGS = ["min_date", "max_date", "split_date", "day_window_size",
+               "max_missing_days_in_window", "min_windows", "participant_ids", "data_location"]
+# Plain attributes restored on load
+READER_ATTRIBUTES = ["min_date", "max_date", "split_date", "min_windows", "day_window_size",
+                     "max_missing_days_in_window", "obs_per_day"]
+
+
+def get_hashed_args(reader_class, dataset_args):
+    """The reader arguments in `dataset_args`, with the reader's defaults for
+    the ones that aren't set, normalized so equivalent values hash the same"""
+    defaults = {name: parameter.default for name, parameter
+                in inspect.signature(reader_class.__init__).parameters.items()}
+    args = {}
+    for name in HASHED_ARGS:
+        value = dataset_args.get(name)
+        if value is None:
+            value = defaults.get(name)
+        if value is not None and name in ["min_date", "max_date", "split_date"]:
+            value = str(pd.to_datetime(value))
+        if value is not None and name == "data_location":
+            value = os.path.abspath(value)
+        if value is not None and name == "participant_ids":
+            value = sorted(str(x) for x in value)
+        args[name] = value
+    return args
+
+
+def get_args_hash(args):
+    return hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def write_activity_snapshot(reader, path, dataset_args=None):
+    os.makedirs(path, exist_ok=True)
+    store = reader.to_array_store()
+    np.save(os.path.join(path, "values.npy"), store.values)
+    np.save(os.path.join(path, "times.npy"), store.times)
+
+    pd.DataFrame({"participant_id": store.participants.astype(str),
+                  "offset": store.offsets[:-1],
+                  "evenly_spaced": store.evenly_spaced}).to_feather(os.path.join(path, "participants.feather"))
+    participant_dates = pd.DataFrame(reader.participant_dates, columns=["participant_id", "end_date"])
+    participant_dates.to_feather(os.path.join(path, "participant_dates.feather"))
+
+    hashed_args = get_hashed_args(type(reader), dataset_args or {})
+    manifest = {"version": SNAPSHOT_VERSION,
+                "reader": type(reader).__name__,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "args": hashed_args,
+                "args_hash": get_args_hash(hashed_args),
+                "attributes": {name: getattr(reader, name, None) for name in READER_ATTRIBUTES},
+                "columns": store.columns,
+                "index_names": store.index_names,
+                "step": store.step,
+                "n_rows": int(store.values.shape[0])}
+    with open(os.path.join(path, MANIFEST_NAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, default=str)
+    logger.info(f"Wrote a snapshot of {manifest['n_rows']} rows to {path}")
+
+
+def load_snapshot_manifest(path):
+    with open(os.path.join(path, MANIFEST_NAME)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def get_snapshot_mismatch(manifest, dataset_args):
+    """The hashed arguments that differ between a snapshot and `dataset_args`,
+    or an empty list if their hashes match"""
+    args = get_hashed_args(READERS[manifest["reader"]], dataset_args)
+    if get_args_hash(args) == manifest["args_hash"]:
+        return []
+    return [(name, args[name], manifest["args"].get(name)) for name in HASHED_ARGS
+            if args[name] != manifest["args"].get(name)]
+
+
+def load_activity_snapshot(path):
+    manifest = load_snapshot_manifest(path)
+    if manifest["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot at {path} is version {manifest['version']}, expected {SNAPSHOT_VERSION}")
+
+    # Copy-on-write maps, so the arrays are writable without touching the files
+    values = np.load(os.path.join(path, "values.npy"), mmap_mode="c")
+    times = np.load(os.path.join(path, "times.npy"), mmap_mode="c")
+    participants = pd.read_feather(os.path.join(path, "participants.feather"))
+    offsets = np.concatenate([participants["offset"].values, [len(times)]])
+    store = ActivityArrayStore.from_arrays(values, times, participants["participant_id"].values,
+                                           offsets, participants["evenly_spaced"].values,
+                                           manifest["columns"], manifest["step"],
+                                           manifest["index_names"])
+
+    reader_class = READERS[manifest["reader"]]
+    reader = reader_class.__new__(reader_class)
+    for name, value in manifest["attributes"].items():
+        setattr(reader, name, value)
+    reader.scaler = None
+    reader.array_store = store
+
+    participant_dates = pd.read_feather(os.path.join(path, "participant_dates.feather"))
+    participant_dates["end_date"] = pd.to_datetime(participant_dates["end_date"])
+    reader.valid_dates = participant_dates
+    reader.participant_dates = list(zip(participant_dates["participant_id"], participant_dates["end_date"]))
+    return reader, manifest
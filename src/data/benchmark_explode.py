@@ -0,0 +1,82 @@
+"""
+Benchmarks `explode_str_column` against `explode_str_column_vectorized`
+on a synthetic table of minute-level strings, laid out like the raw
+Fitbit exports (one row per participant-day).
+
+    python src/data/benchmark_explode.py --n_participant_days 10000
+"""
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from src.data.make_dataset import explode_str_column, explode_str_column_vectorized
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+MINS_IN_DAY = 24*60
+
+
+def make_synthetic_raw_table(n_participant_days, days_per_participant=30, seed=0):
+    rng = np.random.default_rng(seed)
+    n_participants = int(np.ceil(n_participant_days / days_per_participant))
+    participant_ids = np.repeat([f"participant_{i}" for i in range(n_participants)],
+                                days_per_participant)[:n_participant_days]
+    day_offsets = np.tile(np.arange(days_per_participant), n_participants)[:n_participant_days]
+    dates = pd.Timestamp("2020-01-01") + pd.to_timedelta(day_offsets, unit="D")
+
+    values = rng.integers(0, 120, size=(n_participant_days, MINS_IN_DAY))
+    minute_level_str = [" ".join(row) for row in values.astype(str)]
+
+    df = pd.DataFrame({"id_participant_external": participant_ids,
+                       "dt": dates.strftime("%Y-%m-%d"),
+                       "minute_level_str": minute_level_str})
+    df["id_participant_external"] = df["id_participant_external"].astype("category")
+    return df.set_index("id_participant_external")
+
+
+def time_fn(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+
+@click.command()
+@click.option("--n_participant_days", type=int, default=10000)
+@click.option("--days_per_participant", type=int, default=30)
+@click.option("--skip_original", is_flag=True, help="Only time the vectorized engine")
+def main(n_participant_days, days_per_participant, skip_original=False):
+    logger.info(f"Building synthetic table with {n_participant_days} participant-days...")
+    raw = make_synthetic_raw_table(n_participant_days, days_per_participant)
+    users = raw.index.unique()
+
+    vectorized, vectorized_time = time_fn(explode_str_column_vectorized, raw.copy(),
+                                          target_col="minute_level_str",
+                                          rename_target_column="steps",
+                                          keep_participant=True)
+    logger.info(f"explode_str_column_vectorized (whole table): {vectorized_time:.2f}s "
+                f"({len(vectorized)} rows)")
+
+    if skip_original:
+        return
+
+    def explode_per_user(fn):
+        return [fn(raw.loc[[user]].copy(), target_col="minute_level_str",
+                   rename_target_column="steps") for user in users]
+
+    original, original_time = time_fn(explode_per_user, explode_str_column)
+    logger.info(f"explode_str_column (per user): {original_time:.2f}s")
+
+    per_user, per_user_time = time_fn(explode_per_user, explode_str_column_vectorized)
+    logger.info(f"explode_str_column_vectorized (per user): {per_user_time:.2f}s")
+
+    for expected, result in zip(original, per_user):
+        np.testing.assert_array_equal(expected.index.values, result.index.values)
+        np.testing.assert_array_equal(expected["steps"].values.astype(np.int64),
+                                      result["steps"].values.astype(np.int64))
+    logger.info(f"Outputs match. Speedup: {original_time / vectorized_time:.1f}x (whole table), "
+                f"{original_time / per_user_time:.1f}x (per user)")
+
+if __name__ == "__main__":
+    main()
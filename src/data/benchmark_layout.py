@@ -0,0 +1,115 @@
+"""
+Compares petastorm window dataset layouts for the readers used in training.
+
+Each layout (participant buckets, date partitions, windows per row group and
+compression) is materialized with the local engine of
+`make_petastorm_dataset` from the same synthetic minute-level data, then
+read back with `make_reader` (row at a time, as `PetastormDataset` does) and
+`make_batch_reader`. For every layout this logs files, row groups, size on
+disk, rows/s for both readers, and the shuffle locality of `make_reader`:
+the fraction of consecutive rows that come from the same participant, which
+is what shuffling row groups (rather than rows) leaves behind.
+
+    python src/data/benchmark_layout.py --n_participants 200 --n_days 30
+"""
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import click
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from src.data.benchmark_windowing import make_synthetic_minute_level
+from src.data.make_petastorm_dataset import main as make_petastorm_dataset
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+LAYOUTS = {
+    "default": [],
+    "small_row_groups": ["--windows_per_row_group", "64"],
+    "buckets": ["--bucket_participants", "16", "--windows_per_row_group", "64"],
+    "dates": ["--partition_by_date", "--windows_per_row_group", "64"],
+    "buckets_zstd": ["--bucket_participants", "16", "--windows_per_row_group", "64",
+                     "--compression", "zstd"],
+}
+
+
+def write_layout(input_path, output_path, layout_args, day_window_size, workers):
+    args = [input_path, output_path, "--day_window_size", str(day_window_size),
+            "--engine", "local", "--workers", str(workers)] + layout_args
+    start = time.time()
+    make_petastorm_dataset.main(args, standalone_mode=False)
+    return time.time() - start
+
+
+def get_layout_stats(path):
+    files = glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True)
+    return {"n_files": len(files),
+            "n_row_groups": sum(pq.ParquetFile(x).num_row_groups for x in files),
+            "size_mb": sum(os.path.getsize(x) for x in files) / 1024**2}
+
+
+def get_shuffle_locality(participant_ids):
+    participant_ids = np.asarray(participant_ids)
+    if len(participant_ids) < 2:
+        return np.nan
+    return float(np.mean(participant_ids[1:] == participant_ids[:-1]))
+
+
+def time_reader(path, workers, batched=False):
+    from petastorm import make_reader, make_batch_reader
+
+    url = "file://" + os.path.abspath(path)
+    participant_ids = []
+    start = time.time()
+    if batched:
+        with make_batch_reader(url, workers_count=workers, shuffle_row_groups=True,
+                               num_epochs=1) as reader:
+            for batch in reader:
+                participant_ids.extend(batch.participant_id)
+    else:
+        with make_reader(url, workers_count=workers, shuffle_row_groups=True,
+                         num_epochs=1) as reader:
+            for row in reader:
+                participant_ids.append(row.participant_id)
+    return len(participant_ids) / (time.time() - start), participant_ids
+
+
+@click.command()
+@click.option("--n_participants", type=int, default=200)
+@click.option("--n_days", type=int, default=30)
+@click.option("--day_window_size", type=int, default=4)
+@click.option("--workers", type=int, default=8)
+@click.option("--layouts", type=click.Choice(list(LAYOUTS)), multiple=True,
+              help="Layouts to compare, all by default")
+def main(n_participants, n_days, day_window_size, workers, layouts=None):
+    layouts = layouts or list(LAYOUTS)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        input_path = os.path.join(tmp_dir, "minute_level")
+        logger.info(f"Writing {n_participants} participants x {n_days} days of synthetic data...")
+        make_synthetic_minute_level(input_path, n_participants, n_days)
+
+        results = []
+        for name in layouts:
+            output_path = os.path.join(tmp_dir, name)
+            write_time = write_layout(input_path, output_path, LAYOUTS[name], day_window_size, workers)
+            rows_per_s, participant_ids = time_reader(output_path, workers)
+            batch_rows_per_s, _ = time_reader(output_path, workers, batched=True)
+            results.append({"layout": name, "write_s": write_time,
+                            **get_layout_stats(output_path),
+                            "reader_rows_per_s": rows_per_s,
+                            "batch_reader_rows_per_s": batch_rows_per_s,
+                            "shuffle_locality": get_shuffle_locality(participant_ids)})
+            logger.info(f"{name}: {results[-1]}")
+
+        print(pd.DataFrame(results).set_index("layout").round(3).to_string())
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmarks the Spark and local windowing engines of `make_petastorm_dataset`
+on a synthetic dense minute-level dataset, and checks that they produce the
+same windows.
+
+    python src/data/benchmark_windowing.py --n_participants 200 --n_days 30
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import click
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.data.make_petastorm_dataset import main as make_petastorm_dataset
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+MINS_IN_DAY = 60*24
+
+
+def make_synthetic_minute_level(path, n_participants, n_days, seed=0):
+    """Writes a date-partitioned dataset shaped like the output of
+    `fill_missing_minutes`"""
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range("2020-01-01", periods=n_days * MINS_IN_DAY, freq="min")
+    for i in range(n_participants):
+        df = pd.DataFrame({"participant_id": f"participant_{i}",
+                           "timestamp": timestamps,
+                           "heart_rate": rng.normal(70, 10, len(timestamps)),
+                           "steps": rng.integers(0, 100, len(timestamps)),
+                           "missing_heart_rate": rng.random(len(timestamps)) < 0.1})
+        df["date"] = df["timestamp"].dt.strftime("%Y-%m-%d")
+        pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), path,
+                            partition_cols=["date"],
+                            basename_template=f"part-{i}-{{i}}.parquet")
+
+
+def run_engine(engine, input_path, output_path, day_window_size, workers):
+    args = [input_path, output_path, "--day_window_size", str(day_window_size),
+            "--engine", engine, "--workers", str(workers)]
+    start = time.time()
+    make_petastorm_dataset.main(args, standalone_mode=False)
+    return time.time() - start
+
+
+def load_windows(path):
+    df = pd.read_parquet(path).drop(columns=["id"])
+    return df.sort_values(["participant_id", "start"]).reset_index(drop=True)
+
+
+@click.command()
+@click.option("--n_participants", type=int, default=200)
+@click.option("--n_days", type=int, default=30)
+@click.option("--day_window_size", type=int, default=4)
+@click.option("--workers", type=int, default=8)
+@click.option("--skip_spark", is_flag=True, help="Only time the local engine")
+def main(n_participants, n_days, day_window_size, workers, skip_spark=False):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        input_path = os.path.join(tmp_dir, "minute_level")
+        logger.info(f"Writing {n_participants} participants x {n_days} days of synthetic data...")
+        make_synthetic_minute_level(input_path, n_participants, n_days)
+
+        local_path = os.path.join(tmp_dir, "local")
+        local_time = run_engine("local", input_path, local_path, day_window_size, workers)
+        logger.info(f"local engine: {local_time:.2f}s")
+        if skip_spark:
+            return
+
+        spark_path = os.path.join(tmp_dir, "spark")
+        spark_time = run_engine("spark", input_path, spark_path, day_window_size, workers)
+        logger.info(f"spark engine: {spark_time:.2f}s")
+
+        local, spark = load_windows(local_path), load_windows(spark_path)
+        assert len(local) == len(spark), f"{len(local)} local windows vs {len(spark)} spark windows"
+        np.testing.assert_array_equal(local["start"].values, spark["start"].values)
+        for column in ["heart_rate", "steps", "missing_heart_rate"]:
+            np.testing.assert_allclose(np.stack(local[column].values).astype(np.float64),
+                                       np.stack(spark[column].values).astype(np.float64),
+                                       rtol=1e-6)
+        logger.info(f"Outputs match ({len(local)} windows). Speedup: {spark_time / local_time:.1f}x")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
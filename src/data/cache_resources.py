@@ -12,7 +12,8 @@ from src.utils import read_yaml, get_logger
 logger = get_logger(__name__)
 
 from src.data.task_datasets import MinuteLevelActivityReader
-from src.data.utils import get_cached_datareader_path
+from src.data.utils import get_cached_datareader_path, get_activity_snapshot_path
+from src.data.activity_snapshot import write_activity_snapshot
 from src.models.tasks import get_task_with_name
 
 
@@ -26,8 +27,10 @@ from src.models.tasks import get_task_with_name
 @click.option('--activity_level', default="minute")
 @click.option('--preload', is_flag=True)
 @click.option('--postfix', default="",type=str)
+@click.option('--format', "cache_format", type=click.Choice(["snapshot","pickle"]), default="snapshot",
+              help="Readers are written as a memory-mappable snapshot unless 'pickle'. Tasks are always pickled")
 def main(config_path, task_name=None, cache_path=None, data_location=None, postfix="",
-         activity_level="minute",preload=False):
+         activity_level="minute",preload=False, cache_format="snapshot"):
 
     reader_args = read_yaml(config_path)
     if activity_level == "minute":
@@ -49,6 +52,13 @@ def main(config_path, task_name=None, cache_path=None, data_location=None, postf
                 data_loader = DataLoader(dataset, batch_size=1000)
                 [_ for _ in tqdm(data_loader)]
     
+    if not task_name and cache_format == "snapshot":
+        if not cache_path:
+            cache_path = get_activity_snapshot_path(name)
+        logger.info(f"Writing snapshot to {cache_path}...")
+        write_activity_snapshot(resource, cache_path, dataset_args=reader_args)
+        return
+
     if not cache_path:
         cache_path = get_cached_datareader_path(name)
     logger.info(f"Dumping pickle to {cache_path}...")
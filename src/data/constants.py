@@ -20,6 +20,7 @@ PROCESSED_DATASETS = [
     "lab_results_with_triggerdate",
     "baseline_screener_survey",
     "daily_surveys_onehot",
+    "daily_surveys_categorical",
     "fitbit_day_level_activity"
 ]
 
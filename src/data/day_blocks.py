@@ -0,0 +1,237 @@
+"""
+Deduplicated day-block storage for minute-level windows.
+
+The petastorm datasets written by `make_petastorm_dataset` store every
+overlapping window in full, so with a one day stride each minute is written
+`day_window_size` times. This layout instead writes every complete
+(participant, day) block of 1440 minutes exactly once:
+
+    <path>/
+        meta.json                     columns, dtypes and scaling stats
+        index.parquet                 participant_id, date, shard, row
+        blocks/<column>/part-00000.npy  (n_days_in_shard, 1440) arrays
+
+Blocks for a participant are written to a single shard in date order, so a
+window of consecutive days is a single contiguous slice of the memory
+mapped arrays. `DayBlockWindowDataset` assembles windows of any
+`day_window_size` at read time, without re-materializing.
+
+    python src/data/day_blocks.py data/processed/processed_fitbit_minute_level_activity \\
+        data/processed/day_blocks --workers 16
+"""
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+import numpy as np
+import pandas as pd
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from src.data.window_engine import (get_feature_columns, list_participants, read_shard,
+                                    get_shard_moments, combine_moments, get_participant_windows,
+                                    get_column_values, MINS_IN_DAY)
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+META_NAME = "meta.json"
+INDEX_NAME = "index.parquet"
+BLOCKS_DIR = "blocks"
+
+
+def get_block_path(path, column, shard_index):
+    return os.path.join(path, BLOCKS_DIR, column, f"part-{shard_index:05d}.npy")
+
+
+def write_block_shard(shard_index, participants, input_path, output_path, feature_columns,
+                      rename, stds=None, min_date=None, max_date=None):
+    df = read_shard(input_path, participants, feature_columns, rename, min_date, max_date)
+    if stds:
+        for column, std in stds.items():
+            df[column] = df[column] / std if std > 0 else 0.0
+
+    index, blocks = [], {column: [] for column in feature_columns}
+    for participant_id, participant_df in df.groupby("participant_id", sort=False):
+        timestamps = participant_df["timestamp"].values.astype("datetime64[ns]").astype(np.int64)
+        # Complete single days are exactly the one day windows
+        grid_start, positions, n_days, starts = get_participant_windows(timestamps, 1)
+        if len(starts) == 0:
+            continue
+        days = starts // MINS_IN_DAY
+        for column in feature_columns:
+            values = get_column_values(participant_df, column)
+            dense = np.zeros(n_days * MINS_IN_DAY, dtype=values.dtype)
+            dense[positions] = values
+            blocks[column].append(dense.reshape(n_days, MINS_IN_DAY)[days])
+        dates = np.datetime64(int(grid_start), "ns") + days.astype("timedelta64[D]")
+        index.append(pd.DataFrame({"participant_id": participant_id, "date": dates}))
+
+    if not index:
+        return None
+
+    index = pd.concat(index, ignore_index=True)
+    index["shard"] = np.int32(shard_index)
+    index["row"] = np.arange(len(index), dtype=np.int64)
+    dtypes = {}
+    for column in feature_columns:
+        values = np.concatenate(blocks[column])
+        dtypes[column] = values.dtype.str
+        np.save(get_block_path(output_path, column, shard_index), values)
+    return index, dtypes
+
+
+def clear_day_blocks(path):
+    """Removes the blocks, index and metadata of a day-block store, and
+    leaves anything else in `path` alone"""
+    shutil.rmtree(os.path.join(path, BLOCKS_DIR), ignore_errors=True)
+    for name in [INDEX_NAME, META_NAME]:
+        if os.path.exists(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+
+
+def write_day_blocks(input_path, output_path, rename=None, no_scale=False, min_date=None,
+                     max_date=None, users=None, include_users=False, workers=8,
+                     participants_per_shard=64):
+    rename = rename or {}
+    feature_columns, scale_columns = get_feature_columns(input_path, rename)
+    # Shards of an earlier run with more participants would otherwise be left behind
+    clear_day_blocks(output_path)
+    for column in feature_columns:
+        os.makedirs(os.path.join(output_path, BLOCKS_DIR, column), exist_ok=True)
+
+    participants = list_participants(input_path, users=users, include_users=include_users,
+                                     min_date=min_date, max_date=max_date)
+    n_shards = max(1, int(np.ceil(len(participants) / participants_per_shard)))
+    shards = np.array_split(participants, n_shards)
+    logger.info(f"Writing day blocks for {len(participants)} participants in {n_shards} shards...")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        stds = None
+        if scale_columns and not no_scale:
+            futures = [executor.submit(get_shard_moments, input_path, shard, scale_columns,
+                                       rename, min_date, max_date) for shard in shards]
+            _, stds = combine_moments([future.result() for future in futures], scale_columns)
+
+        futures = [executor.submit(write_block_shard, i, shard, input_path, output_path,
+                                   feature_columns, rename, stds, min_date, max_date)
+                   for i, shard in enumerate(shards)]
+        indices, dtypes = [], {}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            result = future.result()
+            if result is None:
+                continue
+            indices.append(result[0])
+            dtypes.update(result[1])
+
+    if indices:
+        index = pd.concat(indices, ignore_index=True).sort_values(["participant_id", "date"])
+    else:
+        logger.warning("No participant has a complete day, writing an empty index")
+        index = pd.DataFrame({"participant_id": pd.Series(dtype=str),
+                              "date": pd.Series(dtype="datetime64[ns]"),
+                              "shard": pd.Series(dtype=np.int32),
+                              "row": pd.Series(dtype=np.int64)})
+    index.to_parquet(os.path.join(output_path, INDEX_NAME), index=False)
+    with open(os.path.join(output_path, META_NAME), "w") as meta_file:
+        json.dump({"columns": feature_columns, "dtypes": dtypes,
+                   "stds": stds, "n_blocks": len(index)}, meta_file)
+    logger.info(f"Wrote {len(index)} participant-day blocks to {output_path}")
+
+
+def load_day_block_index(path):
+    index = pd.read_parquet(os.path.join(path, INDEX_NAME))
+    index["date"] = pd.to_datetime(index["date"])
+    return index
+
+
+def get_window_starts(index, day_window_size):
+    """Rows of `index` that start `day_window_size` consecutive days of
+    blocks for the same participant, in the same shard"""
+    index = index.sort_values(["participant_id", "date"]).reset_index(drop=True)
+    if len(index) < day_window_size:
+        return index.iloc[0:0]
+    day_number = (index["date"].values.astype("datetime64[D]").astype(np.int64))
+    last = day_window_size - 1
+    # Consecutive blocks are consecutive rows, so comparing each row with
+    # the one `last` rows ahead is enough
+    ahead_day = np.full(len(index), -1, dtype=np.int64)
+    ahead_day[:len(index) - last] = day_number[last:]
+    ahead_participant = np.empty(len(index), dtype=object)
+    ahead_participant[:len(index) - last] = index["participant_id"].values[last:]
+    ahead_row = np.full(len(index), -1)
+    ahead_row[:len(index) - last] = index["row"].values[last:]
+    ahead_shard = np.full(len(index), -1)
+    ahead_shard[:len(index) - last] = index["shard"].values[last:]
+
+    valid = ((ahead_day - day_number == last)
+             & (ahead_participant == index["participant_id"].values)
+             & (ahead_shard == index["shard"].values)
+             & (ahead_row - index["row"].values == last))
+    return index[valid].reset_index(drop=True)
+
+
+class DayBlockWindowDataset(Dataset):
+    """Windows of `day_window_size` days read from a day-block store.
+
+    Items look like the rows of the petastorm datasets: `participant_id`,
+    `start`, `end` and one flat array of `day_window_size * 1440` values
+    per column. Each array is a view of the memory mapped blocks.
+    """
+    def __init__(self, path, day_window_size, columns=None, participant_ids=None,
+                 min_date=None, max_date=None):
+        self.path = path
+        self.day_window_size = day_window_size
+        with open(os.path.join(path, META_NAME)) as meta_file:
+            self.meta = json.load(meta_file)
+        self.columns = columns or self.meta["columns"]
+
+        index = load_day_block_index(path)
+        if participant_ids is not None:
+            index = index[index["participant_id"].isin(participant_ids)]
+        if min_date:
+            index = index[index["date"] >= pd.to_datetime(min_date)]
+        if max_date:
+            index = index[index["date"] < pd.to_datetime(max_date)]
+        self.windows = get_window_starts(index, day_window_size)
+        self.blocks = {}
+
+    def get_blocks(self, column, shard):
+        key = (column, shard)
+        if key not in self.blocks:
+            # Opened lazily so each DataLoader worker maps its own copy
+            self.blocks[key] = np.load(get_block_path(self.path, column, shard), mmap_mode="r")
+        return self.blocks[key]
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, index):
+        window = self.windows.iloc[index]
+        shard, row = int(window["shard"]), int(window["row"])
+        item = {"participant_id": window["participant_id"],
+                "start": window["date"],
+                "end": window["date"] + pd.Timedelta(days=self.day_window_size)}
+        for column in self.columns:
+            blocks = self.get_blocks(column, shard)
+            item[column] = blocks[row:row + self.day_window_size].reshape(-1)
+        return item
+
+
+@click.command()
+@click.argument("input_path", type=click.Path(file_okay=True,exists=True))
+@click.argument("output_path", type=click.Path(file_okay=False))
+@click.option("--min_date", type=str, default=None)
+@click.option("--max_date", type=str, default=None)
+@click.option("--no_scale", is_flag=True)
+@click.option("--rename", type=str, multiple=True)
+@click.option("--workers", type=int, default=8)
+def main(input_path, output_path, min_date=None, max_date=None, no_scale=False,
+         rename=None, workers=8):
+    rename = {x.split(":")[0] : x.split(":")[1] for x in rename}
+    write_day_blocks(input_path, output_path, rename=rename, no_scale=no_scale,
+                     min_date=min_date, max_date=max_date, workers=workers)
+
+if __name__ == "__main__":
+    main()
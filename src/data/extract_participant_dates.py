@@ -8,38 +8,34 @@ from pyspark.sql.functions import col
 
 from pyspark import SparkContext
 
-SPARK_CONFIG = [ 
-    ("spark.master","local[95]"),
-    ("spark.ui.port","4050"),
-    ("spark.executor.memory","750g"),
-    ('spark.driver.memory',  '2000g'),
-    ("spark.driver.maxResultSize", '0'), # unlimited
-    ("spark.network.timeout",            "10000001"),
-    ("spark.executor.heartbeatInterval", "10000000")]   
+from src.data.spark_session import get_spark_session, timed_stage
 
 
 @click.command()
 @click.argument("input_path", type=click.Path(file_okay=False,exists=True))
 @click.option("-o","--output_path", type=click.Path(file_okay=False,exists=False))
-def main(input_path, output_path=None):
+@click.option("--spark_config", type=click.Path(exists=True), default=None,
+              help="YAML/JSON of Spark properties overriding the host-sized defaults")
+def main(input_path, output_path=None, spark_config=None):
     """
     Takes as input a spark minute dataset 
     and generates a csv where the first
     column is the participant id and the second column
     is the date in YYYY-MM-DD format.
     """
-    conf = SparkConf().setAll(SPARK_CONFIG)
-    sc = SparkContext(conf=conf, appName="PetaStorm Conversion")
-    spark = SparkSession(sc)
+    spark = get_spark_session("Extract Participant Dates", spark_config)
 
     df = spark.read.parquet(input_path)
     df = (df.select("participant_id","end")
                            .distinct())
     if output_path:
-        df.toPandas().to_csv(output_path,index=False)
+        with timed_stage(spark, "extract dates"):
+            df.toPandas().to_csv(output_path,index=False)
     else:
         print("participant_id","date")
-        for row in df.collect():
+        with timed_stage(spark, "extract dates"):
+            rows = df.collect()
+        for row in rows:
             d = row.asDict()
             participant_id = d['participant_id']
             date = d["end"]
@@ -0,0 +1,191 @@
+"""
+Helpers for incrementally refreshing `processed_fitbit_minute_level_activity`.
+
+A manifest stored next to the processed dataset lists every raw file that
+went into it, with its size and mtime, and the (participant_id, date) keys
+it holds. A refresh only stats the raw files: the keys of new or modified
+files are read from their key columns, and the keys of unchanged files are
+taken from the manifest. Participant-days in a new, modified or deleted
+file are reprocessed, and those no longer in any raw file are removed, so
+only the affected date partitions are rewritten.
+"""
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+MANIFEST_NAME = "_manifest.parquet"
+MANIFEST_COLUMNS = ["table", "file", "size", "mtime_ns", "participant_id", "date"]
+# Column each raw table's rows are assigned to a day by
+RAW_DATE_COLUMNS = {"sleep": "main_start_time", "steps": "dt", "heart_rate": "dt"}
+RAW_PARTICIPANT_COLUMN = "id_participant_external"
+
+
+def get_manifest_path(out_path):
+    # Leading underscore keeps parquet readers from treating it as data
+    return os.path.join(out_path, MANIFEST_NAME)
+
+
+def load_manifest(out_path):
+    path = get_manifest_path(out_path)
+    if not os.path.exists(path):
+        return None
+    manifest = pd.read_parquet(path)
+    if list(manifest.columns) != MANIFEST_COLUMNS:
+        logger.warning(f"Ignoring {path}, which was written by an older version")
+        return None
+    manifest["date"] = pd.to_datetime(manifest["date"])
+    return manifest
+
+
+def write_manifest(manifest, out_path):
+    os.makedirs(out_path, exist_ok=True)
+    manifest.to_parquet(get_manifest_path(out_path), index=False)
+
+
+def list_raw_files(path):
+    """(file, size, mtime_ns) of the parquet files of a raw table, which is
+    either a single file or a (possibly hive-partitioned) directory"""
+    if os.path.isdir(path):
+        files = [f for f in glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True)
+                 if not os.path.basename(f).startswith(("_", "."))]
+    else:
+        files = [path]
+    rows = []
+    for file in sorted(files):
+        stat = os.stat(file)
+        rows.append({"file": os.path.abspath(file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+    return pd.DataFrame(rows, columns=["file", "size", "mtime_ns"])
+
+
+def read_file_keys(path, files, date_col):
+    """(file, participant_id, date) of every row of `files`, which belong to
+    the raw table at `path`. Only the key columns are read."""
+    if os.path.isdir(path):
+        dataset = ds.dataset(list(files), format="parquet", partitioning="hive",
+                             partition_base_dir=os.path.abspath(path))
+    else:
+        dataset = ds.dataset(list(files), format="parquet")
+    frames = []
+    for fragment in dataset.get_fragments():
+        # Passing the dataset schema fills in partition columns
+        keys = fragment.to_table(columns=[RAW_PARTICIPANT_COLUMN, date_col],
+                                 schema=dataset.schema).to_pandas()
+        keys = keys.dropna()
+        frames.append(pd.DataFrame({"file": os.path.abspath(fragment.path),
+                                    "participant_id": keys[RAW_PARTICIPANT_COLUMN].astype(str).values,
+                                    "date": pd.to_datetime(keys[date_col]).dt.normalize().values})
+                      .drop_duplicates())
+    if not frames:
+        return pd.DataFrame(columns=["file", "participant_id", "date"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def build_manifest(raw_paths, old_manifest=None):
+    """The manifest of the raw tables in `raw_paths` ({table: path}). Keys of
+    files whose size and mtime match `old_manifest` are reused, so only new
+    and modified files are read."""
+    parts = []
+    for table, path in raw_paths.items():
+        files = list_raw_files(path)
+        files["table"] = table
+        reused = pd.DataFrame(columns=MANIFEST_COLUMNS)
+        if old_manifest is not None:
+            old = old_manifest[old_manifest["table"] == table]
+            reused = old.merge(files, on=["table", "file", "size", "mtime_ns"])[MANIFEST_COLUMNS]
+        to_read = files[~files["file"].isin(reused["file"])]
+        if len(to_read):
+            logger.info(f"Reading keys of {len(to_read)} new or modified {table} files")
+        keys = read_file_keys(path, to_read["file"], RAW_DATE_COLUMNS[table])
+        # Files without rows are still listed, so they aren't read again
+        keys = to_read.merge(keys, on="file", how="left")
+        parts.extend([reused, keys[MANIFEST_COLUMNS]])
+    manifest = pd.concat(parts, ignore_index=True)
+    manifest["date"] = pd.to_datetime(manifest["date"])
+    manifest["size"] = manifest["size"].astype(np.int64)
+    manifest["mtime_ns"] = manifest["mtime_ns"].astype(np.int64)
+    return manifest.sort_values(["table", "file", "participant_id", "date"]).reset_index(drop=True)
+
+
+def get_participant_days(manifest):
+    """The distinct (participant_id, date) keys of a manifest"""
+    return manifest[["participant_id", "date"]].dropna().drop_duplicates()\
+                                               .sort_values(["participant_id", "date"])\
+                                               .reset_index(drop=True)
+
+
+def find_changed_participant_days(old_manifest, new_manifest):
+    """Participant-days whose output may differ between the raw files of
+    `old_manifest` and `new_manifest`: every key of a file that was added,
+    modified or deleted, including keys that no longer exist at all"""
+    file_columns = ["table", "file", "size", "mtime_ns"]
+    old_files = old_manifest[file_columns].drop_duplicates()
+    new_files = new_manifest[file_columns].drop_duplicates()
+    unchanged = old_files.merge(new_files, on=file_columns)["file"]
+    changed = pd.concat([old_manifest[~old_manifest["file"].isin(unchanged)],
+                         new_manifest[~new_manifest["file"].isin(unchanged)]])
+    return get_participant_days(changed)
+
+
+def get_reprocessing_ranges(changed, new_manifest):
+    """For each participant with changes, find the raw date range that has to
+    be reprocessed and the range of processed dates that will be rewritten.
+
+    Reprocessing starts at the last day with data before the first change,
+    so that `fill_missing_minutes` can fill any gap leading up to the new
+    days. Output is rewritten from the day after that boundary through the
+    day after the last change (sleep can spill over midnight).
+    """
+    ranges = []
+    for participant_id, group in changed.groupby("participant_id"):
+        first_changed = group["date"].min()
+        last_changed = group["date"].max()
+
+        participant_dates = new_manifest.loc[new_manifest["participant_id"] == participant_id, "date"]
+        before = participant_dates[participant_dates < first_changed]
+        boundary = before.max() if len(before) else None
+
+        ranges.append({"participant_id": participant_id,
+                       "read_from": boundary if boundary is not None else first_changed,
+                       "read_to": last_changed + pd.Timedelta(days=1),
+                       "write_from": (boundary + pd.Timedelta(days=1)) if boundary is not None else first_changed,
+                       "write_to": last_changed + pd.Timedelta(days=1)})
+    return pd.DataFrame(ranges, columns=["participant_id", "read_from", "read_to",
+                                         "write_from", "write_to"])
+
+
+def remove_participant_days(out_path, participant_days):
+    """Drops rows for `participant_days` (a frame of participant_id, date)
+    from the date partitions of a processed dataset, rewriting only the
+    files that actually contain one of those participants"""
+    for date, group in participant_days.groupby("date"):
+        partition = os.path.join(out_path, f"date={pd.to_datetime(date).date()}")
+        participants = set(group["participant_id"])
+        for path in glob.glob(os.path.join(partition, "*.parquet")):
+            ids = pq.read_table(path, columns=["participant_id"]).column(0).to_pandas()
+            keep = ~ids.astype(str).isin(participants)
+            if keep.all():
+                continue
+            if not keep.any():
+                os.remove(path)
+                continue
+            table = pq.read_table(path)
+            pq.write_table(table.filter(pa.array(keep.values)), path)
+    remove_stale_metadata(out_path)
+
+
+def remove_stale_metadata(out_path):
+    """Removes the `_metadata` files fastparquet used to write. Dask would
+    otherwise trust them and miss parts written since"""
+    for name in ["_metadata", "_common_metadata"]:
+        stale = os.path.join(out_path, name)
+        if os.path.exists(stale):
+            logger.info(f"Removing stale {stale}")
+            os.remove(stale)
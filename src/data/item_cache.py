@@ -0,0 +1,177 @@
+"""
+Byte-bounded cache for dataset items.
+
+`ActivtyDataset` used to keep every item it returned in a plain dict, so a
+few epochs over minute-level data duplicated the whole dataset in RAM.
+`ItemCache` holds items up to `max_bytes` and evicts either the least
+recently used item ("lru") or, with "clock", the oldest item that hasn't
+been hit since it was last passed over (second chance), which avoids
+reordering entries on every hit.
+
+Each DataLoader worker gets its own copy of a dataset, and so of its cache.
+`get_manager_item_cache` instead keeps the cache in a
+`multiprocessing.managers` server process and returns a proxy to it, so
+all workers share one cache (and one budget). This is not shared memory:
+every `get` and `put` pickles the item to or from the server, so it only
+pays off when building an item costs more than copying it. All manager
+caches of a process live in one server, which is shut down at exit.
+"""
+import atexit
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+import pandas as pd
+
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+DEFAULT_MAX_BYTES = int(os.environ.get("ITEM_CACHE_MAX_BYTES", 2 * 1024**3))
+POLICIES = ["lru", "clock"]
+
+
+def get_item_nbytes(item):
+    """Approximate size of an item: arrays, frames, and containers of them"""
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    if isinstance(item, pd.DataFrame):
+        return int(item.memory_usage(deep=True, index=True).sum())
+    if isinstance(item, pd.Series):
+        return int(item.memory_usage(deep=True, index=True))
+    if isinstance(item, dict):
+        return sum(get_item_nbytes(v) for v in item.values())
+    if isinstance(item, (list, tuple)):
+        return sum(get_item_nbytes(v) for v in item)
+    if isinstance(item, (str, bytes)):
+        return len(item)
+    return 8
+
+
+class ItemCache(object):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, policy="lru"):
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.referenced = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            if self.policy == "lru":
+                self.entries.move_to_end(key)
+            else:
+                self.referenced[key] = True
+            return self.entries[key]
+
+    def put(self, key, value):
+        size = get_item_nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.referenced[key] = False
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        if self.policy == "clock":
+            # Items hit since the hand last passed them get a second chance
+            key = next(iter(self.entries))
+            while self.referenced[key]:
+                self.referenced[key] = False
+                self.entries.move_to_end(key)
+                key = next(iter(self.entries))
+        else:
+            key = next(iter(self.entries))
+        del self.entries[key]
+        del self.referenced[key]
+        self.total_bytes -= self.sizes.pop(key)
+        self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.referenced.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "policy": self.policy}
+
+
+class ItemCacheManager(BaseManager):
+    pass
+
+ItemCacheManager.register("ItemCache", ItemCache,
+                          exposed=["get", "put", "clear", "stats", "__contains__", "__len__"])
+
+# One server for every manager cache of this process, started on first use
+_MANAGER = None
+
+def get_item_cache_manager():
+    global _MANAGER
+    if _MANAGER is None:
+        _MANAGER = ItemCacheManager()
+        _MANAGER.start()
+        atexit.register(shutdown_item_cache_manager)
+    return _MANAGER
+
+def shutdown_item_cache_manager():
+    """Stops the manager server. Proxies to its caches stop working."""
+    global _MANAGER
+    if _MANAGER is not None:
+        _MANAGER.shutdown()
+        _MANAGER = None
+
+def get_manager_item_cache(max_bytes=DEFAULT_MAX_BYTES, policy="lru"):
+    """An `ItemCache` living in the manager server process. The returned
+    proxy can be pickled into DataLoader workers, which then all use the
+    same cache; items are pickled on every access."""
+    cache = get_item_cache_manager().ItemCache(max_bytes, policy)
+    logger.info(f"Started a manager item cache of {max_bytes} bytes ({policy})")
+    return cache
+
+
+def get_item_cache(max_bytes=None, policy="lru", manager=False):
+    max_bytes = DEFAULT_MAX_BYTES if max_bytes is None else max_bytes
+    if manager:
+        return get_manager_item_cache(max_bytes, policy)
+    return ItemCache(max_bytes, policy)
@@ -23,12 +23,13 @@ import os
 logger = get_logger(__name__)
 
 from src.data.utils import (load_raw_table, load_processed_table, get_processed_dataset_path,
-                            process_minute_level)
+                            process_minute_level, write_processed_table,
+                            encode_survey_categoricals)
 import src.data.constants as cons
 
 
 
-def process_day_level(participant_ids=None, random_state=42):
+def process_day_level(participant_ids=None, random_state=42, vectorized=True):
     day_level_df = load_raw_table("fitbit_day_level_activity")
     if not participant_ids is None:
         day_level_df = day_level_df[day_level_df["participant_id"].isin(participant_ids)]  
@@ -43,12 +44,18 @@ def process_day_level(participant_ids=None, random_state=42):
     day_level_df["missing_steps"] = day_level_df["activityCalories"].isnull().astype(int)
     day_level_df.fillna(value = {k:0 for k in cons.DAILY_STEP_FEATURES}, inplace=True) 
     
-    day_level_df = day_level_df.groupby("participant_id").apply(fill_missing_days)
-    del day_level_df["participant_id"]
-    day_level_df = day_level_df.reset_index()
+    if vectorized:
+        day_level_df = fill_missing_days_vectorized(day_level_df)
+    else:
+        day_level_df = day_level_df.groupby("participant_id").apply(fill_missing_days)
+        del day_level_df["participant_id"]
+        day_level_df = day_level_df.reset_index()
 
-    processed_path = get_processed_dataset_path("fitbit_day_level_activity")
-    day_level_df.to_csv(processed_path)
+    # Partitioned by date so that readers only open the days in their
+    # date range
+    day_level_df = day_level_df.sort_values(["date","participant_id"]).reset_index(drop=True)
+    write_processed_table(day_level_df, "fitbit_day_level_activity", fmt="parquet",
+                          partition_cols=["date"])
 
 
 def fill_missing_days(user_df):
@@ -69,6 +76,30 @@ def fill_missing_days(user_df):
     return user_df
 
 
+def fill_missing_days_vectorized(day_level_df):
+    """Same output as `groupby("participant_id").apply(fill_missing_days)`,
+    but builds the (participant, date) grid for everyone at once"""
+    day_level_df = day_level_df.copy()
+    day_level_df["date"] = pd.to_datetime(day_level_df["date"])
+    day_level_df["missing_day"] = 0
+
+    bounds = day_level_df.groupby("participant_id", sort=True)["date"].agg(["min","max"])
+    n_days = ((bounds["max"] - bounds["min"]).dt.days + 1).values
+    offsets = np.arange(n_days.sum()) - np.repeat(np.cumsum(n_days) - n_days, n_days)
+    grid = pd.MultiIndex.from_arrays([np.repeat(bounds.index.values, n_days),
+                                      np.repeat(bounds["min"].values, n_days) + pd.to_timedelta(offsets, unit="D")],
+                                     names=["participant_id","date"])
+
+    filled = day_level_df.set_index(["participant_id","date"]).reindex(grid)
+    # Matches the flags set by fill_missing_days
+    filled["missing_steps"] = filled["missing_steps"].fillna(1)
+    filled["missing_hr"] = filled["missing_steps"]
+    filled["missing_sleep"] = filled["missing_sleep"].fillna(1)
+    filled["missing_day"] = filled["missing_sleep"]
+
+    return filled.fillna(0).reset_index()
+
+
 def process_surveys(return_result=False):
     # Ported from notebooks/melih_notebooks/EDA_survey.ipynb
     # Produces lab_results_with_trigger, baseline_screener_survey, daily_surveys_onehot
@@ -100,25 +131,31 @@ def process_surveys(return_result=False):
          , how = 'left', on = 'participant_id')
     df_lab_results_w_triggerdate.rename(columns = {"timestamp":"trigger_datetime"}, inplace = True)
     
-    lab_updates_with_trigger_path = get_processed_dataset_path("lab_results_with_triggerdate")
-    df_lab_results_w_triggerdate.to_csv(lab_updates_with_trigger_path,index=False)
+    write_processed_table(df_lab_results_w_triggerdate, "lab_results_with_triggerdate")
     
-    baseline_screener_survey_path = get_processed_dataset_path("baseline_screener_survey")
-    pd.merge(df_screener[['participant_id','timestamp', 'sex', 'ethnicity', 'race__0', 'race__1',
+    baseline_screener_survey = pd.merge(df_screener[['participant_id','timestamp', 'sex', 'ethnicity', 'race__0', 'race__1',
        'race__2', 'race__3', 'race__4', 'race__5', 'postal_code', 'age']], df_baseline
-         , how = 'left', on = 'participant_id' ).to_csv(baseline_screener_survey_path)
+         , how = 'left', on = 'participant_id' )
+    write_processed_table(baseline_screener_survey, "baseline_screener_survey")
 
     #One hot encode survey data:
     df_daily_survey = pd.concat([df_fup_a,df_fup_b])
     no_one_hot = ['occurrence', 'timestamp', 'participant_id', 'have_flu', 'recovered_yn',
         'recovery_datetime','first_report_yn', 'first_sx_datetime', 'body_temp_f']
     one_hot_encode = list(set(df_daily_survey.columns.values) - set(no_one_hot))
-    for col in one_hot_encode:
-            df_daily_survey = pd.get_dummies(df_daily_survey ,prefix = col, columns = [col])
+
+    # Compact version of the same table: one categorical column per question
+    # instead of one dummy column per answer. ClauseLabler expands just the
+    # dummies a clause refers to.
+    df_categorical = encode_survey_categoricals(df_daily_survey, one_hot_encode)
+    df_categorical['have_flu'] = df_categorical['have_flu'].astype('uint8')
+    write_processed_table(df_categorical, "daily_surveys_categorical", fmt="parquet", write_csv=False)
+
+    df_daily_survey = pd.get_dummies(df_daily_survey, prefix=one_hot_encode,
+                                     columns=one_hot_encode, dtype="uint8")
     df_daily_survey['have_flu'] = df_daily_survey['have_flu'].astype('uint8')
 
-    one_hot_path = get_processed_dataset_path("daily_surveys_onehot")
-    df_daily_survey.to_csv(one_hot_path,index=False)
+    write_processed_table(df_daily_survey, "daily_surveys_onehot")
 
     if return_result:
         return df_daily_survey
@@ -135,8 +172,7 @@ def lab_updates(updates_path=None,return_result=False):
     df_updates['received_datetime'] = pd.to_datetime(df_updates.received_datetime)
     df_updates['report_sent_datetime'] = pd.to_datetime(df_updates.report_sent_datetime)
 
-    lab_updates_path = get_processed_dataset_path("lab_updates")
-    df_updates.to_csv(lab_updates_path,index=False)
+    write_processed_table(df_updates, "lab_updates")
     
     if return_result:
         return df_updates
@@ -148,8 +184,7 @@ def lab_results(return_result=False):
     df_results['report_sent_datetime'] = pd.to_datetime(df_results.report_sent_datetime)
     df_results['assay_datetime'] = pd.to_datetime(df_results.assay_datetime)
 
-    lab_results_path = get_processed_dataset_path("lab_results")
-    df_results.to_csv(lab_results_path,index=False)
+    write_processed_table(df_results, "lab_results")
 
     if return_result:
         return df_results
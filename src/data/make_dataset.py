@@ -6,12 +6,17 @@ import glob
 import os
 
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 
 from distributed import client
 from distributed.utils import cli_keywords
 
-from src.data.utils import get_dask_df, process_minute_level, process_minute_level_pandas
+from src.data.utils import (get_dask_df, process_minute_level, process_minute_level_pandas,
+                            encode_compact_minute_level)
+from src.data.incremental import (build_manifest, load_manifest, write_manifest,
+                                  find_changed_participant_days, get_reprocessing_ranges,
+                                  remove_participant_days, remove_stale_metadata)
 from src.utils import get_logger
 logger = get_logger(__name__)
 
@@ -28,6 +33,8 @@ import numpy as np
 import pandas as pd
 
 import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 def explode_str_column_dask(df: dd, target_col: str,
@@ -109,7 +116,89 @@ def explode_str_column(df: pd.DataFrame, target_col: str,
     # logger.info("Setting index...")
     df = df.set_index("timestamp").sort_index()
     return df
-    
+
+
+def explode_str_column_vectorized(df: pd.DataFrame, target_col: str,
+                   freq: str = "min", dur: str = "1D",
+                   sep_char: str = " ", date_col: str = "dt",
+                   dtype: str  = "Int32", participant_col: str = "id_participant_external",
+                   rename_participant_id_column: str = "participant_id",
+                   rename_target_column: Optional[str] = None,
+                   start_col: Optional[str] = None,
+                   dur_col: Optional[str] = None,
+                   clip_max: int = 200,
+                   single_val=False,
+                   keep_participant=False) -> pd.DataFrame:
+    """Drop-in replacement for `explode_str_column` that decodes the whole
+    `target_col` in one pass with Arrow string kernels instead of building a
+    `pd.date_range` per row.
+
+    If `keep_participant` is set the result also carries the participant id
+    (taken from the index) as a column, and duplicates are dropped per
+    participant, so the whole raw table can be exploded at once.
+    """
+    val_col_name = rename_target_column if rename_target_column else target_col
+    pid_col_name = rename_participant_id_column if rename_participant_id_column else participant_col
+
+    if df.empty:
+        return pd.DataFrame(columns=["timestamp",val_col_name],index=pd.DatetimeIndex([])).set_index("timestamp")
+
+    freq_ns = pd.tseries.frequencies.to_offset(freq).nanos
+
+    # Where each row's run of timestamps starts and how long it can be
+    if start_col:
+        starts = pd.to_datetime(df[start_col]).dt.round(freq)
+        n_range = pd.to_numeric(df[dur_col]).to_numpy().astype(np.int64)
+    else:
+        starts = pd.to_datetime(df[date_col])
+        n_range = np.full(len(df), pd.to_timedelta(dur).value // freq_ns, dtype=np.int64)
+    starts = starts.to_numpy().astype("datetime64[ns]").view(np.int64)
+
+    if not single_val:
+        tokens = pc.split_pattern(pa.array(df[target_col].to_numpy(), type=pa.string()),
+                                  pattern=sep_char)
+        lengths = pc.list_value_length(tokens).to_numpy(zero_copy_only=False).astype(np.int64)
+        flat = pc.list_flatten(tokens)
+        try:
+            values = pc.cast(flat, pa.int64()).to_numpy(zero_copy_only=False)
+        except pa.ArrowInvalid:
+            # e.g. "nan" tokens, which pd.to_numeric would also turn into floats
+            values = pc.cast(flat, pa.float64()).to_numpy(zero_copy_only=False)
+    else:
+        lengths = n_range
+        values = np.repeat(pd.to_numeric(df[target_col]).to_numpy(), lengths)
+
+    # Position of every token inside its own row
+    row_ends = np.cumsum(lengths)
+    positions = np.arange(row_ends[-1] if len(row_ends) else 0) - np.repeat(row_ends - lengths, lengths)
+
+    # Rows may carry more tokens than their range has minutes, drop the extras
+    in_range = positions < np.repeat(n_range, lengths)
+    timestamps = np.repeat(starts, lengths) + positions * freq_ns
+    timestamps, values = timestamps[in_range], values[in_range]
+
+    if keep_participant:
+        codes = np.repeat(pd.Categorical(df.index).codes, lengths)[in_range]
+        categories = pd.Categorical(df.index).categories
+        order = np.lexsort((timestamps, codes))
+        codes, timestamps, values = codes[order], timestamps[order], values[order]
+        # Keep the last occurrence of each (participant, timestamp)
+        keep = np.ones(len(timestamps), dtype=bool)
+        keep[:-1] = (codes[1:] != codes[:-1]) | (timestamps[1:] != timestamps[:-1])
+    else:
+        order = np.argsort(timestamps, kind="stable")
+        timestamps, values = timestamps[order], values[order]
+        keep = np.ones(len(timestamps), dtype=bool)
+        keep[:-1] = timestamps[1:] != timestamps[:-1]
+
+    result = pd.DataFrame({val_col_name: pd.to_numeric(pd.Series(values[keep]),
+                                                       downcast="unsigned").clip(upper=clip_max).values},
+                          index=pd.DatetimeIndex(timestamps[keep].view("datetime64[ns]"),
+                                                 name="timestamp"))
+    if keep_participant:
+        result[pid_col_name] = pd.Categorical.from_codes(codes[keep], categories=categories)
+    return result
+
 
 def get_new_index(item: dict, target_column: str,
                    freq: str = "min", dur: str = "1D",
@@ -125,8 +214,9 @@ def get_new_index(item: dict, target_column: str,
         start_ts = pd.to_datetime(item[date_col])
         end_ts = start_ts + pd.to_timedelta(dur)
 
-    new_index = pd.date_range(start_ts,end_ts,freq=freq,closed="left").values
-    return new_index
+    # Left-closed range. `closed="left"` was removed in pandas 2
+    new_index = pd.date_range(start_ts,end_ts,freq=freq)
+    return new_index[new_index < end_ts].values
 
 CHUNKSIZE="1GB"
 PARTITION_SIZE="1GB"
@@ -134,9 +224,9 @@ def read_raw_dask(path):
         df = dd.from_pandas(read_raw_pandas(path),npartitions=128)#.set_index("id_participant_external")
         return df.persist()
 
-def read_raw_pandas(path,set_dtypes=None):
+def read_raw_pandas(path,set_dtypes=None,filters=None):
     logger.info("Reading...")
-    df = pd.read_parquet(path,engine='pyarrow')
+    df = pd.read_parquet(path,engine='pyarrow',filters=filters)
     df["id_participant_external"] = df["id_participant_external"].astype("category")
     if set_dtypes:
         for k,v in set_dtypes.items():
@@ -144,12 +234,50 @@ def read_raw_pandas(path,set_dtypes=None):
             
     return df.dropna().set_index("id_participant_external")
 
+def read_raw_participants(path):
+    """Participant ids in a raw table, without loading the minute strings"""
+    df = pd.read_parquet(path,engine='pyarrow',columns=["id_participant_external"])
+    return df["id_participant_external"].dropna().unique()
+
 def safe_loc(df,ind):
     try:
         return df.loc[[ind]]
     except KeyError:
         return pd.DataFrame(columns=df.columns)
 
+class ParticipantGroupedTable(object):
+    """A raw table sorted once by participant, plus an offsets array over the
+    sorted rows. Looking up a participant is then a dict probe and a
+    contiguous `iloc` slice (a view, not a copy) instead of a `.loc` scan
+    over the non-unique participant index.
+    """
+    def __init__(self, df):
+        categories = pd.Categorical(df.index)
+        order = np.argsort(categories.codes, kind="stable")
+        self.df = df.iloc[order]
+
+        counts = np.bincount(categories.codes, minlength=len(categories.categories))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.participant_ids = categories.categories.values
+        self.lookup = {participant_id: i for i, participant_id in enumerate(self.participant_ids)}
+
+    def __getitem__(self, participant_id):
+        i = self.lookup.get(participant_id)
+        if i is None:
+            return self.df.iloc[0:0]
+        return self.df.iloc[self.offsets[i]:self.offsets[i+1]]
+
+    def __len__(self):
+        return len(self.df)
+
+    def participants(self):
+        """Participants with at least one row, in sorted order"""
+        has_rows = np.diff(self.offsets) > 0
+        return self.participant_ids[has_rows]
+
+def read_raw_grouped(path, filters=None):
+    return ParticipantGroupedTable(read_raw_pandas(path, filters=filters))
+
 COLUMNS = ["date",
            "timestamp",
            "heart_rate",
@@ -161,63 +289,225 @@ COLUMNS = ["date",
            "sleep_classic_2",
            "sleep_classic_3"]
 
+SLEEP_COLUMNS = [f"sleep_classic_{i}" for i in range(4)]
+
+def process_user(user, user_sleep, user_hr, user_steps):
+    exploded_sleep = explode_str_column_vectorized(user_sleep,
+                                target_col = "minute_level_str",
+                                rename_target_column="sleep_classic",
+                                start_col="main_start_time",
+                                dur_col = "main_in_bed_minutes",
+                                dtype=pd.Int8Dtype())
+    exploded_hr =  explode_str_column_vectorized(user_hr,
+                                      target_col = "minute_level_str",
+                                      rename_target_column="heart_rate",
+                                      dtype=pd.Int8Dtype())
+    exploded_steps = explode_str_column_vectorized(user_steps,
+                                        target_col="minute_level_str",
+                                        rename_target_column="steps",
+                                        dtype=pd.Int8Dtype())
+    steps_and_hr = exploded_steps.join(exploded_hr,how = "left") 
+    merged = steps_and_hr.join(exploded_sleep,how="left")                        
+
+    processed = process_minute_level_pandas(minute_level_df = merged)
+
+    # Keep datatypes in check
+    processed["heart_rate"] = processed["heart_rate"].astype(pd.Int16Dtype())
+    processed["participant_id"] = user
+    return processed
+
+def fill_sleep_columns(results):
+    for col in SLEEP_COLUMNS:
+        results[col] = results[col].fillna(False)
+    return results
+
+def write_shard(results, out_path, part_name, compact=False):
+    """Writes one shard of processed users as its own part files under
+    the `date` partitioning, so shards never need to be concatenated"""
+    if compact:
+        results = encode_compact_minute_level(results)
+    table = pa.Table.from_pandas(results, preserve_index=False)
+    pq.write_to_dataset(table, root_path=out_path, partition_cols=["date"],
+                        basename_template=f"part-{part_name}-{{i}}.parquet")
+
+def process_shard(shard_index, users, sleep_in_path, steps_in_path,
+                  heart_rate_in_path, out_path, compact=False):
+    # Only read this shard's participants, so peak memory scales with
+    # the size of the shard rather than the whole cohort
+    filters = [("id_participant_external", "in", list(users))]
+    sleep = read_raw_grouped(sleep_in_path, filters=filters)
+    hr = read_raw_grouped(heart_rate_in_path, filters=filters)
+    steps = read_raw_grouped(steps_in_path, filters=filters)
+
+    results = [process_user(user, sleep[user], hr[user], steps[user])
+               for user in steps.participants()]
+    if not results:
+        return 0
+
+    results = fill_sleep_columns(pd.concat(results))
+    write_shard(results, out_path, f"{shard_index:05d}", compact=compact)
+    return len(results)
+
+def remove_processed_parts(out_path):
+    """Removes the part files and metadata of an earlier full run, so a
+    rebuild doesn't leave parts of participants or days that are gone"""
+    for path in glob.glob(os.path.join(out_path, "date=*", "part-*.parquet")):
+        os.remove(path)
+    remove_stale_metadata(out_path)
+
+def run_sharded(sleep_in_path, steps_in_path, heart_rate_in_path, out_path,
+                workers, participants_per_shard, compact=False):
+    # Shards of an earlier run would otherwise stay next to the new ones
+    remove_processed_parts(out_path)
+    users_with_steps = read_raw_participants(steps_in_path)
+    n_shards = max(1, int(np.ceil(len(users_with_steps) / participants_per_shard)))
+    shards = np.array_split(users_with_steps, n_shards)
+    logger.info(f"Processing {len(users_with_steps)} users in {n_shards} shards "
+                f"across {workers} workers...")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_shard, i, shard, sleep_in_path, steps_in_path,
+                                   heart_rate_in_path, out_path, compact)
+                   for i, shard in enumerate(shards)]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+
+def participant_rows_in_range(table, user, date_col, start, end):
+    rows = table[user]
+    if rows.empty:
+        return rows
+    dates = pd.to_datetime(rows[date_col]).dt.normalize()
+    return rows[(dates >= start) & (dates <= end)]
+
+def process_user_range(user, user_sleep, user_hr, user_steps, write_from, write_to):
+    """Processes a participant's raw rows and keeps the days in the write range"""
+    processed = process_user(user, user_sleep, user_hr, user_steps)
+    write_dates = pd.to_datetime(processed["timestamp"]).dt.normalize()
+    return processed[(write_dates >= write_from) & (write_dates <= write_to)]
+
+def run_incremental(sleep_in_path, steps_in_path, heart_rate_in_path, out_path,
+                    manifest, old_manifest, compact=False, workers=None):
+    """Reprocesses only the participant-days of raw files that are new,
+    modified or deleted since `old_manifest` was written, and only reads the
+    raw rows of the participants involved. With `workers`, participants are
+    processed across that many processes."""
+    changed = find_changed_participant_days(old_manifest, manifest)
+    if changed.empty:
+        logger.info("No new, modified or deleted raw files, nothing to do")
+        return
+
+    ranges = get_reprocessing_ranges(changed, manifest)
+    logger.info(f"Reprocessing {len(changed)} changed participant-days "
+                f"for {len(ranges)} participants...")
+
+    filters = [("id_participant_external", "in", list(ranges["participant_id"]))]
+    sleep = read_raw_grouped(sleep_in_path, filters=filters)
+    hr = read_raw_grouped(heart_rate_in_path, filters=filters)
+    steps = read_raw_grouped(steps_in_path, filters=filters)
+
+    tasks = []
+    rewritten = []
+    for row in ranges.itertuples(index=False):
+        user = row.participant_id
+        # Days whose raw rows were deleted are removed even if nothing replaces them
+        rewritten.append(pd.DataFrame({"participant_id": user,
+                                       "date": pd.date_range(row.write_from, row.write_to)}))
+        user_sleep = participant_rows_in_range(sleep, user, "main_start_time", row.read_from, row.read_to)
+        user_hr = participant_rows_in_range(hr, user, "dt", row.read_from, row.read_to)
+        user_steps = participant_rows_in_range(steps, user, "dt", row.read_from, row.read_to)
+        if user_steps.empty:
+            continue
+        tasks.append((user, user_sleep, user_hr, user_steps, row.write_from, row.write_to))
+
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(process_user_range, *task) for task in tasks]
+            all_results = [future.result() for future in tqdm(futures)]
+    else:
+        all_results = [process_user_range(*task) for task in tqdm(tasks)]
+    remove_participant_days(out_path, pd.concat(rewritten))
+    all_results = [results for results in all_results if not results.empty]
+    if not all_results:
+        return
+    all_results = fill_sleep_columns(pd.concat(all_results))
+    # Unique, so parts of two runs can never overwrite each other
+    write_shard(all_results, out_path, f"incremental-{uuid.uuid4().hex}", compact=compact)
+
 @click.command()
 @click.argument("sleep_in_path", type=click.Path(exists=True))
 @click.argument("steps_in_path", type=click.Path(exists=True))
 @click.argument("heart_rate_in_path",type=click.Path(exists=True))
 @click.argument("out_path",type=click.Path())
+@click.option("--workers", type=int, default=None,
+              help="If provided, process participants across this many processes")
+@click.option("--participants_per_shard", type=int, default=256)
+@click.option("--incremental", is_flag=True,
+              help="Only reprocess participant-days that changed since the last run")
+@click.option("--compact", is_flag=True,
+              help="Write uint8 values, a single sleep stage code and bit-packed missingness flags")
 def main(sleep_in_path: str, steps_in_path: str, 
-         heart_rate_in_path: str, out_path: str) -> None:
+         heart_rate_in_path: str, out_path: str,
+         workers: Optional[int] = None,
+         participants_per_shard: int = 256,
+         incremental: bool = False,
+         compact: bool = False) -> None:
     
     start = time.time()
+    if workers and not incremental:
+        run_sharded(sleep_in_path, steps_in_path, heart_rate_in_path, out_path,
+                    workers=workers, participants_per_shard=participants_per_shard,
+                    compact=compact)
+        end = time.time()
+        logger.info(f"Time elapsed {end-start}")
+        return
+
+    if incremental:
+        raw_paths = {"sleep": sleep_in_path, "steps": steps_in_path,
+                     "heart_rate": heart_rate_in_path}
+        old_manifest = load_manifest(out_path)
+        manifest = build_manifest(raw_paths, old_manifest)
+        if old_manifest is not None:
+            run_incremental(sleep_in_path, steps_in_path, heart_rate_in_path, out_path,
+                            manifest, old_manifest, compact=compact, workers=workers)
+            write_manifest(manifest, out_path)
+            end = time.time()
+            logger.info(f"Time elapsed {end-start}")
+            return
+        logger.info("No manifest found, doing a full rebuild")
+        if workers:
+            run_sharded(sleep_in_path, steps_in_path, heart_rate_in_path, out_path,
+                        workers=workers, participants_per_shard=participants_per_shard,
+                        compact=compact)
+            write_manifest(manifest, out_path)
+            end = time.time()
+            logger.info(f"Time elapsed {end-start}")
+            return
+
     logger.info("Loading sleep...")
-    sleep = read_raw_pandas(sleep_in_path)
+    sleep = read_raw_grouped(sleep_in_path)
 
     logger.info("Loading heart rate...") 
-    hr = read_raw_pandas(heart_rate_in_path)
+    hr = read_raw_grouped(heart_rate_in_path)
 
     logger.info("Loading steps...") 
-    steps = read_raw_pandas(steps_in_path)
+    steps = read_raw_grouped(steps_in_path)
 
-    users_with_steps = steps.index.unique()
+    users_with_steps = steps.participants()
 
     logger.info("Processing users...")               
     all_results = []
 
-    for user in tqdm(users_with_steps.values):
-        exploded_sleep = explode_str_column(safe_loc(sleep,user),
-                                    target_col = "minute_level_str",
-                                    rename_target_column="sleep_classic",
-                                    start_col="main_start_time",
-                                    dur_col = "main_in_bed_minutes",
-                                    dtype=pd.Int8Dtype())
-        exploded_hr =  explode_str_column(safe_loc(hr,user),
-                                          target_col = "minute_level_str",
-                                          rename_target_column="heart_rate",
-                                          dtype=pd.Int8Dtype())
-        exploded_steps = explode_str_column(safe_loc(steps,user),
-                                            target_col="minute_level_str",
-                                            rename_target_column="steps",
-                                            dtype=pd.Int8Dtype())
-        steps_and_hr = exploded_steps.join(exploded_hr,how = "left") 
-        merged = steps_and_hr.join(exploded_sleep,how="left")                        
-
-        
-        processed = process_minute_level_pandas(minute_level_df = merged)
-
-        # Keep datatypes in check
-        processed["heart_rate"] = processed["heart_rate"].astype(pd.Int16Dtype())
-        processed["participant_id"] = user
-        all_results.append(processed)
-
-    all_results = pd.concat(all_results)
-    all_results["sleep_classic_0"] = all_results["sleep_classic_0"].fillna(False)
-    all_results["sleep_classic_1"] = all_results["sleep_classic_1"].fillna(False)
-    all_results["sleep_classic_2"] = all_results["sleep_classic_2"].fillna(False)
-    all_results["sleep_classic_3"] = all_results["sleep_classic_3"].fillna(False)
-
-    all_results.to_parquet(path = out_path, partition_cols=["date"], engine="fastparquet")
+    for user in tqdm(users_with_steps):
+        all_results.append(process_user(user, sleep[user], hr[user], steps[user]))
+
+    all_results = fill_sleep_columns(pd.concat(all_results))
+    # Same writer as the sharded and incremental runs, so a dataset never
+    # mixes pyarrow and fastparquet parts
+    remove_processed_parts(out_path)
+    write_shard(all_results, out_path, "00000", compact=compact)
+    if incremental:
+        write_manifest(manifest, out_path)
     end = time.time()
     print("Time elapsed",end-start)
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -12,6 +12,7 @@ Transformations include scaling and grouping of data to time windows of specifie
 from gc import callbacks
 from os import name
 from xml.etree.ElementInclude import include
+import os
 import numpy as np
 import click
 
@@ -34,8 +35,18 @@ from petastorm.unischema import dict_to_spark_row, Unischema, UnischemaField, _n
 import pandas as pd
 
 from src.models.commands import validate_yaml_or_json
+from src.data.window_engine import (get_feature_columns, write_windowed_dataset,
+                                    get_existing_windows, get_column_aggregation,
+                                    get_aggregated_dtype, check_resolution, ID_DAY_BITS)
+from src.data.spark_session import get_spark_session, timed_stage
+from src.data.utils import (write_normalization_stats, load_normalization_stats,
+                            get_normalization_stats_path, write_window_meta,
+                            load_window_meta)
+from src.utils import get_logger
+logger = get_logger(__name__)
 
 MINS_IN_DAY = 60*24
+SECONDS_IN_DAY = MINS_IN_DAY*60
 
 
 from contextlib import contextmanager
@@ -103,10 +114,35 @@ def filter_spark_dataframe_by_list(df, column_name, filter_list):
 @click.option("--rename", type=str, multiple=True)
 @click.option("--users", type=click.Path(exists=True), callback=validate_yaml_or_json)
 @click.option("--include_users", type=bool,is_flag=True)
+@click.option("--engine", type=click.Choice(["spark","local"]), default="spark",
+              help="'local' builds windows with NumPy in a process pool instead of Spark")
+@click.option("--workers", type=int, default=8, help="Processes used by the local engine")
+@click.option("--missing_column", type=str, default="missing_heart_rate",
+              help="Days without any minute where this is false count as missing")
+@click.option("--append", is_flag=True,
+              help="Only add windows ending after each participant's latest window in output_path. "
+                   "Existing windows count toward --min_windows")
+@click.option("--scaling_stats", type=str, default=None,
+              help="Normalization stats (or a dataset written with them) to scale with instead of refitting")
+@click.option("--bucket_participants", type=int, default=None,
+              help="Partition by crc32(participant_id) % N, so each participant's windows share a directory")
+@click.option("--partition_by_date", is_flag=True,
+              help="Partition by each window's last day (end_date=YYYY-MM-DD)")
+@click.option("--windows_per_row_group", type=int, default=None,
+              help="Size row groups by a number of windows instead of a fixed 256MB")
+@click.option("--compression", type=click.Choice(["snappy","zstd","gzip","lz4","none"]), default="snappy")
+@click.option("--spark_config", type=click.Path(exists=True), default=None,
+              help="YAML/JSON of Spark properties overriding the host-sized defaults")
+@click.option("--resolution", type=int, default=1,
+              help="Minutes per time step, e.g. 5, 15 or 60. Must divide a day")
 def main(input_path, output_path, max_missing_days_in_window, 
                     min_windows, day_window_size, parse_timestamp,
                     min_date=None, max_date=None, partition_by = None, rename=None,
-                    no_scale=False, users=None, include_users=False):
+                    no_scale=False, users=None, include_users=False,
+                    engine="spark", workers=8, missing_column="missing_heart_rate",
+                    scaling_stats=None, append=False, bucket_participants=None,
+                    partition_by_date=False, windows_per_row_group=None, compression="snappy",
+                    spark_config=None, resolution=1):
 
                 
     if not "file://" in output_path:
@@ -127,7 +163,12 @@ def main(input_path, output_path, max_missing_days_in_window,
     schema = Unischema.from_arrow_schema(pyarrow_dataset)
     
    
-    expected_length = day_window_size*MINS_IN_DAY
+    check_resolution(resolution)
+    existing_meta = load_window_meta(output_path) if append else None
+    if existing_meta and existing_meta["resolution"] != resolution:
+        raise ValueError(f"Can't append {resolution}-minute windows to a dataset of "
+                         f"{existing_meta['resolution']}-minute windows")
+    expected_length = day_window_size*MINS_IN_DAY // resolution
     new_fields = []
     for field in schema.fields.values():
         name = field.name
@@ -136,6 +177,8 @@ def main(input_path, output_path, max_missing_days_in_window,
         if name in rename:
             name = rename[name]
         np_dtype = field.numpy_dtype
+        if resolution > 1 and name != "participant_id":
+            np_dtype = get_aggregated_dtype(name, np_dtype)
         if np_dtype is np.float64:
             new_fields.append(UnischemaField(name,np.float32,nullable=False,shape=(expected_length,)))
         else:
@@ -143,23 +186,53 @@ def main(input_path, output_path, max_missing_days_in_window,
         
     new_fields.append(UnischemaField("start",np.datetime64,nullable=False,shape=None))
     new_fields.append(UnischemaField("end",np.datetime64,nullable=False,shape=None))
-    new_fields.append(UnischemaField("id",np.int32,nullable=False,shape=None))
+    new_fields.append(UnischemaField("id",np.int64,nullable=False,shape=None))
+
+    # Hive partition columns are read back as fields by petastorm
+    partition_cols = [partition_by] if partition_by else []
+    if bucket_participants:
+        new_fields.append(UnischemaField("participant_bucket",np.int32,nullable=False,shape=None))
+        partition_cols.append("participant_bucket")
+    if partition_by_date:
+        new_fields.append(UnischemaField("end_date",np.str_,nullable=False,shape=None))
+        partition_cols.append("end_date")
 
     schema = Unischema("homekit",new_fields)
     rowgroup_size_mb = 256
+    if windows_per_row_group:
+        window_bytes = sum(np.dtype(field.numpy_dtype).itemsize * expected_length
+                           for field in new_fields if field.shape)
+        rowgroup_size_mb = max(1, int(np.ceil(windows_per_row_group * window_bytes / 1024**2)))
+    layout = {"partition_by": [partition_by] if partition_by else [],
+              "bucket_participants": bucket_participants,
+              "partition_by_date": partition_by_date,
+              "windows_per_row_group": windows_per_row_group,
+              "compression": compression}
+
+    # Statistics fit on another (e.g. training) dataset
+    if append and not scaling_stats and os.path.exists(get_normalization_stats_path(output_path)):
+        # Appended windows have to be scaled like the existing ones
+        scaling_stats = output_path
+    stats = load_normalization_stats(scaling_stats) if scaling_stats else None
+
+    if engine == "local":
+        feature_columns, scale_columns = get_feature_columns(input_path, rename)
+        stats = write_windowed_dataset(input_path, output_path, schema, feature_columns,
+                                       scale_columns=[] if no_scale else scale_columns,
+                                       day_window_size=day_window_size, rename=rename,
+                                       min_date=min_date, max_date=max_date,
+                                       users=users, include_users=include_users,
+                                       workers=workers, rowgroup_size_mb=rowgroup_size_mb,
+                                       stats=stats,
+                                       max_missing_days_in_window=max_missing_days_in_window,
+                                       min_windows=min_windows, missing_column=missing_column,
+                                       append=append, layout=layout, resolution=resolution)
+        if not no_scale:
+            write_normalization_stats(output_path, *stats)
+        write_window_meta(output_path, day_window_size, resolution)
+        return
 
-    configuation_properties = [
-    ("spark.master","local[64]"),
-    ("spark.ui.port","4050"),
-    ("spark.executor.memory","32g"),
-    ('spark.driver.memory',  '2000g'),
-    ("spark.driver.maxResultSize", '0'), # unlimited
-    ("spark.network.timeout",            "10000001"),
-    ("spark.executor.heartbeatInterval", "10000000")]   
-    
-    conf = SparkConf().setAll(configuation_properties)
-    sc = SparkContext(conf=conf, appName="PetaStorm Conversion")
-    spark = SparkSession(sc)
+    spark = get_spark_session("PetaStorm Conversion", spark_config)
 
 
     # Wrap dataset materialization portion. Will take care of setting up spark environment variables as
@@ -185,24 +258,40 @@ def main(input_path, output_path, max_missing_days_in_window,
             else:
                 user_mask = ~df.participant_id.isin(users)
                 df = df[user_mask]
+
+        existing_ends = None
+        if append:
+            ends, counts = get_existing_windows(output_path)
+            if ends:
+                existing_ends = spark.createDataFrame(pd.DataFrame({"participant_id": list(ends.keys()),
+                                                                    "existing_end": list(ends.values()),
+                                                                    "n_existing": [counts[p] for p in ends]}))
+                # Only read the minutes that can be in a window ending after the existing ones
+                df = df.join(f.broadcast(existing_ends), on="participant_id", how="left")
+                df = df.where(f.col("existing_end").isNull() |
+                              (f.col("timestamp") >= f.col("existing_end") - f.expr(f"INTERVAL {day_window_size} DAYS")))\
+                       .drop("existing_end", "n_existing")
              
         # Scale the data
         if not no_scale:
-            assemblers = [VectorAssembler(inputCols=[col], outputCol=col + "_vec") for col in dbl_cols]
-            scalers = [StandardScaler(inputCol=col + "_vec", outputCol=col + "_scaled") for col in dbl_cols]
-            pipeline = Pipeline(stages=assemblers + scalers)
-            scalerModel = pipeline.fit(df)
-            scaledData = scalerModel.transform(df)
-            
-            names = {x + "_scaled": x for x in dbl_cols}
-            firstelement=f.udf(lambda v:float(v[0]),sql_types.DoubleType())
-            scaled_cols = [firstelement(f.col(c)).alias(names[c]) for c in names.keys()]
-            old_cols = [f.col(c) for c in non_dbl_cols]
-            scaledData = scaledData.select(old_cols + scaled_cols)
+            if stats is None:
+                with timed_stage(spark, "scaling stats"):
+                    stats = get_spark_scaling_stats(df, dbl_cols)
+            scaledData = apply_spark_scaling(df, dbl_cols, non_dbl_cols, stats[1])
         
         else:
            scaledData = df
 
+        # Windows to keep are worked out on the minute-level data, since complete
+        # days and missing_* flags don't survive aggregating to a coarser resolution
+        with timed_stage(spark, "valid windows"):
+            valid_windows = get_spark_valid_windows(scaledData, day_window_size,
+                                                    max_missing_days_in_window, min_windows,
+                                                    missing_column, existing_ends)
+
+        if resolution > 1:
+            scaledData = aggregate_spark_resolution(scaledData, resolution)
+
         # Apply windowing
         window_duration = f"{day_window_size} days"
         slide_duration = f"1 days"
@@ -216,6 +305,10 @@ def main(input_path, output_path, max_missing_days_in_window,
 
         # Remove windows that don't have enough samples (e.g. on the edges)
         result  = result.filter(result.count_col == expected_length)
+
+        # ... and those with too many days without data
+        result = result.withColumn("window_day", f.floor(result.window.start.cast("long") / SECONDS_IN_DAY))
+        result = result.join(valid_windows, on=["participant_id","window_day"], how="inner")
         
         result.drop("count_col")
         
@@ -226,12 +319,152 @@ def main(input_path, output_path, max_missing_days_in_window,
         final_columns = ["participant_id","start","end"] + [f.col(f"{x}.{x}").alias(x) for x in feature_columns] 
         result = result.select(*final_columns)
         
-        # Add ID
-        result = result.select("*").withColumn("id", f.monotonically_increasing_id())
+        if existing_ends is not None:
+            result = result.join(f.broadcast(existing_ends), on="participant_id", how="left")
+            result = result.where(f.col("existing_end").isNull() | (f.col("end") > f.col("existing_end")))\
+                           .drop("existing_end", "n_existing")
 
-        result.write \
-            .mode('overwrite') \
-            .parquet(output_path, partitionBy= partition_by)
+        # Add ID
+        result = result.withColumn("id", get_spark_window_id(f.col("participant_id"), f.col("start")))
+
+        if bucket_participants:
+            result = result.withColumn("participant_bucket",
+                                       f.pmod(f.crc32(f.col("participant_id")), f.lit(bucket_participants)).cast("int"))
+        if partition_by_date:
+            # Windows have an exclusive right boundary, so this is their last day.
+            # Worked out from epoch days rather than date_sub/date_format, which
+            # use the session time zone, so dates match the local engine's UTC ones
+            last_day = f"CAST(floor(CAST(`end` AS BIGINT) / {SECONDS_IN_DAY}) - 1 AS INT)"
+            result = result.withColumn("end_date",
+                                       f.expr(f"date_add(DATE'1970-01-01', {last_day})").cast("string"))
+        if partition_cols:
+            # One task per partition value, so each directory gets a single file
+            # with full row groups rather than a file per input partition
+            result = result.repartition(*partition_cols)
+
+        with timed_stage(spark, "write windows"):
+            result.write \
+                .mode('append' if append else 'overwrite') \
+                .option("compression", compression) \
+                .parquet(output_path, partitionBy=partition_cols or None)
+
+    # Written after the job, since overwriting the output removes anything in it
+    if not no_scale:
+        write_normalization_stats(output_path, *stats)
+    write_window_meta(output_path, day_window_size, resolution)
+
+def get_spark_valid_windows(df, day_window_size, max_missing_days_in_window, min_windows,
+                            missing_column="missing_heart_rate", existing=None):
+    """(participant_id, window_day) of the windows to keep, worked out on
+    per participant-day counts rather than on the windows themselves.
+    A window is kept if all of its days are complete, at least
+    `day_window_size - max_missing_days_in_window` of them have data (as in
+    `MinuteLevelActivityReader.get_valid_dates`) and its participant has at
+    least `min_windows` such windows.
+
+    When appending, `existing` has each participant's `existing_end` and
+    `n_existing` windows. `df` then only has the minutes after those
+    windows, so they count toward `min_windows` alongside the new ones."""
+    day = f.floor(f.col("timestamp").cast("long") / SECONDS_IN_DAY)
+    if missing_column in df.columns:
+        has_data = (~f.coalesce(f.col(missing_column).cast("boolean"), f.lit(True))).cast("int")
+    else:
+        has_data = f.lit(1)
+    days = df.groupBy("participant_id", day.alias("window_day"))\
+             .agg(f.count(f.lit(1)).alias("n_minutes"), f.max(has_data).alias("has_data"))
+
+    following_days = Window.partitionBy("participant_id").orderBy("window_day")\
+                           .rangeBetween(0, day_window_size - 1)
+    days = days.withColumn("n_complete_days", f.sum((f.col("n_minutes") == MINS_IN_DAY).cast("int")).over(following_days))\
+               .withColumn("n_days_with_data", f.sum("has_data").over(following_days))
+
+    candidates = days.filter(f.col("n_complete_days") == day_window_size)
+    valid = candidates.filter(f.col("n_days_with_data") >= day_window_size - max_missing_days_in_window)
+    participant = Window.partitionBy("participant_id")
+    if existing is not None:
+        valid = valid.join(f.broadcast(existing), on="participant_id", how="left")
+        window_end = ((f.col("window_day") + day_window_size) * SECONDS_IN_DAY).cast("timestamp")
+        is_new = f.col("existing_end").isNull() | (window_end > f.col("existing_end"))
+        n_windows = f.sum(is_new.cast("int")).over(participant) + f.coalesce(f.col("n_existing"), f.lit(0))
+    else:
+        n_windows = f.count(f.lit(1)).over(participant)
+    valid = valid.withColumn("n_windows", n_windows)\
+                 .filter(f.col("n_windows") >= min_windows)\
+                 .select("participant_id", "window_day")\
+                 .cache()
+
+    n_candidates, n_valid = candidates.count(), valid.count()
+    logger.info(f"Kept {n_valid} of {n_candidates} complete windows "
+                f"({n_candidates - n_valid} dropped for missing days or min_windows)")
+    return valid
+
+def aggregate_spark_resolution(df, resolution):
+    """Same reductions as `aggregate_windows` in `src.data.window_engine`,
+    applied to `resolution`-minute buckets before windowing"""
+    feature_columns = [x for x in df.columns if not x in ["participant_id","timestamp","date"]]
+    dtypes = dict(df.dtypes)
+    sleep_columns = [c for c in feature_columns if get_column_aggregation(c, np.float32) == "majority"]
+    aggs = []
+    for column in feature_columns:
+        aggregation = get_column_aggregation(column, np.bool_ if dtypes[column] == "boolean" else np.float32)
+        if aggregation == "sum":
+            aggs.append(f.sum(column).cast("int" if dtypes[column] in ["tinyint","smallint","int","bigint"]
+                                           else "float").alias(column))
+        elif aggregation == "fraction":
+            aggs.append(f.avg(f.col(column).cast("float")).cast("float").alias(column))
+        elif aggregation == "mean":
+            missing = f"missing_{column}"
+            values = f.col(column)
+            if missing in feature_columns:
+                values = f.when(~f.col(missing).cast("boolean"), values)
+            aggs.append(f.coalesce(f.avg(values), f.lit(0.0)).cast("float").alias(column))
+        else:
+            aggs.append(f.sum(f.col(column).cast("int")).alias(f"n_{column}"))
+
+    bucketed = df.groupBy("participant_id", f.window("timestamp", f"{resolution} minutes").alias("bucket"))\
+                 .agg(*aggs)
+    if sleep_columns:
+        not_asleep = f.lit(resolution) - sum(f.col(f"n_{c}") for c in sleep_columns)
+        for i, column in enumerate(sleep_columns):
+            # Ties go to the earlier stage, and to not being asleep before any stage
+            count = f.col(f"n_{column}")
+            is_majority = count > not_asleep
+            for other in sleep_columns[:i]:
+                is_majority = is_majority & (count > f.col(f"n_{other}"))
+            for other in sleep_columns[i + 1:]:
+                is_majority = is_majority & (count >= f.col(f"n_{other}"))
+            bucketed = bucketed.withColumn(column, is_majority)
+        bucketed = bucketed.drop(*[f"n_{c}" for c in sleep_columns])
+    return bucketed.withColumn("timestamp", f.col("bucket.start")).drop("bucket")
+
+def get_spark_window_id(participant_id, start):
+    """Stable window id from the participant and the window's start day,
+    see `get_window_ids` in `src.data.window_engine`"""
+    participant_hash = f.shiftLeft(f.crc32(participant_id), 15)\
+                        .bitwiseOR(f.shiftRight(f.crc32(f.reverse(participant_id)), 17))
+    start_day = f.floor(start.cast("long") / SECONDS_IN_DAY)
+    return f.shiftLeft(participant_hash, ID_DAY_BITS).bitwiseOR(start_day).cast("long")
+
+def get_spark_scaling_stats(df, columns):
+    """Means and sample standard deviations of `columns` in a single
+    aggregation. The same statistics pyspark's StandardScaler fits."""
+    if not columns:
+        return {}, {}
+    aggs = []
+    for column in columns:
+        aggs += [f.mean(column).alias(f"mean({column})"), f.stddev(column).alias(f"std({column})")]
+    row = df.agg(*aggs).collect()[0]
+    means = {column: row[f"mean({column})"] for column in columns}
+    stds = {column: row[f"std({column})"] or 0.0 for column in columns}
+    return means, stds
+
+def apply_spark_scaling(df, dbl_cols, non_dbl_cols, stds):
+    """Divides each double column by its standard deviation with native
+    column expressions. Like StandardScaler, zero-variance columns become 0"""
+    scaled_cols = [(f.col(c) / stds[c] if stds[c] > 0 else f.lit(0.0)).cast(sql_types.DoubleType()).alias(c)
+                   for c in dbl_cols]
+    old_cols = [f.col(c) for c in non_dbl_cols]
+    return df.select(old_cols + scaled_cols)
 
 def rename_columns(df, columns):
     if isinstance(columns, dict):
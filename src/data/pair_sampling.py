@@ -0,0 +1,241 @@
+"""
+Samples window pairs for `PredictSameParticipant` and `PredictSequential`
+at read time.
+
+`process_petastorm.py` materializes these tasks as a second dataset with
+every field duplicated as `_l`/`_r`, built from repeated global shuffles.
+`PairSamplingDataset` instead indexes the single-window dataset written by
+`make_petastorm_dataset` by participant and by (participant, end date),
+and draws positive and negative pairs with a configurable ratio. Only the
+window metadata is read up front; feature values are read one row group at
+a time as pairs need them. Pairs are redrawn every epoch from `(seed,
+epoch, worker)` so runs are reproducible. DataLoader workers iterate copies
+of the dataset, so the epoch is set from the main process with `set_epoch`
+(see `SetEpochCallback` in `src.models.trainer`).
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from torch.utils.data import IterableDataset, get_worker_info
+
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+PAIR_TASKS = ["same_participant", "sequential"]
+
+
+def strip_file_scheme(path):
+    if path.startswith("file://"):
+        return path[len("file://"):]
+    return path
+
+
+WINDOW_COLUMNS = ["participant_id", "start", "end", "id"]
+
+
+class WindowRowGroups(object):
+    """Feature values of a windowed dataset, read lazily one row group at a
+    time. `windows` holds the participant_id, start, end and id of every
+    window, in the order `get_window` numbers them. The `cache_size` most
+    recently used row groups are kept in memory."""
+    def __init__(self, path, keys, cache_size=8):
+        self.keys = list(keys)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        dataset = ds.dataset(strip_file_scheme(path), format="parquet", partitioning="hive")
+        # Scans return rows in fragment order, which is also the order of
+        # the row groups listed below
+        table = dataset.to_table(columns=WINDOW_COLUMNS)
+        self.windows = {}
+        for column in WINDOW_COLUMNS:
+            values = table.column(column)
+            if pa.types.is_dictionary(values.type):
+                # Partition columns are read as dictionaries
+                values = values.cast(values.type.value_type)
+            self.windows[column] = values.to_numpy()
+        self.row_groups = [row_group for fragment in dataset.get_fragments()
+                           for row_group in fragment.split_by_row_group()]
+        counts = [row_group.row_groups[0].num_rows for row_group in self.row_groups]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        if self.offsets[-1] != table.num_rows:
+            raise ValueError(f"Row groups of {path} don't add up to its {table.num_rows} windows")
+        self.window_length = len(self.get_window(0)[self.keys[0]]) if table.num_rows else 0
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def read_row_group(self, index):
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        table = self.row_groups[index].to_table(columns=self.keys)
+        arrays = {}
+        for key in self.keys:
+            # Every window has the same length, so the flattened values reshape directly
+            values = table.column(key).combine_chunks().flatten().to_numpy(zero_copy_only=False)
+            arrays[key] = values.reshape(table.num_rows, -1)
+        self.cache[index] = arrays
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return arrays
+
+    def get_window(self, row):
+        """{key: values} of window `row`"""
+        index = int(np.searchsorted(self.offsets, row, side="right")) - 1
+        arrays = self.read_row_group(index)
+        return {key: arrays[key][row - self.offsets[index]] for key in self.keys}
+
+
+def stack_window(window, keys, normalize_numerical=True):
+    """Same as `stack_keys` in `src.models.tasks` for one window"""
+    results = []
+    for k in keys:
+        feature_vector = window[k]
+        if normalize_numerical and np.issubdtype(feature_vector.dtype, np.number):
+            sigma = feature_vector.std()
+            if sigma != 0:
+                feature_vector = (feature_vector - feature_vector.mean()) / sigma
+        results.append(feature_vector.astype(np.float32))
+    return np.vstack(results).T
+
+
+class PairSamplingDataset(IterableDataset):
+    """Pairs of windows from a single-window dataset.
+
+    For `same_participant`, positives pair two windows of one participant
+    and negatives pair windows of different participants. For `sequential`,
+    positives pair a window with the one starting where it ends (same
+    participant), and negatives with another window of that participant.
+    `positive_frac` of the pairs are drawn as positives; labels always come
+    from `labler`, so they match the materialized datasets. The right
+    window of a pair is never the left one, and pairs that can't be drawn
+    (a negative when there is no other candidate) are skipped.
+    """
+    def __init__(self, path, keys, labler, task="same_participant", positive_frac=0.5,
+                 n_pairs=None, seed=0, resample_each_epoch=True, normalize_numerical=True,
+                 cache_size=8):
+        if task not in PAIR_TASKS:
+            raise ValueError(f"task must be one of {PAIR_TASKS}")
+        self.keys = keys
+        self.labler = labler
+        self.task = task
+        self.positive_frac = positive_frac
+        self.seed = seed
+        self.resample_each_epoch = resample_each_epoch
+        self.normalize_numerical = normalize_numerical
+        self.epoch = 0
+
+        self.row_groups = WindowRowGroups(path, keys, cache_size=cache_size)
+        self.windows = self.row_groups.windows
+        self.window_length = self.row_groups.window_length
+        self.n_windows = len(self.row_groups)
+        self.n_pairs = n_pairs or self.n_windows
+        self.build_index()
+        logger.info(f"Sampling {self.n_pairs} {task} pairs per epoch from {self.n_windows} windows")
+
+    def build_index(self):
+        participant_ids = pd.Categorical(self.windows["participant_id"])
+        self.participant_codes = participant_ids.codes
+        order = np.argsort(self.participant_codes, kind="stable")
+        counts = np.bincount(self.participant_codes, minlength=len(participant_ids.categories))
+        self.participant_offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.participant_rows = order
+        self.participant_counts = counts[self.participant_codes]
+
+        # (participant, end date) -> row
+        starts = pd.to_datetime(self.windows["start"])
+        ends = pd.to_datetime(self.windows["end"])
+        self.end_index = pd.Series(np.arange(self.n_windows),
+                                   index=pd.MultiIndex.from_arrays([self.participant_codes, ends]))
+        self.end_index = self.end_index.groupby(level=[0, 1]).first()
+
+        # Row of the window starting where each window ends, i.e. the one
+        # ending a window length later, or -1
+        next_ends = pd.MultiIndex.from_arrays([self.participant_codes, ends + (ends - starts)])
+        self.next_row = self.end_index.reindex(next_ends).fillna(-1).astype(np.int64).values
+
+    def same_participant_rows(self, code):
+        return self.participant_rows[self.participant_offsets[code]:self.participant_offsets[code + 1]]
+
+    def sample_other(self, rng, candidates, exclude):
+        """A row of `candidates` other than those in `exclude`, or None if
+        there isn't one"""
+        allowed = candidates[~np.isin(candidates, exclude)]
+        if len(allowed) == 0:
+            return None
+        return allowed[rng.integers(len(allowed))]
+
+    def sample_right(self, rng, left, positive):
+        code = self.participant_codes[left]
+        if self.task == "same_participant":
+            if positive:
+                return self.sample_other(rng, self.same_participant_rows(code), [left])
+            if self.participant_counts[left] == self.n_windows:
+                return None
+            right = rng.integers(self.n_windows)
+            while self.participant_codes[right] == code:
+                right = rng.integers(self.n_windows)
+            return right
+
+        if positive:
+            return self.next_row[left]
+        return self.sample_other(rng, self.same_participant_rows(code), [left, self.next_row[left]])
+
+    def get_item(self, left, right):
+        start_l, start_r = pd.to_datetime(self.windows["start"][left]), pd.to_datetime(self.windows["start"][right])
+        # Windows have an exclusive right boundary
+        end_l = pd.to_datetime(self.windows["end"][left]) - pd.to_timedelta("1ms")
+        end_r = pd.to_datetime(self.windows["end"][right]) - pd.to_timedelta("1ms")
+        participant_id_l = self.windows["participant_id"][left]
+        participant_id_r = self.windows["participant_id"][right]
+        label = self.labler(participant_id_l, start_l, end_l,
+                            participant_id_r, start_r, end_r)
+        window_l, window_r = self.row_groups.get_window(left), self.row_groups.get_window(right)
+        return {"inputs_embeds_l": stack_window(window_l, self.keys, self.normalize_numerical),
+                "inputs_embeds_r": stack_window(window_r, self.keys, self.normalize_numerical),
+                "label": np.float32(label),
+                "id_l": self.windows["id"][left],
+                "id_r": self.windows["id"][right],
+                "participant_id_l": participant_id_l,
+                "participant_id_r": participant_id_r,
+                "end_date_str_l": str(end_l),
+                "end_date_str_r": str(end_r)}
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.n_pairs
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        epoch = self.epoch if self.resample_each_epoch else 0
+        rng = np.random.default_rng([self.seed, epoch, worker_id])
+
+        n_pairs = len(range(worker_id, self.n_pairs, n_workers))
+        if self.task == "sequential":
+            # Negatives come from the same participants as positives
+            anchors = np.flatnonzero(self.next_row >= 0)
+            if len(anchors) == 0:
+                raise ValueError("No window is followed by another window of the same participant")
+            positive_anchors = anchors
+        else:
+            anchors = np.arange(self.n_windows)
+            positive_anchors = np.flatnonzero(self.participant_counts > 1)
+            if len(positive_anchors) == 0 and self.positive_frac > 0:
+                raise ValueError("No participant has more than one window")
+
+        positives = rng.random(n_pairs) < self.positive_frac
+        lefts = np.where(positives,
+                         rng.choice(positive_anchors, size=n_pairs) if len(positive_anchors) else -1,
+                         rng.choice(anchors, size=n_pairs))
+        for left, positive in zip(lefts, positives):
+            right = self.sample_right(rng, left, positive)
+            if right is None:
+                continue
+            yield self.get_item(left, right)
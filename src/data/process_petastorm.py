@@ -32,6 +32,9 @@ from petastorm.unischema import dict_to_spark_row, Unischema, UnischemaField, _n
 
 import pandas as pd
 
+from src.data.spark_session import get_spark_session, timed_stage
+from src.data.utils import load_window_meta, write_window_meta
+
 MINS_IN_DAY = 60*24
 
 
@@ -101,19 +104,13 @@ def lr_schmea(schema):
 @click.argument("output_path", type=click.Path(file_okay=False,exists=False))
 @click.option("--task",type=click.Choice(["same_participant","sequential"]), default="same_participant")
 @click.option("--sequential_offset", default=7, help="Number of days to offset the following window")
-def main(input_path, output_path, task="same_participant",sequential_offset=7):
-    configuation_properties = [
-    ("spark.master","local[64]"),
-    ("spark.ui.port","4050"),
-    ("spark.executor.memory","128g"),
-    ('spark.driver.memory',  '2000g'),
-    ("spark.driver.maxResultSize", '0'), # unlimited
-    ("spark.network.timeout",            "10000001"),
-    ("spark.executor.heartbeatInterval", "10000000")]   
-    
-    conf = SparkConf().setAll(configuation_properties)
-    sc = SparkContext(conf=conf, appName="PetaStorm Conversion")
-    spark = SparkSession(sc)
+@click.option("--rowgroup_size_mb", type=int, default=128)
+@click.option("--compression", type=click.Choice(["snappy","zstd","gzip","lz4","none"]), default="snappy")
+@click.option("--spark_config", type=click.Path(exists=True), default=None,
+              help="YAML/JSON of Spark properties overriding the host-sized defaults")
+def main(input_path, output_path, task="same_participant",sequential_offset=7,
+         rowgroup_size_mb=128, compression="snappy", spark_config=None):
+    spark = get_spark_session("PetaStorm Conversion", spark_config)
                 
     if not "file://" in output_path:
         output_path = "file://"+ output_path
@@ -125,7 +122,6 @@ def main(input_path, output_path, task="same_participant",sequential_offset=7):
     
     input = spark.read.parquet(input_path)
     input_schema = get_schema_from_dataset_url(input_url)
-    rowgroup_size_mb = 128
     schema = lr_schmea(input_schema)
     with materialize_dataset(spark, output_path, schema, rowgroup_size_mb):
 
@@ -175,9 +171,16 @@ def main(input_path, output_path, task="same_participant",sequential_offset=7):
             
             output = pos.union(neg).orderBy(f.rand())
 
-        output.write \
-                .mode('overwrite') \
-                .parquet(output_path,mode="overwrite")
+        with timed_stage(spark, f"write {task} pairs"):
+            output.write \
+                    .mode('overwrite') \
+                    .option("compression", compression) \
+                    .parquet(output_path,mode="overwrite")
+
+    # Pairs keep the resolution of the windows they were built from
+    window_meta = load_window_meta(input_path)
+    if window_meta:
+        write_window_meta(output_path, **window_meta)
 
 def rename_columns(df, columns):
     if isinstance(columns, dict):
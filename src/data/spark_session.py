@@ -0,0 +1,95 @@
+"""
+Shared SparkSession setup for the Spark entry points in `src.data`.
+
+The scripts used to hardcode configs sized for a single large machine
+(`local[95]`, 2000g driver, a fixed UI port). `get_spark_session` instead
+sizes local mode from the host: one thread per core, a fraction of physical
+memory for the driver (which runs the executors in local mode) and a
+multiple of the cores as shuffle partitions. Adaptive query execution is
+on, so small shuffle partitions are coalesced and skewed joins are split.
+Any of these can be overridden with a YAML/JSON file of Spark properties:
+
+    spark.master: local[32]
+    spark.driver.memory: 200g
+
+`timed_stage` labels the Spark jobs run in a block and logs how long they
+took and how many stages they ran.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from pyspark.sql import SparkSession
+from pyspark.conf import SparkConf
+
+from src.utils import get_logger, read_yaml
+logger = get_logger(__name__)
+
+DRIVER_MEMORY_FRACTION = 0.8
+SHUFFLE_PARTITIONS_PER_CORE = 3
+
+
+def get_host_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_host_memory_gb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+
+
+def get_spark_config(overrides=None, memory_fraction=DRIVER_MEMORY_FRACTION):
+    """Spark properties for local mode on this host. `overrides` is a dict
+    or a path to a YAML/JSON file of properties that take precedence"""
+    cores = get_host_cores()
+    driver_memory_gb = max(1, int(get_host_memory_gb() * memory_fraction))
+    config = {
+        "spark.master": f"local[{cores}]",
+        "spark.driver.memory": f"{driver_memory_gb}g",
+        "spark.driver.maxResultSize": "0", # unlimited
+        "spark.sql.shuffle.partitions": str(cores * SHUFFLE_PARTITIONS_PER_CORE),
+        "spark.default.parallelism": str(cores * SHUFFLE_PARTITIONS_PER_CORE),
+        "spark.sql.adaptive.enabled": "true",
+        "spark.sql.adaptive.coalescePartitions.enabled": "true",
+        "spark.sql.adaptive.skewJoin.enabled": "true",
+        "spark.sql.adaptive.advisoryPartitionSizeInBytes": "128m",
+        "spark.network.timeout": "10000001",
+        "spark.executor.heartbeatInterval": "10000000",
+    }
+    if isinstance(overrides, str):
+        overrides = read_yaml(overrides)
+    if overrides:
+        config.update({key: str(value) for key, value in overrides.items()})
+    return config
+
+
+def get_spark_session(app_name, overrides=None, memory_fraction=DRIVER_MEMORY_FRACTION):
+    config = get_spark_config(overrides, memory_fraction)
+    logger.info(f"Starting Spark ({config['spark.master']}, {config['spark.driver.memory']} driver memory, "
+                f"{config['spark.sql.shuffle.partitions']} shuffle partitions)")
+    conf = SparkConf().setAll(list(config.items()))
+    return SparkSession.builder.appName(app_name).config(conf=conf).getOrCreate()
+
+
+@contextmanager
+def timed_stage(spark, name):
+    """Logs the wall time and the Spark jobs and stages run inside the block"""
+    sc = spark.sparkContext
+    sc.setJobGroup(name, name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        tracker = sc.statusTracker()
+        job_ids = tracker.getJobIdsForGroup(name)
+        n_stages = 0
+        for job_id in job_ids:
+            job = tracker.getJobInfo(job_id)
+            if job is not None:
+                n_stages += len(job.stageIds)
+        logger.info(f"{name}: {elapsed:.1f}s ({len(job_ids)} jobs, {n_stages} stages)")
+        sc.setLocalProperty("spark.jobGroup.id", None)
+        sc.setLocalProperty("spark.job.description", None)
@@ -0,0 +1,118 @@
+"""
+Process-wide cache for processed tables.
+
+Tasks, readers and lablers each load the same handful of processed tables
+(`lab_results_with_triggerdate`, `fitbit_day_level_activity`, ...). Going
+through `get_table_cache().get(...)` means each table is read and parsed
+once per process. Entries are keyed by the file's path, mtime and size so a
+rewritten table is picked up automatically, and evicted least recently used
+first once the cache grows past `max_bytes`.
+
+Callers get a copy of the cached frame, so modifying it in place (e.g.
+normalizing columns) never leaks into other users of the same table.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+DEFAULT_MAX_BYTES = 4 * 1024**3
+
+
+def get_file_key(name, path):
+    stat = os.stat(path)
+    return (name, os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def get_frame_bytes(df):
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+
+def get_handle(df):
+    # Under copy-on-write a shallow copy is enough to keep the cached
+    # frame untouched; otherwise fall back to a real copy
+    if pd.options.mode.copy_on_write is True:
+        return df.copy(deep=False)
+    return df.copy()
+
+
+class TableCache(object):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, name, path, loader):
+        """Returns the table at `path`, calling `loader()` to read it on a
+        miss. `path` only needs to exist so it can be stat'ed."""
+        key = get_file_key(name, path)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return get_handle(self.entries[key])
+            self.misses += 1
+
+        df = loader()
+        with self.lock:
+            self.put(key, df)
+        return get_handle(df)
+
+    def put(self, key, df):
+        if key in self.entries:
+            return
+        # A new version of the same file makes the old entries unreachable
+        for stale in [k for k in self.entries if k[:2] == key[:2]]:
+            self.remove(stale)
+
+        size = get_frame_bytes(df)
+        if size > self.max_bytes:
+            logger.warning(f"{key[0]} ({size} bytes) is larger than the table cache, not caching it")
+            return
+        self.entries[key] = df
+        self.sizes[key] = size
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        del self.entries[key]
+        self.total_bytes -= self.sizes.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes}
+
+
+_TABLE_CACHE = None
+
+def get_table_cache():
+    global _TABLE_CACHE
+    if _TABLE_CACHE is None:
+        max_bytes = int(os.environ.get("TABLE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        _TABLE_CACHE = TableCache(max_bytes=max_bytes)
+    return _TABLE_CACHE
+
+
+def get_table_cache_stats():
+    return get_table_cache().stats()
@@ -19,12 +19,12 @@ dask.config.set({"distributed.comm.timeouts.connect": "60"})
 from sklearn.preprocessing import MinMaxScaler
 
 from sklearn.model_selection import train_test_split
-from methodtools import lru_cache
 
 from src.utils import get_logger, read_yaml
 logger = get_logger(__name__)
 
 from src.data.utils import get_dask_df, load_processed_table
+from src.data.item_cache import get_item_cache
 from src.models.features import get_feature_with_name
 from tqdm import tqdm
 
@@ -56,7 +56,169 @@ def calculate_daily_features_with_dask(feature_config_path):
     return dask_df.groupby(["participant_id","date"]).apply(feature_gen, result_type='expand', 
                                                             meta=meta).compute()
 
-class DayLevelActivityReader(object):
+def get_valid_window_ends(days_with_data, day_window_size, max_missing_days_in_window,
+                          inclusive_end=False):
+    """Every window of `day_window_size` days with at least
+    `day_window_size - max_missing_days_in_window` days with data, for all
+    participants in one pass.
+
+    `days_with_data` has a `participant_id` and a `date` (day) column. A
+    participant's candidate windows start anywhere from their first day with
+    data until the window would pass their last one. Days with data are
+    counted on a per-participant day-presence bitmap with a cumulative sum,
+    so each window is O(1). Returns a (participant_id, end_date) frame
+    sorted by participant and date. Windows cover [start, start + N) and
+    end on start + N, or on start + N - 1 with `inclusive_end` (what the
+    minute-level reader uses)."""
+    days = days_with_data[["participant_id", "date"]].copy()
+    days["date"] = pd.to_datetime(days["date"]).dt.normalize()
+    days = days.drop_duplicates().sort_values(["participant_id", "date"])
+    empty = pd.DataFrame({"participant_id": pd.Series(dtype=object),
+                          "end_date": pd.Series(dtype="datetime64[ns]")})
+    if days.empty:
+        return empty
+
+    participant_codes, participants = pd.factorize(days["participant_id"], sort=True)
+    day_numbers = days["date"].values.astype("datetime64[D]").astype(np.int64)
+    n_participants = len(participants)
+    first_day = np.full(n_participants, np.iinfo(np.int64).max)
+    last_day = np.full(n_participants, np.iinfo(np.int64).min)
+    np.minimum.at(first_day, participant_codes, day_numbers)
+    np.maximum.at(last_day, participant_codes, day_numbers)
+    n_days_with_data = np.bincount(participant_codes, minlength=n_participants)
+
+    # Concatenated per-participant bitmaps of days with data
+    grid_lengths = last_day - first_day + 1
+    grid_offsets = np.concatenate([[0], np.cumsum(grid_lengths)])
+    present = np.zeros(grid_offsets[-1], dtype=np.int64)
+    present[grid_offsets[participant_codes] + day_numbers - first_day[participant_codes]] = 1
+    counts = np.concatenate([[0], np.cumsum(present)])
+
+    min_days_with_data = day_window_size - max_missing_days_in_window
+    n_starts = grid_lengths - day_window_size + (1 if inclusive_end else 0)
+    n_starts = np.where(n_days_with_data < min_days_with_data, 0, np.maximum(n_starts, 0))
+    if n_starts.sum() == 0:
+        return empty
+
+    start_codes = np.repeat(np.arange(n_participants), n_starts)
+    # Offset of each start from its participant's first day
+    start_offsets = np.arange(n_starts.sum()) - np.repeat(np.cumsum(n_starts) - n_starts, n_starts)
+    grid_starts = grid_offsets[start_codes] + start_offsets
+    in_window = counts[grid_starts + day_window_size] - counts[grid_starts]
+    valid = in_window >= min_days_with_data
+
+    end_offset = day_window_size - 1 if inclusive_end else day_window_size
+    end_days = first_day[start_codes[valid]] + start_offsets[valid] + end_offset
+    return pd.DataFrame({"participant_id": participants[start_codes[valid]],
+                         "end_date": end_days.astype("datetime64[D]").astype("datetime64[ns]")})
+
+
+class ActivityArrayStore(object):
+    """Array-backed copy of a reader's `activity_data`.
+
+    Rows are stored as one contiguous float32 (T, F) array in which every
+    participant's rows form a single block, plus a table of each
+    participant's block offset, first timestamp and whether their rows are
+    evenly spaced `step` apart. For evenly spaced participants a window is
+    located by arithmetic and returned as a view, without touching pandas.
+    Other participants fall back to a binary search over their timestamps.
+    """
+    def __init__(self, activity_data, step):
+        activity_data = activity_data.sort_index()
+        participant_ids = activity_data.index.get_level_values(0)
+        times = activity_data.index.get_level_values(1).values.astype("datetime64[ns]").astype(np.int64)
+
+        codes, participants = pd.factorize(participant_ids, sort=True)
+        self.participant_codes = {participant_id: code for code, participant_id in enumerate(participants)}
+        counts = np.bincount(codes, minlength=len(participants))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.first_time = times[self.offsets[:-1]] if len(times) else np.array([], dtype=np.int64)
+
+        self.step = int(pd.Timedelta(step).value)
+        self.times = times
+        deltas = np.diff(times)
+        # A participant is evenly spaced if none of the steps inside their block differ
+        uneven = np.zeros(len(participants), dtype=bool)
+        if len(deltas):
+            within_block = np.ones(len(deltas), dtype=bool)
+            within_block[self.offsets[1:-1] - 1] = False
+            bad_steps = within_block & (deltas != self.step)
+            np.logical_or.at(uneven, codes[1:][bad_steps], True)
+        self.evenly_spaced = ~uneven
+
+        self.values = np.ascontiguousarray(activity_data.values, dtype=np.float32)
+        self.columns = list(activity_data.columns)
+        self.participants = np.asarray(participants, dtype=object)
+        self.index_names = list(activity_data.index.names)
+
+    @classmethod
+    def from_arrays(cls, values, times, participants, offsets, evenly_spaced, columns,
+                    step, index_names):
+        """A store over existing (e.g. memory mapped) arrays"""
+        store = cls.__new__(cls)
+        store.values = values
+        store.times = times
+        store.participants = np.asarray(participants, dtype=object)
+        store.participant_codes = {participant_id: code for code, participant_id in enumerate(participants)}
+        store.offsets = np.asarray(offsets)
+        store.first_time = times[store.offsets[:-1]] if len(times) else np.array([], dtype=np.int64)
+        store.evenly_spaced = np.asarray(evenly_spaced, dtype=bool)
+        store.columns = list(columns)
+        store.step = int(step)
+        store.index_names = list(index_names)
+        return store
+
+    def to_frame(self):
+        """The (participant_id, time) indexed frame the store was built from"""
+        index = pd.MultiIndex.from_arrays([np.repeat(self.participants, np.diff(self.offsets)),
+                                           self.times.astype("datetime64[ns]")],
+                                          names=self.index_names)
+        return pd.DataFrame(self.values, index=index, columns=self.columns, copy=False)
+
+    def get_rows(self, participant_id, start, end, exact=False):
+        """[first, last) rows of `participant_id` from `start` to `end`
+        (inclusive). With `exact`, both ends have to be present, as with
+        `Index.get_loc`."""
+        code = self.participant_codes[participant_id]
+        block_start, block_end = self.offsets[code], self.offsets[code + 1]
+        start, end = pd.Timestamp(start).value, pd.Timestamp(end).value
+        if self.evenly_spaced[code]:
+            first = block_start + max(0, -(-(start - self.first_time[code]) // self.step))
+            last = block_start + max(0, (end - self.first_time[code]) // self.step + 1)
+            first, last = min(first, block_end), min(last, block_end)
+        else:
+            times = self.times[block_start:block_end]
+            first = block_start + np.searchsorted(times, start, side="left")
+            last = block_start + np.searchsorted(times, end, side="right")
+        if exact and (last <= first or self.times[first] != start or self.times[last - 1] != end):
+            raise KeyError((participant_id, start, end))
+        return first, last
+
+    def get_window(self, participant_id, start, end, exact=False):
+        """A view of the rows from `start` to `end` and their int64 timestamps"""
+        first, last = self.get_rows(participant_id, start, end, exact=exact)
+        return self.values[first:last], self.times[first:last]
+
+
+class SnapshotActivityReaderMixin(object):
+    """Readers loaded from a snapshot (see `src.data.activity_snapshot`)
+    only have an array store. The pandas frame is rebuilt from it the first
+    time something asks for `activity_data`."""
+    def has_frame(self):
+        """False for a snapshot whose frame hasn't been rebuilt yet"""
+        return "activity_data" in self.__dict__
+
+    def __getattr__(self, name):
+        if name in ["activity_data", "daily_data"] and "array_store" in self.__dict__:
+            frame = self.__dict__["array_store"].to_frame()
+            self.activity_data = frame
+            if isinstance(self, DayLevelActivityReader):
+                self.daily_data = frame
+            return frame
+        raise AttributeError(name)
+
+
+class DayLevelActivityReader(SnapshotActivityReaderMixin):
     def __init__(self, min_date=None,
                        split_date=None,
                        max_date=None,
@@ -78,7 +240,15 @@ class DayLevelActivityReader(object):
         self.max_missing_days_in_window = max_missing_days_in_window
         self.obs_per_day = 1
 
-        df = load_processed_table("fitbit_day_level_activity", path=data_location)
+        # Only takes effect for the parquet version of the table, which is
+        # partitioned by date so whole days can be skipped
+        parquet_filters = []
+        if min_date:
+            parquet_filters.append(("date", ">=", pd.to_datetime(min_date)))
+        if max_date:
+            parquet_filters.append(("date", "<", pd.to_datetime(max_date)))
+        df = load_processed_table("fitbit_day_level_activity", path=data_location,
+                                  filters=parquet_filters or None)
 
         date_filters = []
         filters = []
@@ -100,11 +270,10 @@ class DayLevelActivityReader(object):
         if not participant_ids is None:
             df = df[df["participant_id"].isin(participant_ids)]
         
-        # Need to add metadata to get to run only once
-        valid_participant_dates = df.groupby("participant_id").apply(self.get_valid_dates)
+        self.valid_dates = self.get_valid_dates(df)
         self.daily_data = df.set_index(["participant_id","date"]).dropna()
 
-        self.participant_dates = list(valid_participant_dates.dropna().apply(pd.Series).stack().droplevel(-1).items())
+        self.participant_dates = list(zip(self.valid_dates["participant_id"], self.valid_dates["end_date"]))
         
         if add_features_path:
             features = pd.read_csv(add_features_path)
@@ -119,26 +288,17 @@ class DayLevelActivityReader(object):
         self.activity_data = self.daily_data.sort_index()
 
 
-    def get_valid_dates(self, partition):
-        dates_with_data = pd.DatetimeIndex(partition[~partition["missing_hr"].astype(bool)]["date"].dt.date.unique())
-        min_days_with_data = self.day_window_size - self.max_missing_days_in_window
-    
-        if len(dates_with_data) < min_days_with_data:
-            return 
-        min_date = dates_with_data.min()
-        max_date = dates_with_data.max()
-
-        all_possible_start_dates = pd.date_range(min_date,max_date-pd.Timedelta(days=self.day_window_size))
-        all_possible_end_dates = all_possible_start_dates + pd.Timedelta(days=self.day_window_size)
-
-        min_days_with_data = self.day_window_size - self.max_missing_days_in_window
+    def get_valid_dates(self, df):
+        """(participant_id, end_date) of the windows with enough days with data"""
+        days_with_data = df.loc[~df["missing_hr"].astype(bool), ["participant_id", "date"]]
+        return get_valid_window_ends(days_with_data, self.day_window_size,
+                                     self.max_missing_days_in_window)
 
-        mask = []
-        for a,b in zip(all_possible_start_dates, all_possible_end_dates):
-            has_enough_data = len(dates_with_data[(dates_with_data >= a) & (dates_with_data < b) ] )>= min_days_with_data
-            mask.append(has_enough_data)
-
-        return all_possible_end_dates[mask].rename("dates")
+    def to_array_store(self):
+        """Built once and shared by every dataset made from this reader"""
+        if getattr(self, "array_store", None) is None:
+            self.array_store = ActivityArrayStore(self.activity_data, step="1D")
+        return self.array_store
 
     def get_all_participant_dates_for_participants_ids(self,participant_ids):
         good_keys = self.daily_data.dropna().index.get_level_values(0).intersection(participant_ids)
@@ -172,7 +332,7 @@ class DayLevelActivityReader(object):
                 raise ValueError("If splitting, must either provide a date or fraction")
             return train, eval
 
-class MinuteLevelActivityReader(object):
+class MinuteLevelActivityReader(SnapshotActivityReaderMixin):
     def __init__(self, min_date=None,
                        split_date=None,
                        max_date=None,
@@ -199,8 +359,13 @@ class MinuteLevelActivityReader(object):
         
         #pylint:disable=unused-variable 
         with Client(n_workers=min(n_cores,16)) as client:
+            # Date and participant filters are pushed down into the parquet
+            # read, the masks below handle rows in partially matching row groups
             dask_df = get_dask_df("processed_fitbit_minute_level_activity",
-                                    path = data_location)
+                                    path = data_location,
+                                    min_date = min_date,
+                                    max_date = max_date,
+                                    participant_ids = participant_ids)
     
             if not participant_ids is None:
                 dask_df = dask_df[dask_df["participant_id"].isin(participant_ids)] 
@@ -227,7 +392,10 @@ class MinuteLevelActivityReader(object):
             self.min_windows = min_windows
             
 
-            valid_participant_dates = dask_df.groupby("participant_id").apply(self.get_valid_dates, meta=("dates",object))
+            # Only the distinct days with data are brought back for finding windows
+            days_with_data = dask_df[~dask_df["missing_heartrate"]][["participant_id","timestamp"]]
+            days_with_data = days_with_data.assign(date=days_with_data["timestamp"].dt.floor("D"))\
+                                           [["participant_id","date"]].drop_duplicates()
             
             self.activity_data = dask_df
         
@@ -238,10 +406,11 @@ class MinuteLevelActivityReader(object):
                 numeric = self.activity_data.select_dtypes(include=['float64'])
                 self.activity_data[list(numeric.columns.values)] = scale_model.fit_transform(numeric)
 
-            valid_participant_dates, self.activity_data = dask.compute(valid_participant_dates,self.activity_data)
+            days_with_data, self.activity_data = dask.compute(days_with_data,self.activity_data)
+            self.valid_dates = self.get_valid_dates(days_with_data)
             logger.info("Setting index...")
             self.activity_data = self.activity_data.set_index(["participant_id","timestamp"]).drop(columns=["date"])
-            self.participant_dates = list(valid_participant_dates.dropna().apply(pd.Series).stack().droplevel(-1).items())
+            self.participant_dates = list(zip(self.valid_dates["participant_id"], self.valid_dates["end_date"]))
         
        
             
@@ -250,26 +419,17 @@ class MinuteLevelActivityReader(object):
             logger.info("Sorting Index...")
             self.activity_data = self.activity_data.sort_index()
             
-    def get_valid_dates(self, partition):
-        dates_with_data = pd.DatetimeIndex(partition[~partition["missing_heartrate"]]["timestamp"].dt.date.unique())
-        min_days_with_data = self.day_window_size - self.max_missing_days_in_window
-    
-        if len(dates_with_data) < min_days_with_data:
-            return 
-        min_date = dates_with_data.min()
-        max_date = dates_with_data.max()
-
-        all_possible_start_dates = pd.date_range(min_date,max_date-pd.Timedelta(days=self.day_window_size-1))
-        all_possible_end_dates = all_possible_start_dates + pd.Timedelta(days=self.day_window_size-1)
-
-        min_days_with_data = self.day_window_size - self.max_missing_days_in_window
-
-        mask = []
-        for a,b in zip(all_possible_start_dates, all_possible_end_dates):
-            has_enough_data = len(dates_with_data[(dates_with_data >= a) & (dates_with_data <= b) ] )>= min_days_with_data
-            mask.append(has_enough_data)
-
-        return all_possible_end_dates[mask].rename("dates")
+    def get_valid_dates(self, days_with_data):
+        """(participant_id, end_date) of the windows with enough days with
+        data. Windows here end on their last day rather than the day after."""
+        return get_valid_window_ends(days_with_data, self.day_window_size,
+                                     self.max_missing_days_in_window, inclusive_end=True)
+
+    def to_array_store(self):
+        """Built once and shared by every dataset made from this reader"""
+        if getattr(self, "array_store", None) is None:
+            self.array_store = ActivityArrayStore(self.activity_data, step="1min")
+        return self.array_store
 
     def split_participant_dates(self,date=None,eval_frac=None, by_participant=False,
                             limit_train_frac=False):
@@ -329,13 +489,24 @@ class ActivtyDataset(Dataset):
                        add_cls=False,
                        shuffle=False,
                        cache=True,
+                       cache_max_bytes=None,
+                       cache_policy="lru",
+                       manager_cache=False,
+                       storage=None,
                        **_):
         
         self.activity_reader = activity_reader
-        self.activity_data = self.activity_reader.activity_data
-        self.activity_data = self.activity_data.sort_index()
         self.day_window_size = self.activity_reader.day_window_size 
 
+        # "array" serves windows from an `ActivityArrayStore` without pandas.
+        # By default readers loaded from a snapshot keep using their mapped
+        # store, rather than rebuilding the frame from it
+        if storage is None:
+            storage = "frame" if activity_reader.has_frame() else "array"
+        if storage not in ["frame", "array"]:
+            raise ValueError("storage must be either 'frame' or 'array'")
+        self.array_store = activity_reader.to_array_store() if storage == "array" else None
+
         self.lab_results_reader = lab_results_reader
         
         self.participant_dates = participant_dates
@@ -348,7 +519,7 @@ class ActivtyDataset(Dataset):
         self.return_dict = return_dict
         self.return_global_attention_mask = return_global_attention_mask
         
-        n_features = self.activity_reader.activity_data.shape[-1] + 2*bool(time_encoding)
+        n_features = len(self.get_columns()) + 2*bool(time_encoding)
         
         obs_per_day = self.activity_reader.obs_per_day
         n_timesteps = (obs_per_day*self.day_window_size + int(add_cls))
@@ -359,9 +530,15 @@ class ActivtyDataset(Dataset):
         if self.add_cls:
             self.cls_init = np.random.randn(1,self.size[-1]).astype(np.float32)   
 
+        # Bounded by `cache_max_bytes` (ITEM_CACHE_MAX_BYTES by default). A
+        # manager cache is used by every DataLoader worker instead of one each
         self.cache = cache
         if self.cache:
-            self.get_item_cache = {}
+            self.item_cache = get_item_cache(max_bytes=cache_max_bytes, policy=cache_policy,
+                                             manager=manager_cache)
+
+    def get_cache_stats(self):
+        return self.item_cache.stats() if self.cache else None
 
     def get_user_data_in_date_range(self,participant_id, start, end):
         eod = end + pd.to_timedelta("1D") - pd.to_timedelta("1min")
@@ -378,6 +555,31 @@ class ActivtyDataset(Dataset):
             end_ix = self.activity_data.index.get_loc((participant_id,end)) + 1
             return self.activity_data.iloc[start_ix:end_ix]
 
+    @property
+    def activity_data(self):
+        # Readers keep their frame sorted, and readers loaded from a snapshot
+        # only build it if something other than the array store needs it
+        return self.activity_reader.activity_data
+
+    def get_columns(self):
+        if self.array_store is not None:
+            return self.array_store.columns
+        return list(self.activity_data.columns.values)
+
+    def get_window_values(self, participant_id, start, end):
+        """Values from the start of `start` to the end of `end` (both dates),
+        and their timestamps. With storage="array" the values are copied out
+        of the store, which may be a memory mapped snapshot shared by every
+        dataset of the reader."""
+        if self.array_store is None:
+            activity_data = self.get_user_data_in_date_range(participant_id,start,end)
+            return activity_data.values, activity_data.index.get_level_values(-1)
+
+        eod = end + pd.to_timedelta("1D") - pd.to_timedelta("1min")
+        exact = not isinstance(self.activity_reader,DayLevelActivityReader)
+        values, times = self.array_store.get_window(participant_id, start, eod, exact=exact)
+        return values.copy(), pd.DatetimeIndex(times.astype("datetime64[ns]"))
+
     def get_label(self,participant_id,start_date,end_date):
         raise NotImplementedError
         try:
@@ -399,14 +601,13 @@ class ActivtyDataset(Dataset):
     def __getitem__(self,index):
         # Could cache this later
         if self.cache:
-            try:
-                return self.get_item_cache[index]
-            except KeyError:
-                pass
+            cached = self.item_cache.get(index)
+            if cached is not None:
+                return cached
 
         participant_id, end_date = self.participant_dates[index]
         start_date = end_date - pd.Timedelta(self.day_window_size -1, unit = "days")
-        activity_data = self.get_user_data_in_date_range(participant_id,start_date,end_date)
+        embeds, timestamps = self.get_window_values(participant_id,start_date,end_date)
         
         result = self.get_label(participant_id,start_date,end_date)
         if result:
@@ -415,18 +616,14 @@ class ActivtyDataset(Dataset):
             label = 0
         
         if self.time_encoding == "sincos":
-            activity_data["sin_time"]  = sin_time(activity_data.index)
-            activity_data["cos_time"]  = cos_time(activity_data.index)
+            embeds = np.column_stack([embeds, sin_time(timestamps), cos_time(timestamps)])
         
-        # activity_data = activity_data.T
-
         if self.add_absolute_embedding:
-            activity_data = activity_data + sinu_position_encoding(*self.size)
+            embeds = embeds + sinu_position_encoding(*self.size)
         
         if self.return_dict:
             
             item = {}
-            embeds = activity_data.values
             
             if self.add_cls:
                 embeds = np.concatenate([self.cls_init,embeds],axis=0)
@@ -443,10 +640,10 @@ class ActivtyDataset(Dataset):
             
             result = item
         else:
-            result = activity_data.values, label
+            result = embeds, label
 
         if self.cache:
-            self.get_item_cache[index] = result
+            self.item_cache.put(index, result)
         
         return result
     
@@ -465,7 +662,7 @@ class ActivtyDataset(Dataset):
             if flatten:
                 el_x = el_x.flatten()
             
-            if len(el_x) == self.day_window_size * self.activity_reader.activity_data.shape[-1]:
+            if len(el_x) == self.day_window_size * len(self.get_columns()):
                 X.append(el_x)
                 y.append(el_y)
                 user_dates.append(user_date)
@@ -488,7 +685,7 @@ class ActivtyDataset(Dataset):
         return mtx
 
     def get_feature_names(self):
-        names =list(self.activity_data.columns.values)
+        names = list(self.get_columns())
         if self.time_encoding == "sincos":
             names = names + ["sin_time","cos_time"]
         return names
@@ -539,23 +736,30 @@ class AutoencodeDataset(ActivtyDataset):
     def get_label(self,participant_id,start_date,end_date):
         return None
 
-    @lru_cache(maxsize=None)
     def __getitem__(self,index):
-        # Could cache this later
+        if self.cache:
+            cached = self.item_cache.get(index)
+            if cached is not None:
+                return cached
+        item = self.get_autoencode_item(index)
+        if self.cache:
+            self.item_cache.put(index, item)
+        return item
+
+    def get_autoencode_item(self,index):
         participant_id, end_date = self.participant_dates[index]
         start_date = end_date - pd.Timedelta(self.day_window_size, unit = "days")
-        activity_data = self.get_user_data_in_date_range(participant_id,start_date,end_date)
+        embeds, timestamps = self.get_window_values(participant_id,start_date,end_date)
         
 
         if self.time_encoding == "sincos":
-            activity_data["sin_time"]  = sin_time(activity_data.index)
-            activity_data["cos_time"]  = cos_time(activity_data.index)
+            embeds = np.column_stack([embeds, sin_time(timestamps), cos_time(timestamps)])
 
         if self.return_dict:
-            return {"inputs_embeds":activity_data.values.astype(np.float32),
-                    "labels":activity_data.values.astype(np.float32)}
+            return {"inputs_embeds":embeds.astype(np.float32),
+                    "labels":embeds.astype(np.float32)}
         
-        return activity_data.values.astype(np.float32)
+        return embeds.astype(np.float32)
 
     def to_stacked_numpy(self):
         if len(self)==0:
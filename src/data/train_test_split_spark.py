@@ -22,17 +22,7 @@ from pyspark import SparkContext
 # from src.models.commands import validate_yaml_or_json
 # from src.data.utils import get_dask_df, write_pandas_to_parquet, load_processed_table, read_parquet_to_pandas
 
-# TODO Maybe want to support loading this from a file
-# although this hardcoded config works pretty well for
-# bdata's darkwing machine
-SPARK_CONFIG = [ 
-    ("spark.master","local[95]"),
-    ("spark.ui.port","4050"),
-    ("spark.executor.memory","750g"),
-    ('spark.driver.memory',  '2000g'),
-    ("spark.driver.maxResultSize", '0'), # unlimited
-    ("spark.network.timeout",            "10000001"),
-    ("spark.executor.heartbeatInterval", "10000000")]   
+from src.data.spark_session import get_spark_session, timed_stage
 
 @click.command()
 @click.argument("in_path", type=click.Path())
@@ -42,16 +32,16 @@ SPARK_CONFIG = [
 @click.option("--eval_frac",default=None)
 @click.option("--test_frac", default=0.5, help="Fraction of eval set that's reserved for testing")
 @click.option("--activity_level", type=click.Choice(["day","minute"]), default="minute")
+@click.option("--spark_config", type=click.Path(exists=True), default=None,
+              help="YAML/JSON of Spark properties overriding the host-sized defaults")
 def main(in_path, out_path, split_date=None, end_date=None,
         test_frac = 0.5, eval_frac = None, activity_level="minute",
-        timestamp_col = "timestamp"):
+        timestamp_col = "timestamp", spark_config=None):
     
         if not activity_level == "minute":
             raise NotImplementedError("This script only supports minute-level data")
         
-        conf = SparkConf().setAll(SPARK_CONFIG)
-        sc = SparkContext(conf=conf, appName="PetaStorm Conversion")
-        spark = SparkSession(sc)
+        spark = get_spark_session("Train Test Split", spark_config)
 
         df = spark.read.parquet(in_path)
         if end_date:
@@ -80,9 +70,10 @@ def main(in_path, out_path, split_date=None, end_date=None,
 
         for df,prefix in zip(dfs_to_write,prefixes):
             path = os.path.join(out_path,prefix)
-            df.write \
-                .mode('overwrite') \
-                .parquet(path, partitionBy="date")
+            with timed_stage(spark, f"write {prefix}"):
+                df.write \
+                    .mode('overwrite') \
+                    .parquet(path, partitionBy="date")
             df.unpersist(blocking = True)
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""
+Splits a date-partitioned minute-level dataset into train, eval and test
+one parquet file at a time, so memory doesn't grow with the cohort.
+
+Participants are assigned by a stable hash of their id (and `--seed`)
+rather than a shuffle, so every file can be routed independently and reruns
+give the same split. The split semantics match `train_test_split_spark.py`:
+
+  - With `--split_date`, every row before the split date goes to train.
+    Rows from the split date on go to test for a `test_frac` share of
+    participants and to eval for the rest.
+  - With `--eval_frac`, a `test_frac * eval_frac` share of participants goes
+    to test, the next `(1 - test_frac) * eval_frac` to eval, and everyone
+    else to train.
+
+Outputs are written as `<out_path>/{train,eval,test}/date=YYYY-MM-DD/`, and
+replace the splits of any earlier run, like Spark's overwrite mode.
+
+    python src/data/train_test_split_streaming.py data/processed/processed_fitbit_minute_level_activity \\
+        data/processed/split --split_date 2020-02-01 --workers 8
+"""
+import os
+import shutil
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+SPLITS = ["train", "eval", "test"]
+BATCH_SIZE = 1_000_000
+
+
+def get_participant_fraction(participant_id, seed=0):
+    """Stable value in [0, 1) for a participant"""
+    return zlib.crc32(f"{seed}:{participant_id}".encode("utf-8")) / 2**32
+
+
+def get_participant_splits(participant_ids, split_date_mode, test_frac, eval_frac=None, seed=0):
+    """Index into SPLITS for each participant that doesn't depend on the
+    split date, i.e. for rows on or after it"""
+    fractions = np.array([get_participant_fraction(p, seed) for p in participant_ids])
+    if split_date_mode:
+        return np.where(fractions < test_frac, 2, 1)
+    return np.where(fractions < test_frac * eval_frac, 2,
+                    np.where(fractions < eval_frac, 1, 0))
+
+
+def get_batch_dates(batch):
+    if "date" in batch.schema.names:
+        dates = batch.column("date")
+        if pa.types.is_string(dates.type) or pa.types.is_dictionary(dates.type):
+            return pc.cast(dates, pa.string())
+    else:
+        dates = batch.column("timestamp")
+    return pc.strftime(dates, format="%Y-%m-%d")
+
+
+def split_file(file_index, file_path, in_path, out_path, split_date=None, end_date=None,
+               test_frac=0.5, eval_frac=None, seed=0, batch_size=BATCH_SIZE):
+    """Routes the rows of one input file to the split outputs, one record
+    batch at a time. Returns the number of rows written to each split."""
+    dataset = ds.dataset([file_path], format="parquet", partitioning="hive",
+                         partition_base_dir=in_path)
+    writers, counts = {}, dict.fromkeys(SPLITS, 0)
+    participant_splits = {}
+    try:
+        for batch in dataset.to_batches(batch_size=batch_size):
+            if batch.num_rows == 0:
+                continue
+            dates = get_batch_dates(batch)
+            participant_ids = pd.Categorical(batch.column("participant_id").to_numpy(zero_copy_only=False))
+            new = [p for p in participant_ids.categories if p not in participant_splits]
+            if new:
+                participant_splits.update(zip(new, get_participant_splits(new, split_date is not None,
+                                                                          test_frac, eval_frac, seed)))
+            code_splits = np.array([participant_splits[p] for p in participant_ids.categories])
+            splits = code_splits[participant_ids.codes]
+
+            keep = np.ones(batch.num_rows, dtype=bool)
+            if end_date:
+                keep &= pc.less(dates, end_date).to_numpy(zero_copy_only=False)
+            if split_date:
+                before_split = pc.less(dates, split_date).to_numpy(zero_copy_only=False)
+                splits = np.where(before_split, 0, splits)
+
+            table = pa.Table.from_batches([batch]).drop_columns(
+                [c for c in ["date"] if c in batch.schema.names])
+            dates = dates.to_numpy(zero_copy_only=False)
+            for date in np.unique(dates[keep]):
+                for split_index, split in enumerate(SPLITS):
+                    mask = keep & (dates == date) & (splits == split_index)
+                    if not mask.any():
+                        continue
+                    key = (split, date)
+                    if key not in writers:
+                        path = os.path.join(out_path, split, f"date={date}")
+                        os.makedirs(path, exist_ok=True)
+                        writers[key] = pq.ParquetWriter(os.path.join(path, f"part-{file_index:05d}.parquet"),
+                                                        table.schema)
+                    writers[key].write_table(table.filter(pa.array(mask)))
+                    counts[split] += int(mask.sum())
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return counts
+
+
+def clear_splits(out_path):
+    """Removes the split directories of an earlier run, whose parts would
+    otherwise be read alongside the new ones"""
+    for split in SPLITS:
+        shutil.rmtree(os.path.join(out_path, split), ignore_errors=True)
+
+
+def split_dataset(in_path, out_path, split_date=None, end_date=None, test_frac=0.5,
+                  eval_frac=None, seed=0, workers=4, batch_size=BATCH_SIZE):
+    if split_date is None and eval_frac is None:
+        raise ValueError("One of split_date or eval_frac is required")
+    split_date = pd.to_datetime(split_date).strftime("%Y-%m-%d") if split_date else None
+    end_date = pd.to_datetime(end_date).strftime("%Y-%m-%d") if end_date else None
+
+    dataset = ds.dataset(in_path, format="parquet", partitioning="hive")
+    files = dataset.files
+    if end_date and "date" in dataset.schema.names:
+        # Skip whole date partitions past the end date
+        files = [fragment.path for fragment in
+                 dataset.get_fragments(filter=pc.field("date").cast(pa.string()) < end_date)]
+    logger.info(f"Splitting {len(files)} files from {in_path} into {out_path}...")
+    clear_splits(out_path)
+
+    counts = dict.fromkeys(SPLITS, 0)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(split_file, i, path, in_path, out_path, split_date, end_date,
+                                   test_frac, eval_frac, seed, batch_size)
+                   for i, path in enumerate(files)]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            for split, count in future.result().items():
+                counts[split] += count
+    logger.info(f"Rows per split: {counts}")
+    return counts
+
+
+@click.command()
+@click.argument("in_path", type=click.Path(exists=True))
+@click.argument("out_path", type=click.Path(file_okay=False))
+@click.option("--split_date",default=None)
+@click.option("--end_date",default=None)
+@click.option("--eval_frac",default=None, type=float)
+@click.option("--test_frac", default=0.5, help="Fraction of eval set that's reserved for testing")
+@click.option("--seed", default=0, help="Changes which participants land in each split")
+@click.option("--workers", default=4)
+@click.option("--batch_size", default=BATCH_SIZE, help="Rows read at a time by each worker")
+def main(in_path, out_path, split_date=None, end_date=None, eval_frac=None,
+         test_frac=0.5, seed=0, workers=4, batch_size=BATCH_SIZE):
+    split_dataset(in_path, out_path, split_date=split_date, end_date=end_date,
+                  test_frac=test_frac, eval_frac=eval_frac, seed=seed,
+                  workers=workers, batch_size=batch_size)
+
+if __name__ == "__main__":
+    main()
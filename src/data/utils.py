@@ -1,7 +1,9 @@
 import os
 import glob 
 import json
+import re
 import pickle
+import shutil
 from re import M
 from fsspec.registry import filesystem
 
@@ -13,11 +15,14 @@ import pandas as pd
 from pandas.api.types import CategoricalDtype
 from scipy.special import softmax
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 from torch.utils import data
 import numpy as np
 
 from src.utils import get_logger
 import src.data.constants as constants
+from src.data.table_cache import get_table_cache
 
 import wandb
 import dask
@@ -97,28 +102,222 @@ def get_cached_datareader_path(name):
         data_path = PROCESSED_DATA_PATH
     print(data_path)
     return os.path.join(data_path,"cached_datareaders",name+".pickle")
+
+def get_activity_snapshot_path(name):
+    # Snapshots sit next to the pickles, as a directory without the extension
+    return os.path.splitext(get_cached_datareader_path(name))[0]
         
-def find_processed_dataset(name,path=None):
+TYPED_TABLE_FORMATS = ["feather", "parquet"]
+
+def get_typed_processed_dataset_path(name, fmt="feather"):
+    csv_path = get_processed_dataset_path(name)
+    return os.path.splitext(csv_path)[0] + "." + fmt
+
+def find_typed_processed_dataset_path(name):
+    # If a table has been written in more than one format, use the newest
+    paths = [get_typed_processed_dataset_path(name, fmt=fmt) for fmt in TYPED_TABLE_FORMATS]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return None
+    return max(paths, key=os.path.getmtime)
+
+def is_typed_table_path(path):
+    return any(path.endswith("." + fmt) for fmt in TYPED_TABLE_FORMATS)
+
+def resolve_processed_table_path(name, path=None):
+    """Prefers the typed (feather/parquet) version of a processed table, and
+    falls back to the CSV written by older versions of the pipeline"""
+    if path is None:
+        path = find_typed_processed_dataset_path(name)
     if path is None:
         path = get_processed_dataset_path(name)
-    if ".csv" in path:
+    return path
+
+def find_processed_dataset(name,path=None,filters=None):
+    path = resolve_processed_table_path(name, path=path)
+    if path.endswith(".feather"):
+        return feather.read_table(path, memory_map=True).to_pandas()
+    elif ".parquet" in path and os.path.isdir(path):
+        return read_partitioned_parquet(path, filters=filters)
+    elif ".parquet" in path:
+        return pq.read_table(path, memory_map=True, filters=filters).to_pandas()
+    elif ".csv" in path:
         return pd.read_csv(path)
     elif ".jsonl" in path:
         return pd.read_json(path,lines=True)
 
-def load_processed_table(name,fmt="df",path=None):
-    dataset = find_processed_dataset(name,path=path)
-    for column in dataset.columns:
-        if "date" in str(column) or "time" in str(column):
-            try:
-                dataset[column] = pd.to_datetime(dataset[column])
-            except (ValueError, TypeError, pd.errors.OutOfBoundsDatetime):
-                continue
+def read_processed_table(name,path,filters=None):
+    dataset = find_processed_dataset(name,path=path,filters=filters)
+    if not is_typed_table_path(path):
+        # Typed tables already carry their datetime columns in the schema
+        for column in dataset.columns:
+            if "date" in str(column) or "time" in str(column):
+                try:
+                    dataset[column] = pd.to_datetime(dataset[column])
+                except (ValueError, TypeError, pd.errors.OutOfBoundsDatetime):
+                    continue
     logger.info(f"Reading {name}...")
-    if fmt=="df":
-        return dataset
-    else:
+    return dataset
+
+def load_processed_table(name,fmt="df",path=None,filters=None,use_cache=True):
+    if fmt!="df":
         raise ValueError("Unsupported fmt") 
+    path = resolve_processed_table_path(name, path=path)
+    if not use_cache:
+        return read_processed_table(name,path,filters=filters)
+    cache_name = name if filters is None else f"{name}:{filters}"
+    return get_table_cache().get(cache_name, path,
+                                 lambda: read_processed_table(name,path,filters=filters))
+
+def parse_datetime_columns(df):
+    """Same columns that `load_processed_table` parses for CSVs, done once
+    when the table is written so the typed file stores them as timestamps"""
+    for column in df.columns:
+        if not ("date" in str(column) or "time" in str(column)):
+            continue
+        # Object columns, or "str" ones on newer pandas
+        if not pd.api.types.is_string_dtype(df[column].dtype):
+            continue
+        try:
+            df[column] = pd.to_datetime(df[column])
+        except (ValueError, TypeError, pd.errors.OutOfBoundsDatetime):
+            continue
+    return df
+
+def to_arrow_table(df):
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # Survey answers can mix strings and numbers within a column
+        df = df.copy()
+        for column in df.select_dtypes(include="object").columns:
+            df[column] = df[column].map(lambda x: x if x is None or pd.isna(x) else str(x))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+def write_partitioned_parquet(table, path, partition_cols):
+    """Writes `table` as a hive-partitioned parquet dataset, replacing
+    whatever was at `path`. Timestamp partition columns that only hold
+    whole days are partitioned by date, and the `_common_metadata` schema
+    restores them as timestamps when the dataset is read."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    partitioned = table
+    for column in partition_cols:
+        values = table.column(column)
+        if not pa.types.is_timestamp(values.type):
+            continue
+        days = values.cast(pa.date32())
+        if pc.all(pc.equal(days.cast(values.type), values)).as_py() is not False:
+            partitioned = partitioned.set_column(partitioned.schema.get_field_index(column),
+                                                 column, days)
+    pq.write_to_dataset(partitioned, path, partition_cols=partition_cols)
+    pq.write_metadata(table.schema, os.path.join(path, "_common_metadata"))
+
+def read_partitioned_parquet(path, filters=None):
+    common_metadata = os.path.join(path, "_common_metadata")
+    schema = pq.read_schema(common_metadata) if os.path.exists(common_metadata) else None
+    return pq.read_table(path, schema=schema, filters=filters).to_pandas()
+
+def write_processed_table(df, name, fmt="feather", path=None, write_csv=True, row_group_size=None,
+                          partition_cols=None):
+    """Writes a processed table with its Arrow schema, so that loading it
+    doesn't need any parsing or dtype inference. The CSV is still written
+    for anything that reads it directly. Parquet tables with
+    `partition_cols` are written as a directory of partitions."""
+    if path is None:
+        path = get_typed_processed_dataset_path(name, fmt=fmt)
+    table = to_arrow_table(parse_datetime_columns(df.copy()))
+    if fmt == "feather":
+        # Uncompressed so that the file can be memory mapped
+        feather.write_feather(table, path, compression="uncompressed")
+    elif fmt == "parquet" and partition_cols:
+        write_partitioned_parquet(table, path, partition_cols)
+    elif fmt == "parquet":
+        pq.write_table(table, path, row_group_size=row_group_size)
+    else:
+        raise ValueError("fmt must be one of 'feather' or 'parquet'")
+
+    if write_csv:
+        df.to_csv(get_processed_dataset_path(name),index=False)
+
+def encode_survey_categoricals(df, columns):
+    """Stores each of `columns` as a categorical of its answers' string
+    representations, which is what `pd.get_dummies` uses to name dummies"""
+    df = df.copy()
+    for column in columns:
+        df[column] = df[column].map(lambda x: x if pd.isna(x) else str(x)).astype("category")
+    return df
+
+def get_clause_identifiers(clause):
+    # Plain names and `backticked names` in a DataFrame.query expression
+    plain = re.sub(r"`[^`]+`", " ", clause)
+    return set(re.findall(r"`([^`]+)`", clause)) | set(re.findall(r"[A-Za-z_]\w*", plain))
+
+def expand_clause_dummies(df, clause):
+    """Returns the subset of a categorical survey table needed to evaluate
+    `clause`, with the one-hot columns it references built from their
+    categorical source columns. Columns already in `df` are used as is.
+    Raises a ValueError for one-hot columns of answers that aren't in the
+    data, which `pd.get_dummies` wouldn't have created either."""
+    categorical = [c for c in df.columns if isinstance(df[c].dtype, CategoricalDtype)]
+    # Longest prefix first, so "a_b_1" maps to column "a_b" rather than "a"
+    categorical = sorted(categorical, key=len, reverse=True)
+
+    needed = {}
+    for name in get_clause_identifiers(clause):
+        if name in df.columns:
+            needed[name] = df[name]
+            continue
+        columns = [c for c in categorical if name.startswith(c + "_")]
+        for column in columns:
+            value = name[len(column) + 1:]
+            if value in df[column].cat.categories:
+                needed[name] = (df[column] == value).fillna(False).astype("uint8")
+                break
+        else:
+            if columns:
+                raise ValueError(f"{name} in {clause!r} isn't an answer in the data, "
+                                 f"{columns[0]} has {list(df[columns[0]].cat.categories)}")
+    return pd.DataFrame(needed, index=df.index)
+
+NORMALIZATION_STATS_NAME = "_normalization_stats.json"
+
+def get_normalization_stats_path(path):
+    """`path` can be the stats file itself or the dataset it sits next to"""
+    path = path.replace("file://","")
+    if path.endswith(".json"):
+        return path
+    return os.path.join(path, NORMALIZATION_STATS_NAME)
+
+def write_normalization_stats(path, means, stds):
+    stats = {column: {"mean": means.get(column), "std": stds[column]} for column in stds}
+    with open(get_normalization_stats_path(path), "w") as stats_file:
+        json.dump(stats, stats_file, indent=2)
+
+def load_normalization_stats(path):
+    with open(get_normalization_stats_path(path)) as stats_file:
+        stats = json.load(stats_file)
+    means = {column: values["mean"] for column, values in stats.items()}
+    stds = {column: values["std"] for column, values in stats.items()}
+    return means, stds
+
+WINDOW_META_NAME = "_window_meta.json"
+
+def write_window_meta(path, day_window_size, resolution=1):
+    """Records how a windowed dataset was built, e.g. minutes per time step"""
+    with open(os.path.join(path.replace("file://",""), WINDOW_META_NAME), "w") as meta_file:
+        json.dump({"day_window_size": day_window_size, "resolution": resolution}, meta_file, indent=2)
+
+def load_window_meta(path):
+    """Returns None for datasets written before the metadata was added"""
+    meta_path = os.path.join(path.replace("file://",""), WINDOW_META_NAME)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as meta_file:
+        return json.load(meta_file)
 
 def write_pandas_to_parquet(df,path,write_metadata=True,
                             partition_cols=[],overwrite=False,
@@ -154,17 +353,58 @@ def download_wandb_table(run_id,table_name="roc_table",
     return pd.DataFrame(data["data"],columns=data["columns"])
 
 
-def get_dask_df(name=None,path= None,min_date=None,max_date=None,index=None):
+def get_dask_df(name=None,path= None,min_date=None,max_date=None,index=None,
+                decode=True,participant_ids=None,columns=None):
+    """Lazily reads a processed parquet dataset.
+
+    `min_date`/`max_date` prune the hive `date=` partitions and filter row
+    groups on their `timestamp` statistics, `participant_ids` filters row
+    groups on `participant_id`, and `columns` projects the read so only
+    those columns are loaded. Rows still need to be filtered afterwards,
+    since row group statistics only rule out whole row groups.
+    """
     if not path:
         path = get_processed_dataset_path(name)
     filters = []
+
+    if min_date:
+        min_datetime = pd.to_datetime(min_date)
+        filters.append(("date", ">=", str(min_datetime.date())))
+        filters.append(("timestamp", ">=", min_datetime))
+    if max_date:
+        max_datetime = pd.to_datetime(max_date)
+        filters.append(("date", "<=", str(max_datetime.date())))
+        filters.append(("timestamp", "<", max_datetime))
+    if not participant_ids is None:
+        filters.append(("participant_id", "in", list(participant_ids)))
         
     if filters:
-        df = dd.read_parquet(path,filters=filters)
+        df = dd.read_parquet(path,filters=filters,index=index)
     else: 
         df = dd.read_parquet(path,index=index)
+
+    compact = is_compact_minute_level(df.columns)
+    if columns:
+        stored_columns = get_stored_columns(columns, df.columns, compact=compact and decode)
+        # Dask pushes this selection down into the parquet read
+        df = df[stored_columns]
+
+    if decode and compact:
+        df = df.map_partitions(decode_compact_minute_level,
+                               meta=decode_compact_minute_level(df._meta))
+        if columns:
+            df = df[list(columns)]
     return df
 
+def get_stored_columns(columns, available, compact=False):
+    """Maps the columns a caller asked for onto the columns that actually
+    have to be read from disk"""
+    if not compact:
+        return [c for c in columns if c in available]
+    # Decoding rebuilds every regular column from all of the compact ones
+    needed = set(columns) | {"timestamp", "heart_rate", "steps", "sleep_stage", "missing_flags"}
+    return [c for c in available if c in needed]
+
 def load_results(path):
     results = pd.read_json(path,lines=True)
     logits = pd.DataFrame(results["logits"].tolist(), columns=["pos_logit","neg_logit"])
@@ -211,11 +451,23 @@ def load_cached_activity_reader(name, dataset_args=None,
                                 activity_level="minute"):
     if not activity_level == "minute":
         raise NotImplementedError("Can only cache minute level activities")
-        
-    cache_path = get_cached_datareader_path(name)
-    reader = pickle.load(open(cache_path, "rb" ) )
+
+    snapshot_path = get_activity_snapshot_path(name)
+    if os.path.exists(snapshot_path):
+        # Imported here since task_datasets depends on this module
+        from src.data.activity_snapshot import load_activity_snapshot, get_snapshot_mismatch
+        reader, manifest = load_activity_snapshot(snapshot_path)
+    else:
+        manifest = None
+        cache_path = get_cached_datareader_path(name)
+        reader = pickle.load(open(cache_path, "rb" ) )
+
     if dataset_args:
-        dont_match = validate_reader(dataset_args,reader)
+        if manifest is not None:
+            # Snapshots store a hash of the arguments they were built with
+            dont_match = get_snapshot_mismatch(manifest, dataset_args)
+        else:
+            dont_match = validate_reader(dataset_args,reader)
         if len(dont_match) != 0:
             message = f"Mismatch between cached data reader and dataset args:{dont_match}"
             if fail_if_mismatched:
@@ -264,7 +516,7 @@ def process_minute_level(minute_level_path=None,
     minute_level_df["steps"] = minute_level_df["steps"].fillna(0)
     minute_level_df['missing_steps'] = minute_level_df['missing_steps'].astype(bool)
     minute_level_df["sleep_classic"] = minute_level_df["sleep_classic"].fillna(0)
-    minute_level_df =  minute_level_df[["timestamp", "sleep_classic", "heart_rate", "steps", "missing_heart_rate", "missing_steps"]]
+    minute_level_df =  minute_level_df[["participant_id", "timestamp", "sleep_classic", "heart_rate", "steps", "missing_heart_rate", "missing_steps"]]
 
     minute_level_df = minute_level_df.categorize(columns="sleep_classic",meta = [  ('sleep_classic', "category"),
                                                                                     ('heart_rate', "Int64"),
@@ -281,19 +533,11 @@ def process_minute_level(minute_level_path=None,
     
 
 
-    minute_level_df = minute_level_df.map_partitions(lambda x: x.groupby("participant_id")\
-                                                                .apply(fill_missing_minutes)\
-                                                                .reset_index(drop=True),
-                                                                meta = [("timestamp", "datetime64[ns]"),
-                                                                        ("heart_rate", "Int64"),
-                                                                        ("steps", "Int64"),
-                                                                        ("missing_heart_rate", "bool"),
-                                                                        ("missing_steps", "bool"),
-                                                                        ("sleep_classic_3", "bool"),
-                                                                        ("sleep_classic_2", "bool"),
-                                                                        ("sleep_classic_1", "bool"),
-                                                                        ("sleep_classic_0", "bool"),
-                                                                        ("date", "datetime64[ns]"),])
+    # All participants in a partition are gap-filled at once, and "date"
+    # is recomputed for the filled minutes
+    fill_partition = lambda x: fill_missing_minutes_vectorized(x).reset_index()
+    minute_level_df = minute_level_df.map_partitions(fill_partition,
+                                                     meta=fill_partition(minute_level_df._meta))
    
     if out_path is None:
         out_path = get_processed_dataset_path("processed_fitbit_minute_level_activity")
@@ -322,6 +566,84 @@ def fill_missing_minutes(user_df):
     return user_df
 
 
+MINUTE_FILL_VALUES = {"missing_heart_rate": True,
+                      "missing_steps": True,
+                      "steps": 0,
+                      "heart_rate": 0}
+
+def fill_missing_minutes_vectorized(df, participant_col="participant_id",
+                                    timestamp_col="timestamp"):
+    """Same result as running `fill_missing_minutes` on every participant, but
+    in a single pass: each row is scattered into a dense per-minute grid
+    that runs from each participant's first to last timestamp.
+
+    Timestamps are read from `timestamp_col` if it's a column and from the
+    index otherwise. If `participant_col` isn't a column the whole frame is
+    treated as one participant. Returns a frame indexed by "timestamp",
+    sorted by participant and then time.
+    """
+    if timestamp_col in df.columns:
+        timestamps = pd.to_datetime(df[timestamp_col])
+        df = df.drop(columns=[timestamp_col])
+    else:
+        timestamps = pd.Series(df.index.get_level_values(0))
+    if len(df) == 0:
+        # Nothing to fill. Dask's meta partitions are empty too, so "date"
+        # gets the same dtype as in filled partitions
+        df = df.set_axis(pd.DatetimeIndex([], dtype="datetime64[ns]", name="timestamp"))
+        if "date" in df.columns:
+            df["date"] = df.index.date
+        return df
+    timestamps = timestamps.to_numpy().astype("datetime64[ns]").view(np.int64)
+
+    if participant_col in df.columns:
+        codes, participant_ids = pd.factorize(df[participant_col], sort=True)
+    else:
+        codes, participant_ids = np.zeros(len(df), dtype=np.int64), None
+    n_participants = codes.max() + 1 if len(codes) else 0
+
+    minute = np.int64(60 * 10**9)
+    min_ts = np.full(n_participants, np.iinfo(np.int64).max)
+    max_ts = np.full(n_participants, np.iinfo(np.int64).min)
+    np.minimum.at(min_ts, codes, timestamps)
+    np.maximum.at(max_ts, codes, timestamps)
+
+    # Layout of the dense grid: participant i owns [starts[i], starts[i] + lengths[i])
+    lengths = (max_ts - min_ts) // minute + 1
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    total = int(lengths.sum())
+
+    positions = starts[codes] + (timestamps - min_ts[codes]) // minute
+    take_idx = np.full(total, -1, dtype=np.int64)
+    # On duplicate timestamps the later row wins
+    take_idx[positions] = np.arange(len(df))
+
+    dense_codes = np.repeat(np.arange(n_participants), lengths)
+    dense_timestamps = (np.repeat(min_ts, lengths)
+                        + (np.arange(total) - np.repeat(starts, lengths)) * minute)
+    new_index = pd.DatetimeIndex(dense_timestamps.view("datetime64[ns]"), name="timestamp")
+
+    filled = {}
+    for col in df.columns:
+        if col == participant_col:
+            filled[col] = participant_ids.take(dense_codes)
+            continue
+        if col == "date":
+            filled[col] = new_index.date
+            continue
+        values = df[col].array
+        if col in MINUTE_FILL_VALUES:
+            fill_value = MINUTE_FILL_VALUES[col]
+        elif pd.api.types.is_bool_dtype(values.dtype):
+            fill_value = False
+        else:
+            fill_value = None
+        filled[col] = pd.api.extensions.take(values, take_idx, allow_fill=True,
+                                             fill_value=fill_value)
+
+    return pd.DataFrame(filled, index=new_index, columns=df.columns)
+
+
 def process_minute_level_pandas(minute_level_path=None, minute_level_df=None,
                 out_path =None, participant_ids=None, single_user_mode = False,
                 return_df = False, random_state=42):
@@ -355,7 +677,7 @@ def process_minute_level_pandas(minute_level_path=None, minute_level_df=None,
     
 
 
-    minute_level_df = fill_missing_minutes(minute_level_df)
+    minute_level_df = fill_missing_minutes_vectorized(minute_level_df)
     minute_level_df["date"] = minute_level_df.index.date
     minute_level_df = minute_level_df.reset_index()
     sleep_cols = [f"sleep_classic_{i}" for i in range(4)]
@@ -371,5 +693,57 @@ def url_from_path(path,filesystem="file://"):
         return filesystem + path
 
 
-def read_parquet_to_pandas(path):
-    return pd.read_parquet(path,engine="fastparquet")
\ No newline at end of file
+def read_parquet_to_pandas(path,decode=True):
+    df = pd.read_parquet(path,engine="fastparquet")
+    if decode and is_compact_minute_level(df.columns):
+        df = decode_compact_minute_level(df)
+    return df
+
+
+# Compact storage for processed minute-level data. Heart rate and steps are
+# clipped into a uint8, the four sleep_classic one-hots become one uint8
+# stage code (0 means no sleep data, i+1 means sleep_classic_i) and the two
+# missingness flags are packed into the bits of one uint8.
+SLEEP_CLASSIC_COLUMNS = [f"sleep_classic_{i}" for i in range(4)]
+MISSING_FLAG_BITS = {"missing_heart_rate": 1,
+                     "missing_steps": 2}
+
+def is_compact_minute_level(columns):
+    return "missing_flags" in columns and "sleep_stage" in columns
+
+def encode_compact_minute_level(df):
+    compact = df.drop(columns=["heart_rate", "steps"] + SLEEP_CLASSIC_COLUMNS
+                              + list(MISSING_FLAG_BITS.keys()))
+    for col in ["heart_rate", "steps"]:
+        values = pd.to_numeric(df[col]).fillna(0).to_numpy(dtype=np.float64)
+        compact[col] = np.clip(values, 0, 255).astype(np.uint8)
+
+    sleep_stage = np.zeros(len(df), dtype=np.uint8)
+    for i, col in enumerate(SLEEP_CLASSIC_COLUMNS):
+        sleep_stage[df[col].fillna(False).to_numpy(dtype=bool)] = i + 1
+    compact["sleep_stage"] = sleep_stage
+
+    missing_flags = np.zeros(len(df), dtype=np.uint8)
+    for col, bit in MISSING_FLAG_BITS.items():
+        missing_flags[df[col].fillna(True).to_numpy(dtype=bool)] |= bit
+    compact["missing_flags"] = missing_flags
+    return compact
+
+def decode_compact_minute_level(df):
+    """Re-expands a frame written with `encode_compact_minute_level` into
+    the regular processed minute-level columns"""
+    decoded = df.drop(columns=["sleep_stage", "missing_flags"])
+    decoded["heart_rate"] = df["heart_rate"].astype(pd.Int16Dtype())
+    decoded["steps"] = df["steps"].astype(np.int16)
+
+    missing_flags = df["missing_flags"].to_numpy()
+    for col, bit in MISSING_FLAG_BITS.items():
+        decoded[col] = (missing_flags & bit) > 0
+
+    sleep_stage = df["sleep_stage"].to_numpy()
+    for i, col in enumerate(SLEEP_CLASSIC_COLUMNS):
+        decoded[col] = sleep_stage == i + 1
+
+    if not "date" in decoded.columns:
+        decoded["date"] = pd.to_datetime(decoded["timestamp"]).dt.date
+    return decoded
\ No newline at end of file
@@ -0,0 +1,504 @@
+"""
+Local (Spark-free) windowing engine for `make_petastorm_dataset`.
+
+After `fill_missing_minutes` every participant's minute-level data is a
+dense, sorted array, so the sliding `day_window_size`-day windows that the
+Spark path builds with `groupBy(f.window(...))` + `collect_list` are just
+strided slices of those arrays. Participants are split into shards and
+each shard is read, scaled, windowed and written by a worker process. The
+output has the same columns and Unischema as the Spark output, and the
+petastorm metadata that `materialize_dataset` would have written.
+
+Window semantics follow the Spark path: windows start at UTC midnights,
+slide by one day, end `day_window_size` days later (exclusive) and are
+only kept if every minute in them is present.
+"""
+import glob
+import json
+import os
+import pickle
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from tqdm import tqdm
+
+from src.utils import get_logger
+logger = get_logger(__name__)
+
+MINS_IN_DAY = 60*24
+MINUTE_NS = 60 * 10**9
+DAY_NS = MINS_IN_DAY * MINUTE_NS
+SLEEP_PREFIX = "sleep_classic_"
+
+# Window ids are a 47 bit hash of the participant id followed by the 16 bit
+# day number (since epoch) of the window's start, so they are stable across
+# rebuilds and appends
+ID_DAY_BITS = 16
+
+
+def strip_file_scheme(path):
+    if path.startswith("file://"):
+        return path[len("file://"):]
+    return path
+
+
+def get_input_dataset(input_path):
+    return ds.dataset(input_path, format="parquet", partitioning="hive")
+
+
+def get_row_filter(participants=None, min_date=None, max_date=None):
+    expression = None
+    def combine(new):
+        return new if expression is None else expression & new
+    if participants is not None:
+        expression = combine(ds.field("participant_id").isin(list(participants)))
+    if min_date:
+        expression = combine(ds.field("date") >= min_date)
+    if max_date:
+        expression = combine(ds.field("date") <= max_date)
+    return expression
+
+
+def get_participant_hash(participant_id):
+    """Matches `get_spark_window_id` in `make_petastorm_dataset`"""
+    return (zlib.crc32(participant_id.encode("utf-8")) << 15) \
+           | (zlib.crc32(participant_id[::-1].encode("utf-8")) >> 17)
+
+
+def get_window_ids(participant_id, start_times):
+    start_days = start_times.astype("datetime64[D]").astype(np.int64)
+    return (np.int64(get_participant_hash(participant_id)) << ID_DAY_BITS) | start_days
+
+
+def get_existing_windows(output_path):
+    """Latest window end and number of windows for each participant
+    already in `output_path`"""
+    output_path = strip_file_scheme(output_path)
+    if not os.path.exists(output_path):
+        return {}, {}
+    table = ds.dataset(output_path, format="parquet", partitioning="hive")\
+              .to_table(columns=["participant_id", "end"])
+    if table.num_rows == 0:
+        return {}, {}
+    grouped = table.to_pandas().groupby("participant_id")["end"]
+    ends = {participant_id: np.datetime64(end, "ns") for participant_id, end in grouped.max().items()}
+    counts = {participant_id: int(n) for participant_id, n in grouped.size().items()}
+    return ends, counts
+
+
+def get_feature_columns(input_path, rename=None):
+    """Feature columns (after renaming) and the subset of them that the
+    Spark path would scale, i.e. the double columns"""
+    rename = rename or {}
+    schema = get_input_dataset(input_path).schema
+    feature_columns, scale_columns = [], []
+    for field in schema:
+        if field.name in ["participant_id", "timestamp", "date"]:
+            continue
+        name = rename.get(field.name, field.name)
+        feature_columns.append(name)
+        if pa.types.is_float64(field.type):
+            scale_columns.append(name)
+    return feature_columns, scale_columns
+
+
+def list_participants(input_path, users=None, include_users=False, min_date=None, max_date=None):
+    dataset = get_input_dataset(input_path)
+    table = dataset.to_table(columns=["participant_id"],
+                             filter=get_row_filter(min_date=min_date, max_date=max_date))
+    participants = pc.unique(table.column("participant_id")).to_numpy(zero_copy_only=False)
+    participants = np.sort(participants.astype(str))
+    if users is not None:
+        mask = np.isin(participants, list(users))
+        participants = participants[mask] if include_users else participants[~mask]
+    return participants
+
+
+def read_shard(input_path, participants, feature_columns, rename, min_date=None, max_date=None):
+    # Columns are read by their original name and renamed after
+    inverse = {v: k for k, v in rename.items()}
+    read_columns = ["participant_id", "timestamp"] + [inverse.get(c, c) for c in feature_columns]
+    table = get_input_dataset(input_path).to_table(columns=read_columns,
+                                                   filter=get_row_filter(participants, min_date, max_date))
+    df = table.to_pandas()
+    df = df.rename(columns=rename)
+    if not np.issubdtype(df["timestamp"].dtype, np.datetime64):
+        # Same as --parse_timestamp on the Spark path: nanoseconds since epoch
+        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ns")
+    df["participant_id"] = df["participant_id"].astype(str)
+    return df.sort_values(["participant_id", "timestamp"], kind="stable").reset_index(drop=True)
+
+
+def get_column_values(df, column):
+    """A column as a plain numpy array. pyarrow restores pandas' nullable
+    dtypes (e.g. Int16) from the file metadata, and numpy can't allocate
+    those, so their missing values become 0 (NaN for floats)"""
+    series = df[column]
+    dtype = getattr(series.dtype, "numpy_dtype", None)
+    if dtype is None:
+        return series.to_numpy()
+    na_value = np.nan if np.issubdtype(dtype, np.floating) else dtype.type(0)
+    return series.to_numpy(dtype=dtype, na_value=na_value)
+
+
+def get_shard_moments(input_path, participants, scale_columns, rename, min_date=None, max_date=None):
+    """Count, sum and sum of squares of each column to scale, so the
+    global standard deviation can be combined across shards"""
+    df = read_shard(input_path, participants, scale_columns, rename, min_date, max_date)
+    moments = {}
+    for column in scale_columns:
+        values = df[column].dropna().values.astype(np.float64)
+        moments[column] = (len(values), values.sum(), np.square(values).sum())
+    return moments
+
+
+def combine_moments(shard_moments, scale_columns):
+    """Means and sample standard deviations (what pyspark's StandardScaler
+    divides by) from the per-shard moments"""
+    means, stds = {}, {}
+    for column in scale_columns:
+        n = sum(m[column][0] for m in shard_moments)
+        total = sum(m[column][1] for m in shard_moments)
+        total_sq = sum(m[column][2] for m in shard_moments)
+        means[column] = float(total / n) if n else 0.0
+        if n < 2:
+            stds[column] = 0.0
+            continue
+        variance = (total_sq - total**2 / n) / (n - 1)
+        stds[column] = float(np.sqrt(max(variance, 0.0)))
+    return means, stds
+
+
+def get_participant_windows(timestamps, day_window_size):
+    """Given one participant's sorted minute timestamps (as int64 ns),
+    returns the positions of each minute on a dense grid starting at the
+    first UTC midnight, and the grid day offsets of every complete window"""
+    window_length = day_window_size * MINS_IN_DAY
+    grid_start = (timestamps[0] // DAY_NS) * DAY_NS
+    positions = (timestamps - grid_start) // MINUTE_NS
+    n_days = int(positions[-1] // MINS_IN_DAY) + 1
+
+    present = np.zeros(n_days * MINS_IN_DAY, dtype=np.int64)
+    np.add.at(present, positions, 1)
+    counts = np.concatenate([[0], np.cumsum(present)])
+
+    starts = np.arange(0, max(n_days - day_window_size + 1, 0)) * MINS_IN_DAY
+    complete = (counts[starts + window_length] - counts[starts]) == window_length
+    return grid_start, positions, n_days, starts[complete]
+
+
+def get_days_with_data(participant_df, positions, n_days, missing_column):
+    """Whether each day on the participant's grid has at least one minute
+    where `missing_column` is false"""
+    has_data = np.zeros(n_days * MINS_IN_DAY, dtype=bool)
+    has_data[positions] = ~participant_df[missing_column].fillna(True).values.astype(bool)
+    return has_data.reshape(n_days, MINS_IN_DAY).any(axis=1)
+
+
+def filter_missing_days(starts, days_with_data, day_window_size, max_missing_days_in_window):
+    """Keeps the windows with at least `day_window_size - max_missing_days_in_window`
+    days with data, like `MinuteLevelActivityReader.get_valid_dates`"""
+    counts = np.concatenate([[0], np.cumsum(days_with_data)])
+    start_days = starts // MINS_IN_DAY
+    n_with_data = counts[start_days + day_window_size] - counts[start_days]
+    return starts[n_with_data >= day_window_size - max_missing_days_in_window]
+
+
+def window_participant(participant_df, feature_columns, day_window_size,
+                       max_missing_days_in_window=None, missing_column=None):
+    """Returns the windows and how many complete windows there were before
+    dropping the ones with too many missing days"""
+    timestamps = participant_df["timestamp"].values.astype("datetime64[ns]").astype(np.int64)
+    grid_start, positions, n_days, starts = get_participant_windows(timestamps, day_window_size)
+    n_complete = len(starts)
+    if max_missing_days_in_window is not None and missing_column in participant_df.columns:
+        days_with_data = get_days_with_data(participant_df, positions, n_days, missing_column)
+        starts = filter_missing_days(starts, days_with_data, day_window_size,
+                                     max_missing_days_in_window)
+    if len(starts) == 0:
+        return None, n_complete
+
+    window_length = day_window_size * MINS_IN_DAY
+    windows = {}
+    for column in feature_columns:
+        values = get_column_values(participant_df, column)
+        dense = np.zeros(n_days * MINS_IN_DAY, dtype=values.dtype)
+        dense[positions] = values
+        # Each window is a view into the dense array, only copied when stacked
+        windows[column] = np.lib.stride_tricks.sliding_window_view(dense, window_length)[starts]
+
+    start_times = (grid_start + starts.astype(np.int64) * MINUTE_NS).astype("datetime64[ns]")
+    windows["start"] = start_times
+    windows["end"] = start_times + np.timedelta64(day_window_size, "D")
+    return windows, n_complete
+
+
+def get_column_aggregation(column, dtype):
+    """How a minute-level column is reduced to a coarser resolution"""
+    if column.startswith("missing_"):
+        return "fraction"
+    if column.startswith(SLEEP_PREFIX):
+        return "majority"
+    if column == "steps":
+        return "sum"
+    if np.dtype(dtype) == np.bool_:
+        return "fraction"
+    return "mean"
+
+
+def get_aggregated_dtype(column, dtype):
+    aggregation = get_column_aggregation(column, dtype)
+    if aggregation == "majority":
+        return np.bool_
+    if aggregation == "sum" and np.issubdtype(np.dtype(dtype), np.integer):
+        return np.int32
+    return np.float32
+
+
+def check_resolution(resolution):
+    if resolution < 1 or MINS_IN_DAY % resolution:
+        raise ValueError(f"resolution must be a number of minutes that divides a day, got {resolution}")
+
+
+def aggregate_windows(windows, feature_columns, resolution):
+    """Reduces each window from minutes to `resolution`-minute steps. Heart
+    rate-like columns are averaged over the minutes their `missing_` flag
+    isn't set (0 if there are none), steps are summed, missing flags become
+    the fraction of missing minutes and the sleep stage columns mark the
+    stage slept for most of the step (none if mostly not in bed)."""
+    if resolution == 1:
+        return windows
+    windows = dict(windows)
+    minutes = {column: windows[column] for column in feature_columns}
+    sleep_columns = []
+    for column in feature_columns:
+        values = minutes[column]
+        buckets = values.reshape(values.shape[0], -1, resolution)
+        aggregation = get_column_aggregation(column, values.dtype)
+        if aggregation == "majority":
+            sleep_columns.append(column)
+        elif aggregation == "sum":
+            windows[column] = buckets.sum(axis=-1, dtype=get_aggregated_dtype(column, values.dtype))
+        elif aggregation == "fraction":
+            windows[column] = buckets.mean(axis=-1, dtype=np.float32)
+        elif f"missing_{column}" in minutes:
+            present = ~minutes[f"missing_{column}"].reshape(buckets.shape).astype(bool)
+            totals = np.where(present, buckets, 0).sum(axis=-1, dtype=np.float64)
+            counts = present.sum(axis=-1)
+            windows[column] = np.divide(totals, counts, out=np.zeros_like(totals),
+                                        where=counts > 0).astype(np.float32)
+        else:
+            windows[column] = buckets.mean(axis=-1, dtype=np.float64).astype(np.float32)
+
+    if sleep_columns:
+        counts = np.stack([minutes[c].reshape(minutes[c].shape[0], -1, resolution).sum(axis=-1)
+                           for c in sleep_columns], axis=-1)
+        not_asleep = resolution - counts.sum(axis=-1, keepdims=True)
+        # Ties go to the earlier stage, and to not being asleep before any stage
+        majority = np.argmax(np.concatenate([not_asleep, counts], axis=-1), axis=-1) - 1
+        for i, column in enumerate(sleep_columns):
+            windows[column] = majority == i
+    return windows
+
+
+def windows_to_table(participant_ids, windows, feature_columns, ids):
+    n_windows = len(windows["start"])
+    arrays = {"participant_id": pa.array(participant_ids, type=pa.string()),
+              "start": pa.array(windows["start"].astype("datetime64[us]")),
+              "end": pa.array(windows["end"].astype("datetime64[us]"))}
+    for column in feature_columns:
+        values = windows[column]
+        offsets = pa.array(np.arange(n_windows + 1, dtype=np.int32) * values.shape[1])
+        arrays[column] = pa.ListArray.from_arrays(offsets, pa.array(values.reshape(-1)))
+    arrays["id"] = pa.array(ids, type=pa.int64())
+    return pa.table(arrays)
+
+
+def get_row_group_size(feature_columns, dtypes, window_length, rowgroup_size_mb):
+    row_bytes = sum(np.dtype(dtypes[c]).itemsize for c in feature_columns) * window_length
+    return max(1, int(rowgroup_size_mb * 1024**2 // max(row_bytes, 1)))
+
+
+def get_participant_buckets(participant_ids, n_buckets):
+    """Same as pmod(crc32(participant_id), n_buckets) in Spark"""
+    return np.array([zlib.crc32(p.encode("utf-8")) % n_buckets for p in participant_ids], dtype=np.int32)
+
+
+def get_end_dates(ends):
+    # Windows have an exclusive right boundary, so this is their last day
+    return (ends - np.timedelta64(1, "D")).astype("datetime64[D]").astype(str)
+
+
+def add_partition_columns(table, participant_ids, windows, layout):
+    partition_cols = list(layout.get("partition_by") or [])
+    if layout.get("bucket_participants"):
+        buckets = get_participant_buckets(participant_ids, layout["bucket_participants"])
+        table = table.append_column("participant_bucket", pa.array(buckets))
+        partition_cols.append("participant_bucket")
+    if layout.get("partition_by_date"):
+        table = table.append_column("end_date", pa.array(get_end_dates(windows["end"])))
+        partition_cols.append("end_date")
+    return table, partition_cols
+
+
+def process_window_shard(shard_index, participants, input_path, output_path, feature_columns,
+                         rename, day_window_size, stds=None, min_date=None, max_date=None,
+                         rowgroup_size_mb=256, max_missing_days_in_window=None, min_windows=1,
+                         missing_column="missing_heart_rate", existing_ends=None, file_prefix="part",
+                         layout=None, resolution=1, existing_counts=None):
+    layout = layout or {}
+    existing_ends = existing_ends or {}
+    existing_counts = existing_counts or {}
+    if existing_ends and all(p in existing_ends for p in participants):
+        # Only minutes that can be part of a window ending after the
+        # existing ones need to be read
+        read_from = min(existing_ends[p] for p in participants) - np.timedelta64(day_window_size, "D")
+        read_from = str(read_from.astype("datetime64[D]"))
+        min_date = max(min_date, read_from) if min_date else read_from
+    df = read_shard(input_path, participants, feature_columns, rename, min_date, max_date)
+    if stds:
+        for column, std in stds.items():
+            # pyspark's StandardScaler leaves zero-variance columns at 0
+            df[column] = df[column] / std if std > 0 else 0.0
+
+    participant_ids, chunks = [], []
+    n_complete = 0
+    for participant_id, participant_df in df.groupby("participant_id", sort=False):
+        windows, n_participant_complete = window_participant(participant_df, feature_columns, day_window_size,
+                                                             max_missing_days_in_window, missing_column)
+        n_complete += n_participant_complete
+        if windows is None:
+            continue
+        if participant_id in existing_ends:
+            is_new = windows["end"] > existing_ends[participant_id]
+            windows = {k: v[is_new] for k, v in windows.items()}
+            if not is_new.any():
+                continue
+        # Only the minutes after a participant's existing windows are read
+        # when appending, so those windows count toward min_windows too
+        if len(windows["start"]) + existing_counts.get(participant_id, 0) < min_windows:
+            continue
+        windows = aggregate_windows(windows, feature_columns, resolution)
+        windows["id"] = get_window_ids(participant_id, windows["start"])
+        participant_ids.extend([participant_id] * len(windows["start"]))
+        chunks.append(windows)
+
+    result = {"n_windows": len(participant_ids), "n_complete": n_complete}
+    if not chunks:
+        return result
+
+    windows = {k: np.concatenate([c[k] for c in chunks]) for k in chunks[0]}
+    table = windows_to_table(participant_ids, windows, feature_columns, windows["id"])
+    table, partition_cols = add_partition_columns(table, participant_ids, windows, layout)
+
+    row_group_size = layout.get("windows_per_row_group") or \
+                     get_row_group_size(feature_columns, {c: windows[c].dtype for c in feature_columns},
+                                        day_window_size * MINS_IN_DAY // resolution, rowgroup_size_mb)
+    compression = layout.get("compression", "snappy")
+    if partition_cols:
+        ds.write_dataset(table, output_path, format="parquet",
+                         partitioning=partition_cols, partitioning_flavor="hive",
+                         basename_template=f"{file_prefix}-{shard_index:05d}-{{i}}.parquet",
+                         existing_data_behavior="overwrite_or_ignore",
+                         max_rows_per_group=row_group_size,
+                         file_options=ds.ParquetFileFormat().make_write_options(compression=compression))
+    else:
+        pq.write_table(table, os.path.join(output_path, f"{file_prefix}-{shard_index:05d}.parquet"),
+                       row_group_size=row_group_size, compression=compression)
+    return result
+
+
+def write_petastorm_metadata(output_path, schema, row_groups_per_file):
+    """Adds the metadata `materialize_dataset` writes after a Spark job,
+    so `make_reader` can open the dataset"""
+    from petastorm.etl.dataset_metadata import ROW_GROUPS_PER_FILE_KEY, UNISCHEMA_KEY
+    from petastorm.utils import add_to_dataset_metadata
+
+    dataset = pq.ParquetDataset(output_path, validate_schema=False)
+    add_to_dataset_metadata(dataset, UNISCHEMA_KEY, pickle.dumps(schema))
+    add_to_dataset_metadata(dataset, ROW_GROUPS_PER_FILE_KEY, json.dumps(row_groups_per_file))
+
+
+def write_windowed_dataset(input_path, output_path, schema, feature_columns, scale_columns,
+                           day_window_size, rename=None, min_date=None, max_date=None,
+                           users=None, include_users=False, workers=8,
+                           participants_per_shard=64, rowgroup_size_mb=256, stats=None,
+                           max_missing_days_in_window=None, min_windows=1,
+                           missing_column="missing_heart_rate", append=False, layout=None,
+                           resolution=1):
+    """Builds the windowed petastorm dataset without Spark. `scale_columns`
+    are divided by their standard deviation, like the Spark pipeline's
+    StandardScaler. Pass `stats` (means, stds) to reuse statistics fit on
+    another dataset. Returns the (means, stds) used.
+
+    With `append`, only windows ending after a participant's latest window
+    in `output_path` are written, as new files next to the existing ones.
+    A participant's existing windows count toward `min_windows`.
+
+    `layout` can set `partition_by` (output columns to partition by),
+    `bucket_participants` (number of participant hash buckets to partition
+    by), `partition_by_date` (partition by the window's last day),
+    `windows_per_row_group` and `compression`. With `resolution` > 1 windows
+    are aggregated to steps of that many minutes, see `aggregate_windows`."""
+    check_resolution(resolution)
+    output_path = strip_file_scheme(output_path)
+    rename = rename or {}
+    os.makedirs(output_path, exist_ok=True)
+
+    existing_ends, existing_counts, file_prefix = {}, {}, "part"
+    if append:
+        existing_ends, existing_counts = get_existing_windows(output_path)
+        file_prefix = f"part-{pd.Timestamp.now():%Y%m%d%H%M%S}"
+        logger.info(f"Appending to {len(existing_ends)} participants' existing windows")
+    else:
+        for path in glob.glob(os.path.join(output_path, "**", "*.parquet"), recursive=True) \
+                    + glob.glob(os.path.join(output_path, "_*metadata")):
+            os.remove(path)
+
+    participants = list_participants(input_path, users=users, include_users=include_users,
+                                     min_date=min_date, max_date=max_date)
+    n_shards = max(1, int(np.ceil(len(participants) / participants_per_shard)))
+    shards = np.array_split(participants, n_shards)
+    logger.info(f"Windowing {len(participants)} participants in {n_shards} shards "
+                f"across {workers} workers...")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        means, stds = stats if stats else ({}, {})
+        if scale_columns and not stats:
+            futures = [executor.submit(get_shard_moments, input_path, shard, scale_columns,
+                                       rename, min_date, max_date) for shard in shards]
+            means, stds = combine_moments([future.result() for future in futures], scale_columns)
+        if stds:
+            stds = {column: stds[column] for column in scale_columns}
+            logger.info(f"Scaling by standard deviations: {stds}")
+
+        futures = [executor.submit(process_window_shard, i, shard, input_path, output_path,
+                                   feature_columns, rename, day_window_size, stds,
+                                   min_date, max_date, rowgroup_size_mb,
+                                   max_missing_days_in_window, min_windows, missing_column,
+                                   {p: existing_ends[p] for p in shard if p in existing_ends},
+                                   file_prefix, layout, resolution,
+                                   {p: existing_counts[p] for p in shard if p in existing_counts})
+                   for i, shard in enumerate(shards)]
+        n_windows, n_complete = 0, 0
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            result = future.result()
+            n_windows += result["n_windows"]
+            n_complete += result["n_complete"]
+
+    # Covers the files from earlier runs when appending
+    row_groups_per_file = {os.path.relpath(path, output_path): pq.ParquetFile(path).num_row_groups
+                           for path in glob.glob(os.path.join(output_path, "**", "*.parquet"), recursive=True)}
+
+    logger.info(f"Kept {n_windows} of {n_complete} complete windows "
+                f"({n_complete - n_windows} dropped for missing days or min_windows)")
+    logger.info(f"Wrote {n_windows} windows to {output_path}")
+    write_petastorm_metadata(output_path, schema, row_groups_per_file)
+    return means, stds
@@ -7,7 +7,7 @@ from pandas.core.indexes.datetimes import date_range
 from pyspark.sql.functions import window
 
 import src.data.task_datasets as td
-from src.data.utils import load_processed_table
+from src.data.utils import load_processed_table, expand_clause_dummies
 
 
 def get_dates_around(date,days_minus,days_plus):
@@ -188,8 +188,10 @@ class CovidLabler(object):
 class ClauseLabler(object):
     def __init__(self, survey_respones, clause):
         self.clause = clause
-        self.survey_responses = survey_respones
-        self.survey_responses["_date"] = self.survey_responses["timestamp"].dt.normalize()
+        # Only materialize the columns the clause uses. For the categorical
+        # survey table this also builds the dummies it refers to.
+        self.survey_responses = expand_clause_dummies(survey_respones, clause)
+        self.survey_responses["_date"] = survey_respones["timestamp"].dt.normalize()
         self.survey_responses["_dummy"] = True
         self.survey_lookup = self.survey_responses\
                                  .reset_index()\
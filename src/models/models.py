@@ -458,6 +458,10 @@ class CNNToTransformerEncoder(pl.LightningModule):
     
     def on_train_epoch_start(self):
         self.train_metrics.to(self.device)
+        # Datasets that resample every epoch (e.g. PairSamplingDataset) only
+        # see the epoch if it's set here, before the workers copy them
+        if hasattr(self.train_dataset, "set_epoch"):
+            self.train_dataset.set_epoch(self.current_epoch)
     
     def on_validation_epoch_start(self):
         torch.cuda.empty_cache()
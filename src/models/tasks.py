@@ -48,8 +48,10 @@ from petastorm.etl.dataset_metadata import infer_or_load_unischema
 import petastorm.predicates  as peta_pred
 
 import src.data.task_datasets as td
+from src.data.pair_sampling import PairSamplingDataset
 from src.models.eval import classification_eval, regression_eval
-from src.data.utils import load_processed_table, load_cached_activity_reader, url_from_path
+from src.data.utils import (load_processed_table, load_cached_activity_reader, url_from_path,
+                            find_typed_processed_dataset_path, load_window_meta)
 from src.utils import get_logger, read_yaml
 from src.models.lablers import (FluPosLabler, ClauseLabler, EvidationILILabler, 
                                  DayOfWeekLabler, AudereObeseLabler, DailyFeaturesLabler,
@@ -420,7 +422,7 @@ class ActivityTask(Task):
                 for side in ["l","r"]:    
                     new_fields+=   [(f"inputs_embeds_{side}",np.float32,None,False),
                                     (f"participant_id_{side}",np.str_,None,False),
-                                    (f"id_{side}",np.int32,None,False),
+                                    (f"id_{side}",np.int64,None,False),
                                     (f"end_date_str_{side}",np.str_,None,False)]
                 new_fields +=[("label",label_type,None,False)]
             
@@ -481,7 +483,7 @@ class ActivityTask(Task):
                 new_fields = [("inputs_embeds",np.float32,None,False),
                             ("label",label_type,None,False),
                             ("participant_id",np.str_,None,False),
-                            ("id",np.int32,None,False),
+                            ("id",np.int64,None,False),
                             ("end_date_str",np.str_,None,False)]
 
             self.transform = TransformSpec(_transform_row,removed_fields=fields,
@@ -501,6 +503,11 @@ class ActivityTask(Task):
                 self.data_shape = (data_length,len(self.keys)//2)
             else:
                 self.data_shape = (data_length,len(self.keys))
+
+            # Minutes per time step, for datasets written with --resolution
+            window_meta = load_window_meta(infer_schema_path)
+            self.resolution = window_meta["resolution"] if window_meta else 1
+            logger.info(f"Data shape {self.data_shape} at {self.resolution} minute resolution")
         
         elif backend == "dynamic":
             self.data_shape = shape 
@@ -820,7 +827,11 @@ class PredictSurveyClause(ActivityTask,ClassificationMixin):
                 'sleep_classic_2',
                 'sleep_classic_3', 
                 'steps']
-        self.survey_responses = load_processed_table("daily_surveys_onehot").set_index("participant_id")
+        if find_typed_processed_dataset_path("daily_surveys_categorical"):
+            survey_table = "daily_surveys_categorical"
+        else:
+            survey_table = "daily_surveys_onehot"
+        self.survey_responses = load_processed_table(survey_table).set_index("participant_id")
         self.labler = ClauseLabler(self.survey_responses,self.clause)
         dataset_args["labeler"] = self.labler
         ActivityTask.__init__(self, td.CustomLabler, dataset_args=dataset_args,
@@ -1065,7 +1076,46 @@ class Autoencode(AutoencodeMixin, ActivityTask):
     def get_name(self):
         return "Autoencode"
 
-class PredictSameParticipant(ActivityTask,ClassificationMixin):
+class PairSamplingMixin(object):
+    """Lets pair tasks sample pairs from a single-window petastorm dataset
+    at read time (see `src.data.pair_sampling`) rather than reading a
+    materialized `_l`/`_r` dataset. Enabled with `sample_pairs: true` in
+    `dataset_args`, options go in `pair_sampling_args`."""
+
+    def pop_pair_sampling_args(self, dataset_args, kwargs):
+        self.sample_pairs = dataset_args.pop("sample_pairs", False)
+        pair_sampling_args = dataset_args.pop("pair_sampling_args", {})
+        if self.sample_pairs:
+            # Pairs are served as a regular torch dataset
+            kwargs["backend"] = "dynamic"
+            for split in ["train_path","eval_path","test_path"]:
+                pair_sampling_args[split] = kwargs.get(split)
+            pair_sampling_args["normalize_numerical"] = kwargs.get("normalize_numerical",True)
+        return pair_sampling_args
+
+    def init_pair_sampling(self, pair_task, train_path=None, eval_path=None, test_path=None,
+                           positive_frac=0.5, n_pairs=None, seed=0, normalize_numerical=True):
+        keys = [k[:-2] for k in self.keys if k.endswith("_l")]
+
+        def make_dataset(path, resample_each_epoch):
+            if not path:
+                return None
+            return PairSamplingDataset(path, keys, self.get_labler(), task=pair_task,
+                                       positive_frac=positive_frac, n_pairs=n_pairs, seed=seed,
+                                       resample_each_epoch=resample_each_epoch,
+                                       normalize_numerical=normalize_numerical)
+
+        self.train_dataset = make_dataset(train_path, True)
+        # Evaluation pairs stay the same across epochs
+        self.eval_dataset = make_dataset(eval_path, False)
+        self.test_dataset = make_dataset(test_path, False)
+
+        for dataset in [self.train_dataset, self.eval_dataset, self.test_dataset]:
+            if dataset is not None:
+                self.data_shape = (dataset.window_length, len(keys))
+                break
+
+class PredictSameParticipant(ActivityTask,ClassificationMixin,PairSamplingMixin):
     """Predict the whether a participant triggered the 
        test on the last day of a range of data"""
 
@@ -1087,9 +1137,12 @@ class PredictSameParticipant(ActivityTask,ClassificationMixin):
                      'sleep_classic_3_r', 
                      'steps_r']
         self.labler = SameParticipantLabler()
+        pair_sampling_args = self.pop_pair_sampling_args(dataset_args, kwargs)
         ActivityTask.__init__(self,td.PredictTriggerDataset,dataset_args=dataset_args,
                                activity_level = activity_level, double_encode=True,
                             **kwargs)
+        if self.sample_pairs:
+            self.init_pair_sampling("same_participant", **pair_sampling_args)
 
         ClassificationMixin.__init__(self)
         self.is_double_encoding = True
@@ -1102,7 +1155,7 @@ class PredictSameParticipant(ActivityTask,ClassificationMixin):
 
 
 
-class PredictSequential(ActivityTask,ClassificationMixin):
+class PredictSequential(ActivityTask,ClassificationMixin,PairSamplingMixin):
     """Predict whether two days of data follow one another"""
 
     def __init__(self,dataset_args={}, activity_level="minute", **kwargs):
@@ -1123,9 +1176,12 @@ class PredictSequential(ActivityTask,ClassificationMixin):
                      'sleep_classic_3_r', 
                      'steps_r']
         self.labler = SequentialLabler()
+        pair_sampling_args = self.pop_pair_sampling_args(dataset_args, kwargs)
         ActivityTask.__init__(self,td.PredictTriggerDataset,dataset_args=dataset_args,
                                activity_level = activity_level, double_encode=True,
                             **kwargs)
+        if self.sample_pairs:
+            self.init_pair_sampling("sequential", **pair_sampling_args)
 
         ClassificationMixin.__init__(self)
         self.is_double_encoding = True
@@ -57,7 +57,7 @@ from src.models.autoencode import get_autoencoder_by_name, run_autoencoder
 from src.models.tasks import get_task_with_name, Autoencode
 from src.models.neural_baselines import create_neural_model
 from src.models.models import CNNToTransformerEncoder, CNNToTransformerDoubleEncoder
-from src.models.trainer import FluTrainer
+from src.models.trainer import FluTrainer, SetEpochCallback
 from src.SAnD.core.model import SAnD
 from src.utils import (get_logger, load_dotenv, render_network_plot, set_gpus_automatically, 
                         visualize_model)
@@ -784,6 +784,8 @@ def run_huggingface(model,base_trainer,training_args,
             eval_dataset=eval_dataset,
             compute_metrics=metrics,
             save_eval=True,)
+    if hasattr(train_dataset, "set_epoch"):
+        trainer_args["callbacks"] = [SetEpochCallback(train_dataset)]
 
     trainer = base_trainer(**trainer_args)  
     trainer.train()
@@ -19,7 +19,7 @@ import torch
 from torch.utils.data import DataLoader
 from torch.utils.data.dataset import Dataset
 
-from transformers import Trainer
+from transformers import Trainer, TrainerCallback
 from transformers.trainer_utils import PredictionOutput, EvalPrediction, speed_metrics
 from transformers.file_utils import  is_torch_tpu_available
 from transformers.trainer_pt_utils import (
@@ -34,6 +34,18 @@ from src.utils import get_logger, check_for_wandb_run, write_jsonl
 logger = get_logger(__name__)
 
 
+class SetEpochCallback(TrainerCallback):
+    """Tells a dataset that resamples every epoch (e.g. `PairSamplingDataset`)
+    which epoch is starting. The Trainer only does this for distributed
+    samplers, and DataLoader workers only ever see copies of the dataset."""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        # state.epoch is None before the first step
+        self.dataset.set_epoch(int(round(state.epoch or 0)))
+
+
 class FluTrainer(Trainer):
     """ Subclasses the huggingface trainer to add more flexability"""
     def __init__(self, *args, **kwargs):
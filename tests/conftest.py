@@ -0,0 +1,175 @@
+"""
+Synthetic datasets shared by the tests. Generators are fixtures that
+return factories, so each test writes its data under its own tmp_path.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+MINS_IN_DAY = 24*60
+
+
+def make_minute_level(participants=("a",), n_days=3, start="2020-01-01", gaps=()):
+    """Minute-level rows shaped like the output of `fill_missing_minutes`.
+    `steps` is a nullable Int16 column with one missing value per
+    participant, as pyarrow restores it. `gaps` are (participant_id, start,
+    end) ranges of minutes to drop."""
+    frames = []
+    for i, participant_id in enumerate(participants):
+        timestamps = pd.date_range(start, periods=n_days * MINS_IN_DAY, freq="min")
+        steps = pd.array((np.arange(len(timestamps)) + i) % 100, dtype="Int16")
+        steps[5] = pd.NA
+        df = pd.DataFrame({"participant_id": participant_id,
+                           "timestamp": timestamps,
+                           "heart_rate": np.linspace(60, 90, len(timestamps)) + i,
+                           "steps": steps})
+        for gap_participant, gap_start, gap_end in gaps:
+            if gap_participant == participant_id:
+                df = df[~df["timestamp"].between(gap_start, gap_end)]
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_date_partitioned(df, path):
+    df = df.copy()
+    df["date"] = df["timestamp"].dt.strftime("%Y-%m-%d")
+    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), str(path),
+                        partition_cols=["date"])
+
+
+@pytest.fixture
+def minute_level(tmp_path):
+    """Writes a date-partitioned minute-level dataset and returns its path
+    and rows. Rows are `df` if given, and `make_minute_level(**kwargs)`
+    otherwise."""
+    def write(name="minute_level", df=None, **kwargs):
+        if df is None:
+            df = make_minute_level(**kwargs)
+        write_date_partitioned(df, tmp_path / name)
+        return str(tmp_path / name), df
+    return write
+
+
+@pytest.fixture
+def no_petastorm_metadata(monkeypatch):
+    """Lets the local window engine run without petastorm, which is only
+    needed for the metadata `make_reader` reads"""
+    from src.data import window_engine
+    monkeypatch.setattr(window_engine, "write_petastorm_metadata", lambda *args: None)
+
+
+def make_day_level(n_participants=4, n_days=20, seed=0):
+    """Day-level rows with missing days, shaped like the input to
+    `fill_missing_days`"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(n_participants):
+        dates = pd.date_range("2020-01-01", periods=n_days) + pd.Timedelta(days=int(rng.integers(0, 5)))
+        keep = rng.random(n_days) < 0.6
+        keep[[0, -1]] = True
+        n = int(keep.sum())
+        frames.append(pd.DataFrame({"participant_id": f"participant_{i}",
+                                    "date": dates[keep],
+                                    "resting_heart_rate": rng.normal(60, 5, n),
+                                    "total_asleep_minutes": rng.integers(200, 500, n).astype(float),
+                                    "missing_steps": rng.integers(0, 2, n),
+                                    "missing_hr": rng.integers(0, 2, n),
+                                    "missing_sleep": rng.integers(0, 2, n)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.fixture
+def day_level():
+    return make_day_level
+
+
+@pytest.fixture
+def day_level_table(tmp_path):
+    """Writes a gap-filled day-level table the way `process_day_level` does
+    and returns its path and rows"""
+    from src.data.make_audere_dataset import fill_missing_days_vectorized
+    from src.data.utils import write_processed_table
+
+    def write(**kwargs):
+        df = fill_missing_days_vectorized(make_day_level(**kwargs))
+        path = str(tmp_path / "fitbit_day_level_activity.parquet")
+        write_processed_table(df, "fitbit_day_level_activity", fmt="parquet", path=path,
+                              write_csv=False, partition_cols=["date"])
+        return path, df
+    return write
+
+
+def make_raw_rows(n_days, participants=("a", "b"), seed=0):
+    steps, hr, sleep = [], [], []
+    for i, participant_id in enumerate(participants):
+        # Adding days doesn't change the earlier ones
+        rng = np.random.default_rng([seed, i])
+        for day in pd.date_range("2020-01-01", periods=n_days):
+            dt = day.strftime("%Y-%m-%d")
+            steps.append({"id_participant_external": participant_id, "dt": dt,
+                          "minute_level_str": " ".join(rng.integers(0, 100, MINS_IN_DAY).astype(str))})
+            hr.append({"id_participant_external": participant_id, "dt": dt,
+                       "minute_level_str": " ".join(rng.integers(50, 120, MINS_IN_DAY).astype(str))})
+            sleep.append({"id_participant_external": participant_id,
+                          "main_start_time": day + pd.Timedelta(hours=23),
+                          "main_in_bed_minutes": 120,
+                          "minute_level_str": " ".join(rng.integers(0, 4, 120).astype(str))})
+    return {"sleep": pd.DataFrame(sleep), "steps": pd.DataFrame(steps), "heart_rate": pd.DataFrame(hr)}
+
+
+def write_raw_tables(path, n_days, participants=("a", "b"), seed=0):
+    os.makedirs(path, exist_ok=True)
+    for name, rows in make_raw_rows(n_days, participants, seed).items():
+        rows.to_parquet(os.path.join(path, f"{name}.parquet"))
+
+
+def write_daily_raw_tables(path, n_days, participants=("a", "b"), seed=0):
+    """Raw tables as directories of one file per day, like daily exports.
+    Files that already exist are left alone, so their mtimes don't change."""
+    for name, rows in make_raw_rows(n_days, participants, seed).items():
+        os.makedirs(os.path.join(path, name), exist_ok=True)
+        days = pd.to_datetime(rows["dt"] if "dt" in rows else rows["main_start_time"]).dt.strftime("%Y-%m-%d")
+        for day, day_rows in rows.groupby(days):
+            file = os.path.join(path, name, f"{day}.parquet")
+            if not os.path.exists(file):
+                day_rows.to_parquet(file)
+
+
+def run_make_dataset(raw_path, out_path, *args, daily=False):
+    from click.testing import CliRunner
+    from src.data.make_dataset import main as make_dataset
+    paths = [os.path.join(raw_path, name if daily else f"{name}.parquet")
+             for name in ["sleep", "steps", "heart_rate"]]
+    result = CliRunner().invoke(make_dataset, paths + [out_path] + list(args), catch_exceptions=False)
+    assert result.exit_code == 0
+
+
+def load_processed(path):
+    df = pd.read_parquet(path).drop(columns=["date"])
+    return df.sort_values(["participant_id", "timestamp"]).reset_index(drop=True)
+
+
+@pytest.fixture
+def raw_tables():
+    """`write_raw_tables`, or `write_daily_raw_tables` with `daily=True`"""
+    def write(path, n_days, participants=("a", "b"), seed=0, daily=False):
+        writer = write_daily_raw_tables if daily else write_raw_tables
+        writer(path, n_days, participants, seed)
+    return write
+
+
+@pytest.fixture
+def make_dataset_cli():
+    """`run_make_dataset`, which runs the `make_dataset` CLI on raw tables
+    written by `raw_tables`"""
+    return run_make_dataset
+
+
+@pytest.fixture
+def processed():
+    """`load_processed`, which reads the output of `make_dataset`"""
+    return load_processed
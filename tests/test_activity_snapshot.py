@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+from src.data.activity_snapshot import (get_snapshot_mismatch, load_activity_snapshot,
+                                        write_activity_snapshot)
+from src.data.task_datasets import ActivtyDataset, DayLevelActivityReader
+
+
+class UnlabeledDataset(ActivtyDataset):
+    def get_label(self, participant_id, start_date, end_date):
+        return 0
+
+
+def make_reader(path, **kwargs):
+    args = dict(day_window_size=3, max_missing_days_in_window=1, scaler=None,
+                data_location=path, **kwargs)
+    return DayLevelActivityReader(**args), args
+
+
+def test_snapshot_round_trip(tmp_path, day_level_table):
+    path, _ = day_level_table()
+    reader, args = make_reader(path, split_date="2020-01-10")
+    write_activity_snapshot(reader, str(tmp_path / "snapshot"), dataset_args=args)
+
+    loaded, manifest = load_activity_snapshot(str(tmp_path / "snapshot"))
+    assert not loaded.has_frame()
+    assert loaded.participant_dates == reader.participant_dates
+    assert loaded.split_date == "2020-01-10" and loaded.day_window_size == 3
+
+    # Datasets read windows from the mapped store without rebuilding the frame
+    dataset = UnlabeledDataset(loaded, None, loaded.participant_dates, cache=False)
+    assert dataset.array_store is loaded.array_store
+    for index in [0, len(dataset) - 1]:
+        item = dataset[index]
+        end = item["end_date"]
+        expected = reader.activity_data.loc[(item["participant_id"], end - pd.Timedelta(days=2)):
+                                            (item["participant_id"], end)]
+        np.testing.assert_allclose(item["inputs_embeds"], expected.values.astype(np.float32))
+    assert not loaded.has_frame()
+
+    # The frame is still there for anything that asks for it
+    pd.testing.assert_frame_equal(loaded.activity_data, reader.activity_data.astype(np.float32),
+                                  check_index_type=False, check_freq=False)
+    assert loaded.has_frame()
+    assert get_snapshot_mismatch(manifest, args) == []
+
+
+def test_snapshot_mismatch(tmp_path, day_level_table):
+    path, _ = day_level_table()
+    reader, args = make_reader(path, split_date="2020-01-10")
+    write_activity_snapshot(reader, str(tmp_path / "snapshot"), dataset_args=args)
+    _, manifest = load_activity_snapshot(str(tmp_path / "snapshot"))
+
+    assert get_snapshot_mismatch(manifest, {**args, "split_date": pd.Timestamp("2020-01-10")}) == []
+    assert get_snapshot_mismatch(manifest, {**args, "split_date": "2020-01-12"}) == \
+        [("split_date", "2020-01-12 00:00:00", "2020-01-10 00:00:00")]
+    mismatch = get_snapshot_mismatch(manifest, {**args, "data_location": str(tmp_path / "other")})
+    assert [name for name, *_ in mismatch] == ["data_location"]
+    mismatch = get_snapshot_mismatch(manifest, {**args, "day_window_size": 5})
+    assert [name for name, *_ in mismatch] == ["day_window_size"]
@@ -0,0 +1,242 @@
+import os
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data import utils
+from src.data.utils import (SLEEP_CLASSIC_COLUMNS, decode_compact_minute_level,
+                            encode_compact_minute_level, encode_survey_categoricals,
+                            expand_clause_dummies, fill_missing_minutes,
+                            fill_missing_minutes_vectorized, get_dask_df,
+                            is_compact_minute_level, load_processed_table,
+                            read_parquet_to_pandas, resolve_processed_table_path,
+                            write_processed_table)
+
+MINS_IN_DAY = 24*60
+
+
+def get_survey():
+    df = pd.DataFrame({"symptom": [1, 0, 1, None],
+                       "symptom_severity": [2, 3, 2, None],
+                       "age": [30, 40, 50, 60]})
+    return encode_survey_categoricals(df, ["symptom", "symptom_severity"])
+
+
+def test_expand_clause_dummies_matches_get_dummies():
+    df = get_survey()
+    clause = "`symptom_1.0` == 1 and `symptom_severity_2.0` == 1 and age > 35"
+    expanded = expand_clause_dummies(df, clause)
+    assert len(expanded.query(clause)) == 1
+    dummies = pd.get_dummies(df, columns=["symptom", "symptom_severity"], dtype="uint8")
+    pd.testing.assert_frame_equal(expanded.query(clause), dummies[expanded.columns].query(clause))
+
+
+def test_expand_clause_dummies_unknown_answer():
+    with pytest.raises(ValueError, match="symptom_severity_5.0"):
+        expand_clause_dummies(get_survey(), "`symptom_severity_5.0` == 1")
+
+
+def make_gappy_minute_level(n_participants=3, n_minutes=3 * MINS_IN_DAY, seed=0):
+    """Minute-level rows with random gaps, shaped like the input to fill_missing_minutes"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(n_participants):
+        timestamps = pd.date_range("2020-01-01", periods=n_minutes, freq="min")
+        keep = rng.random(n_minutes) > 0.3
+        keep[[0, -1]] = True
+        n = int(keep.sum())
+        frames.append(pd.DataFrame({"participant_id": f"participant_{i}",
+                                    "timestamp": timestamps[keep],
+                                    "heart_rate": pd.array(rng.integers(50, 120, n), dtype="Int64"),
+                                    "steps": pd.array(rng.integers(0, 100, n), dtype="Int64"),
+                                    "missing_heart_rate": rng.random(n) < 0.1,
+                                    "missing_steps": rng.random(n) < 0.1}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_fill_missing_minutes_vectorized():
+    df = make_gappy_minute_level()
+    result = fill_missing_minutes_vectorized(df)
+    for participant_id, user_df in df.groupby("participant_id"):
+        expected = fill_missing_minutes(user_df.set_index("timestamp").drop(columns=["participant_id"]))
+        user_result = result[result["participant_id"] == participant_id].drop(columns=["participant_id"])
+        assert len(user_result) == len(expected)
+        np.testing.assert_array_equal(user_result.index.values, expected.index.values)
+        for column in expected.columns:
+            np.testing.assert_array_equal(user_result[column].to_numpy(dtype=np.int64),
+                                          expected[column].to_numpy(dtype=np.int64), err_msg=column)
+
+
+def test_fill_missing_minutes_vectorized_empty():
+    df = make_gappy_minute_level().iloc[0:0]
+    result = fill_missing_minutes_vectorized(df)
+    assert result.empty and result.index.name == "timestamp"
+    assert list(result.columns) == [c for c in df.columns if c != "timestamp"]
+    pd.testing.assert_series_equal(result.dtypes, df.drop(columns=["timestamp"]).dtypes)
+
+
+def test_fill_missing_minutes_meta_matches_output():
+    # The same meta process_minute_level passes to map_partitions
+    df = make_gappy_minute_level()
+    df["date"] = df["timestamp"].dt.date
+    fill_partition = lambda x: fill_missing_minutes_vectorized(x).reset_index()
+    ddf = dd.from_pandas(df, npartitions=2)
+    filled = ddf.map_partitions(fill_partition, meta=fill_partition(ddf._meta))
+    result = filled.compute()
+    assert list(result.columns) == list(filled.columns)
+    pd.testing.assert_series_equal(result.dtypes, filled.dtypes)
+
+
+def make_processed_minute_level():
+    """Rows shaped like processed minute-level data, with out of range
+    values, missing values and minutes without sleep data"""
+    df = pd.DataFrame({"participant_id": "a",
+                       "timestamp": pd.date_range("2020-01-01 23:58", periods=6, freq="min"),
+                       "heart_rate": [61.0, np.nan, 300.0, 0.0, 72.4, 255.0],
+                       "steps": pd.array([0, 12, None, 400, 7, 3], dtype="Int64"),
+                       "missing_heart_rate": [False, True, False, True, False, False],
+                       "missing_steps": [False, False, True, False, True, False]})
+    sleep_stage = [0, 1, 2, 3, 4, 0]
+    for i, col in enumerate(SLEEP_CLASSIC_COLUMNS):
+        df[col] = [stage == i + 1 for stage in sleep_stage]
+    return df
+
+
+def test_compact_minute_level_round_trip():
+    df = make_processed_minute_level()
+    compact = encode_compact_minute_level(df)
+    assert is_compact_minute_level(compact.columns)
+    assert set(compact.columns) == {"participant_id", "timestamp", "heart_rate", "steps",
+                                    "sleep_stage", "missing_flags"}
+    for col in ["heart_rate", "steps", "sleep_stage", "missing_flags"]:
+        assert compact[col].dtype == np.uint8, col
+    assert compact["sleep_stage"].tolist() == [0, 1, 2, 3, 4, 0]
+    assert compact["missing_flags"].tolist() == [0, 1, 2, 1, 2, 0]
+
+    decoded = decode_compact_minute_level(compact)
+    assert isinstance(decoded["heart_rate"].dtype, pd.Int16Dtype)
+    assert decoded["steps"].dtype == np.int16
+    # Missing values become 0, out of range ones are clipped and fractions truncated
+    assert decoded["heart_rate"].tolist() == [61, 0, 255, 0, 72, 255]
+    assert decoded["steps"].tolist() == [0, 12, 0, 255, 7, 3]
+    for col in ["missing_heart_rate", "missing_steps"] + SLEEP_CLASSIC_COLUMNS:
+        assert decoded[col].dtype == bool, col
+        assert decoded[col].tolist() == df[col].tolist(), col
+    assert decoded["date"].tolist() == df["timestamp"].dt.date.tolist()
+    pd.testing.assert_series_equal(decoded["timestamp"], df["timestamp"])
+
+
+def test_compact_minute_level_missing_flags_default_to_missing():
+    df = make_processed_minute_level()
+    df["missing_steps"] = pd.array([None, False, True, None, True, False], dtype="boolean")
+    decoded = decode_compact_minute_level(encode_compact_minute_level(df))
+    assert decoded["missing_steps"].tolist() == [True, False, True, True, True, False]
+
+
+def test_compact_minute_level_parquet_round_trip(tmp_path):
+    df = make_processed_minute_level()
+    encode_compact_minute_level(df).to_parquet(tmp_path / "compact.parquet", index=False)
+    expected = decode_compact_minute_level(encode_compact_minute_level(df))
+    result = read_parquet_to_pandas(str(tmp_path / "compact.parquet"))
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_index_type=False,
+                                  check_dtype=False)
+    for col in expected.columns:
+        if col not in ["participant_id", "timestamp", "date"]:
+            assert result[col].dtype == expected[col].dtype, col
+
+
+def test_get_dask_df_prunes_rows_and_columns(minute_level):
+    path, df = minute_level(participants=("a", "b"), n_days=4)
+    ddf = get_dask_df(path=path, min_date="2020-01-02 12:00", max_date="2020-01-04",
+                      participant_ids=["b"], columns=["participant_id", "timestamp", "steps"])
+    # Only the date partitions in range are read, and only the requested columns
+    assert ddf.npartitions == 2
+    assert ddf.optimize().expr.columns == ["participant_id", "timestamp", "steps"]
+
+    result = ddf.compute()
+    expected = df[(df["participant_id"] == "b")
+                  & (df["timestamp"] >= "2020-01-02 12:00") & (df["timestamp"] < "2020-01-04")]
+    assert list(result.columns) == ["participant_id", "timestamp", "steps"]
+    assert result["participant_id"].astype(str).unique().tolist() == ["b"]
+    assert result["timestamp"].tolist() == expected["timestamp"].tolist()
+    assert result["steps"].tolist() == expected["steps"].tolist()
+
+
+def test_get_dask_df_decodes_requested_compact_columns(minute_level):
+    df = make_processed_minute_level()
+    path, _ = minute_level(df=encode_compact_minute_level(df))
+    ddf = get_dask_df(path=path, columns=["timestamp", "missing_steps", "sleep_classic_1"])
+    # Decoding needs every compact column, but not participant_id
+    assert "participant_id" not in ddf.optimize().expr.columns
+    result = ddf.compute().sort_values("timestamp")
+    assert list(result.columns) == ["timestamp", "missing_steps", "sleep_classic_1"]
+    assert result["missing_steps"].tolist() == df["missing_steps"].tolist()
+    assert result["sleep_classic_1"].tolist() == df["sleep_classic_1"].tolist()
+
+
+@pytest.fixture
+def processed_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv("DEBUG_DATA", raising=False)
+    monkeypatch.setattr(utils, "PROCESSED_DATA_PATH", str(tmp_path))
+    return tmp_path
+
+
+def get_lab_results():
+    # Mixed answers in one column, like the survey tables
+    return pd.DataFrame({"participant_id": ["a", "b", "c"],
+                         "trigger_datetime": ["2020-01-01 10:00", "2020-01-02 11:30", None],
+                         "result": [1, 0, 1],
+                         "answer": ["yes", 3, None]})
+
+
+def set_mtime(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+
+def test_processed_table_is_loaded_from_typed_file(processed_dir):
+    df = get_lab_results()
+    write_processed_table(df, "lab_results")
+    assert resolve_processed_table_path("lab_results") == str(processed_dir / "lab_results.feather")
+    assert os.path.exists(processed_dir / "lab_results.csv")
+
+    loaded = load_processed_table("lab_results", use_cache=False)
+    assert pd.api.types.is_datetime64_any_dtype(loaded["trigger_datetime"])
+    assert loaded["trigger_datetime"].tolist()[:2] == [pd.Timestamp("2020-01-01 10:00"),
+                                                       pd.Timestamp("2020-01-02 11:30")]
+    assert pd.isna(loaded["trigger_datetime"][2])
+    assert loaded["result"].tolist() == [1, 0, 1]
+    assert loaded["answer"].tolist()[:2] == ["yes", "3"] and pd.isna(loaded["answer"][2])
+
+
+def test_newest_typed_table_wins(processed_dir):
+    df = get_lab_results()
+    write_processed_table(df.iloc[:1], "lab_results", fmt="feather", write_csv=False)
+    write_processed_table(df.iloc[:2], "lab_results", fmt="parquet", write_csv=False)
+    set_mtime(processed_dir / "lab_results.feather", 1_000_000)
+    set_mtime(processed_dir / "lab_results.parquet", 2_000_000)
+    assert resolve_processed_table_path("lab_results").endswith(".parquet")
+    assert len(load_processed_table("lab_results", use_cache=False)) == 2
+
+    set_mtime(processed_dir / "lab_results.feather", 3_000_000)
+    assert resolve_processed_table_path("lab_results").endswith(".feather")
+    assert len(load_processed_table("lab_results", use_cache=False)) == 1
+
+
+def test_processed_table_falls_back_to_csv(processed_dir):
+    get_lab_results().to_csv(processed_dir / "lab_results.csv", index=False)
+    assert resolve_processed_table_path("lab_results") == str(processed_dir / "lab_results.csv")
+    loaded = load_processed_table("lab_results", use_cache=False)
+    assert pd.api.types.is_datetime64_any_dtype(loaded["trigger_datetime"])
+    assert loaded["result"].tolist() == [1, 0, 1]
+
+    # An explicit path is used as is
+    write_processed_table(get_lab_results(), "lab_results", write_csv=False)
+    csv_path = str(processed_dir / "lab_results.csv")
+    assert resolve_processed_table_path("lab_results", path=csv_path) == csv_path
+
+
+def test_write_processed_table_unknown_format(processed_dir):
+    with pytest.raises(ValueError):
+        write_processed_table(get_lab_results(), "lab_results", fmt="orc")
@@ -0,0 +1,77 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.data.day_blocks import (BLOCKS_DIR, DayBlockWindowDataset, get_block_path,
+                                 get_window_starts, write_block_shard, write_day_blocks)
+from src.data.window_engine import MINS_IN_DAY
+
+
+def test_write_block_shard_int16(tmp_path, minute_level):
+    path, df = minute_level()
+    output_path = str(tmp_path / "blocks")
+    for column in ["heart_rate", "steps"]:
+        os.makedirs(os.path.join(output_path, BLOCKS_DIR, column))
+
+    index, dtypes = write_block_shard(0, ["a"], path, output_path, ["heart_rate", "steps"], {})
+    assert len(index) == 3
+    assert dtypes["steps"] == np.dtype(np.int16).str
+    steps = np.load(get_block_path(output_path, "steps", 0))
+    expected = df["steps"].to_numpy(dtype=np.int16, na_value=0)
+    np.testing.assert_array_equal(steps, expected.reshape(3, MINS_IN_DAY))
+
+
+def test_get_window_starts():
+    index = pd.DataFrame({"participant_id": ["a"] * 4 + ["b"] * 3,
+                          "date": pd.to_datetime(["2020-01-01", "2020-01-02", "2020-01-03", "2020-01-05",
+                                                  "2020-01-03", "2020-01-04", "2020-01-05"]),
+                          "shard": [0] * 4 + [1] * 3,
+                          "row": [0, 1, 2, 3, 0, 1, 2]})
+    starts = get_window_starts(index, 2)
+    assert list(zip(starts["participant_id"], starts["date"].dt.day)) == [("a", 1), ("a", 2), ("b", 3), ("b", 4)]
+    starts = get_window_starts(index, 3)
+    assert list(zip(starts["participant_id"], starts["date"].dt.day)) == [("a", 1), ("b", 3)]
+    assert get_window_starts(index.iloc[:2], 3).empty
+
+
+def test_day_block_window_dataset(tmp_path, minute_level):
+    # b has a gap on its second day, so only its first and third days are blocks
+    path, df = minute_level(participants=("a", "b"),
+                            gaps=[("b", "2020-01-02 10:00", "2020-01-02 10:05")])
+    output_path = str(tmp_path / "blocks")
+    write_day_blocks(path, output_path, no_scale=True, workers=1, participants_per_shard=1)
+
+    dataset = DayBlockWindowDataset(output_path, 2)
+    assert len(dataset) == 2
+    for i, start in enumerate(pd.to_datetime(["2020-01-01", "2020-01-02"])):
+        item = dataset[i]
+        assert item["participant_id"] == "a"
+        assert item["start"] == start and item["end"] == start + pd.Timedelta(days=2)
+        rows = df[(df["participant_id"] == "a") & (df["timestamp"] >= start)
+                  & (df["timestamp"] < item["end"])]
+        np.testing.assert_array_equal(item["steps"], rows["steps"].to_numpy(dtype=np.int16, na_value=0))
+        np.testing.assert_allclose(item["heart_rate"], rows["heart_rate"].values)
+
+    single_days = DayBlockWindowDataset(output_path, 1, participant_ids=["b"])
+    assert [item["start"].day for item in single_days] == [1, 3]
+
+
+def test_write_day_blocks_without_complete_days(tmp_path, minute_level):
+    path, _ = minute_level(gaps=[("a", "2020-01-01 10:00", "2020-01-03 10:00")])
+    output_path = str(tmp_path / "blocks")
+    write_day_blocks(path, output_path, no_scale=True, workers=1)
+    assert len(DayBlockWindowDataset(output_path, 1)) == 0
+
+
+def test_write_day_blocks_clears_earlier_shards(tmp_path, minute_level):
+    path, _ = minute_level(participants=("a", "b"))
+    output_path = str(tmp_path / "blocks")
+    write_day_blocks(path, output_path, no_scale=True, workers=1, participants_per_shard=1)
+    assert len(glob.glob(os.path.join(output_path, BLOCKS_DIR, "steps", "*.npy"))) == 2
+
+    write_day_blocks(path, output_path, no_scale=True, workers=1, participants_per_shard=1,
+                     users=["b"])
+    assert len(glob.glob(os.path.join(output_path, BLOCKS_DIR, "steps", "*.npy"))) == 1
+    assert set(DayBlockWindowDataset(output_path, 1).windows["participant_id"]) == {"a"}
@@ -0,0 +1,69 @@
+import glob
+import os
+
+import pandas as pd
+
+from src.data import incremental
+
+
+def test_incremental_matches_full_rebuild(tmp_path, raw_tables, make_dataset_cli, processed):
+    raw_tables(tmp_path / "raw", 3)
+    make_dataset_cli(str(tmp_path / "raw"), str(tmp_path / "incremental"), "--incremental")
+
+    # Only the new day (and the last old one, to fill up to it) is reprocessed
+    raw_tables(tmp_path / "raw", 4)
+    make_dataset_cli(str(tmp_path / "raw"), str(tmp_path / "incremental"),
+                     "--incremental", "--workers", "2")
+    make_dataset_cli(str(tmp_path / "raw"), str(tmp_path / "full"))
+
+    assert not os.path.exists(tmp_path / "full" / "_metadata")
+    pd.testing.assert_frame_equal(processed(tmp_path / "incremental"),
+                                  processed(tmp_path / "full"))
+
+
+def test_incremental_reads_only_changed_files(tmp_path, raw_tables, make_dataset_cli, processed, monkeypatch):
+    raw, out = tmp_path / "raw", str(tmp_path / "incremental")
+    raw_tables(raw, 3, daily=True)
+    make_dataset_cli(str(raw), out, "--incremental", daily=True)
+
+    read_files = []
+    read_file_keys = incremental.read_file_keys
+    def record_file_keys(path, files, date_col):
+        read_files.extend(os.path.basename(file) for file in files)
+        return read_file_keys(path, files, date_col)
+    monkeypatch.setattr(incremental, "read_file_keys", record_file_keys)
+
+    raw_tables(raw, 4, daily=True)
+    make_dataset_cli(str(raw), out, "--incremental", daily=True)
+    assert read_files == ["2020-01-04.parquet"] * 3
+    make_dataset_cli(str(raw), str(tmp_path / "full_4"), daily=True)
+    pd.testing.assert_frame_equal(processed(out), processed(tmp_path / "full_4"))
+
+    # Nothing changed, nothing is read or written
+    read_files.clear()
+    parts = sorted(glob.glob(os.path.join(out, "*", "*.parquet")))
+    make_dataset_cli(str(raw), out, "--incremental", daily=True)
+    assert read_files == []
+    assert sorted(glob.glob(os.path.join(out, "*", "*.parquet"))) == parts
+
+
+def test_incremental_removes_deleted_days(tmp_path, raw_tables, make_dataset_cli, processed):
+    raw, out = tmp_path / "raw", str(tmp_path / "incremental")
+    raw_tables(raw, 4, daily=True)
+    make_dataset_cli(str(raw), out, "--incremental", daily=True)
+
+    for name in ["sleep", "steps", "heart_rate"]:
+        os.remove(raw / name / "2020-01-04.parquet")
+    make_dataset_cli(str(raw), out, "--incremental", daily=True)
+    make_dataset_cli(str(raw), str(tmp_path / "full_3"), daily=True)
+    result = processed(out)
+    assert result["timestamp"].max() < pd.Timestamp("2020-01-04 23:00")
+    pd.testing.assert_frame_equal(result, processed(tmp_path / "full_3"))
+
+
+def test_full_rebuild_removes_old_parts(tmp_path, raw_tables, make_dataset_cli, processed):
+    raw_tables(tmp_path / "raw", 2)
+    make_dataset_cli(str(tmp_path / "raw"), str(tmp_path / "out"))
+    raw_tables(tmp_path / "raw", 2, participants=("a",))
+    make_dataset_cli(str(tmp_path / "raw"), str(tmp_path / "out"))
+    assert set(processed(tmp_path / "out")["participant_id"]) == {"a"}
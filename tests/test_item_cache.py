@@ -0,0 +1,78 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from src.data import item_cache
+from src.data.item_cache import ItemCache, get_item_cache
+
+
+def item(n_bytes=80):
+    return np.zeros(n_bytes // 8)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = ItemCache(max_bytes=240, policy="lru")
+    for key in "abc":
+        cache.put(key, item())
+    assert cache.get("a") is not None
+    cache.put("d", item())
+    assert "b" not in cache
+    assert all(key in cache for key in "acd")
+    assert cache.stats()["bytes"] == 240
+
+
+def test_clock_gives_hit_items_a_second_chance():
+    cache = ItemCache(max_bytes=240, policy="clock")
+    for key in "abc":
+        cache.put(key, item())
+    cache.get("a")
+    cache.put("d", item())
+    assert "b" not in cache and "a" in cache
+    # a went behind d with its reference bit cleared, so it goes after d
+    cache.put("e", item())
+    cache.put("f", item())
+    assert "c" not in cache and "d" not in cache and "a" in cache
+    cache.put("g", item())
+    assert "a" not in cache
+
+
+def test_counters():
+    cache = ItemCache(max_bytes=160)
+    assert cache.get("a") is None
+    cache.put("a", item())
+    cache.put("b", item())
+    cache.get("a")
+    cache.get("a")
+    cache.put("c", item())
+    # Too large to ever fit, so it isn't cached and evicts nothing
+    cache.put("huge", item(800))
+    assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 1, "entries": 2,
+                             "bytes": 160, "max_bytes": 160, "policy": "lru"}
+
+
+def test_cache_pickles_without_its_lock():
+    cache = ItemCache(max_bytes=160)
+    cache.put("a", item())
+    copy = pickle.loads(pickle.dumps(cache))
+    np.testing.assert_array_equal(copy.get("a"), item())
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        ItemCache(policy="fifo")
+
+
+def test_manager_caches_share_one_server():
+    try:
+        first = get_item_cache(max_bytes=160, manager=True)
+        second = get_item_cache(max_bytes=160, policy="clock", manager=True)
+        assert item_cache._MANAGER is not None
+        first.put("a", item())
+        # A pickled proxy, as DataLoader workers get it, sees the same cache
+        np.testing.assert_array_equal(pickle.loads(pickle.dumps(first)).get("a"), item())
+        assert first.stats()["hits"] == 1
+        assert len(second) == 0 and second.stats()["policy"] == "clock"
+    finally:
+        item_cache.shutdown_item_cache_manager()
+    assert item_cache._MANAGER is None
@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.data.make_audere_dataset import fill_missing_days, fill_missing_days_vectorized
+from src.data.utils import load_processed_table
+
+
+def test_fill_missing_days_vectorized(day_level):
+    df = day_level()
+    result = fill_missing_days_vectorized(df)
+    for participant_id, user_df in df.groupby("participant_id"):
+        expected = fill_missing_days(user_df.copy()).drop(columns=["participant_id"])
+        user_result = result[result["participant_id"] == participant_id].set_index("date")
+        np.testing.assert_array_equal(user_result.index.values, expected.index.values)
+        for column in expected.columns:
+            np.testing.assert_allclose(user_result[column].to_numpy(dtype=float),
+                                       expected[column].to_numpy(dtype=float), err_msg=column)
+
+
+def test_day_level_table_is_date_partitioned(day_level_table):
+    path, df = day_level_table()
+    assert len(os.listdir(path)) == df["date"].nunique() + 1
+    assert os.path.isdir(os.path.join(path, "date=2020-01-03"))
+
+    loaded = load_processed_table("fitbit_day_level_activity", path=path, use_cache=False)
+    assert pd.api.types.is_datetime64_any_dtype(loaded["date"])
+    key = ["participant_id", "date"]
+    pd.testing.assert_frame_equal(loaded.sort_values(key).reset_index(drop=True)[df.columns],
+                                  df.sort_values(key).reset_index(drop=True),
+                                  check_dtype=False)
+
+    filters = [("date", ">=", pd.Timestamp("2020-01-10")), ("date", "<", pd.Timestamp("2020-01-12"))]
+    loaded = load_processed_table("fitbit_day_level_activity", path=path, filters=filters,
+                                  use_cache=False)
+    assert set(loaded["date"].dt.day) == {10, 11}
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+from src.data.make_dataset import explode_str_column, explode_str_column_vectorized
+
+MINS_IN_DAY = 24*60
+
+
+def make_raw_table(n_participants=3, n_days=4, duplicate_days=(), seed=0):
+    """Raw day rows of minute strings, with `duplicate_days` repeated at the end"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n_participants):
+        for day in list(range(n_days)) + list(duplicate_days):
+            rows.append({"id_participant_external": f"participant_{i}",
+                         "dt": (pd.Timestamp("2020-01-01") + pd.Timedelta(days=day)).strftime("%Y-%m-%d"),
+                         "minute_level_str": " ".join(rng.integers(0, 250, MINS_IN_DAY).astype(str))})
+    df = pd.DataFrame(rows)
+    df["id_participant_external"] = df["id_participant_external"].astype("category")
+    return df.set_index("id_participant_external")
+
+
+def make_sleep_table(n_participants=3, n_nights=3, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n_participants):
+        for night in range(n_nights):
+            minutes = int(rng.integers(60, 600))
+            rows.append({"id_participant_external": f"participant_{i}",
+                         "main_start_time": pd.Timestamp("2020-01-01 22:00:20") + pd.Timedelta(days=night),
+                         "main_in_bed_minutes": minutes,
+                         "minute_level_str": " ".join(rng.integers(0, 4, minutes).astype(str))})
+    df = pd.DataFrame(rows)
+    df["id_participant_external"] = df["id_participant_external"].astype("category")
+    return df.set_index("id_participant_external")
+
+
+def assert_exploded_equal(expected, result, column):
+    np.testing.assert_array_equal(expected.index.values, result.index.values)
+    np.testing.assert_array_equal(expected[column].values.astype(np.int64),
+                                  result[column].values.astype(np.int64))
+
+
+def test_explode_str_column_vectorized():
+    raw = make_raw_table()
+    for user in raw.index.unique():
+        expected = explode_str_column(raw.loc[[user]].copy(), target_col="minute_level_str",
+                                      rename_target_column="steps")
+        result = explode_str_column_vectorized(raw.loc[[user]].copy(), target_col="minute_level_str",
+                                               rename_target_column="steps")
+        assert_exploded_equal(expected, result, "steps")
+
+
+def test_explode_str_column_vectorized_sleep():
+    raw = make_sleep_table()
+    kwargs = dict(target_col="minute_level_str", rename_target_column="sleep_classic",
+                  start_col="main_start_time", dur_col="main_in_bed_minutes")
+    for user in raw.index.unique():
+        expected = explode_str_column(raw.loc[[user]].copy(), **kwargs)
+        result = explode_str_column_vectorized(raw.loc[[user]].copy(), **kwargs)
+        assert_exploded_equal(expected, result, "sleep_classic")
+
+
+def test_explode_str_column_vectorized_duplicates():
+    # explode_str_column's unstable sort leaves which duplicate it keeps
+    # undefined, the vectorized version keeps the later row
+    raw = make_raw_table(n_participants=1, n_days=2, duplicate_days=[1])
+    result = explode_str_column_vectorized(raw.copy(), target_col="minute_level_str",
+                                           rename_target_column="steps")
+    assert len(result) == 2 * MINS_IN_DAY
+    expected = np.minimum(np.array(raw["minute_level_str"].iloc[-1].split(), dtype=np.int64), 200)
+    np.testing.assert_array_equal(result["steps"].values[MINS_IN_DAY:].astype(np.int64), expected)
+
+
+def test_explode_str_column_vectorized_whole_table():
+    raw = make_raw_table()
+    whole = explode_str_column_vectorized(raw.copy(), target_col="minute_level_str",
+                                          rename_target_column="steps", keep_participant=True)
+    for user in raw.index.unique():
+        expected = explode_str_column(raw.loc[[user]].copy(), target_col="minute_level_str",
+                                      rename_target_column="steps")
+        assert_exploded_equal(expected, whole[whole["participant_id"] == user], "steps")
+
+
+def test_sharded_matches_single_process(tmp_path, raw_tables, make_dataset_cli, processed):
+    raw_tables(tmp_path / "raw", 2, participants=("a", "b", "c"))
+    make_dataset_cli(str(tmp_path / "raw"), str(tmp_path / "single"))
+    sharded = str(tmp_path / "sharded")
+    make_dataset_cli(str(tmp_path / "raw"), sharded, "--workers", "2", "--participants_per_shard", "1")
+    pd.testing.assert_frame_equal(processed(sharded), processed(tmp_path / "single"))
+
+    # A rerun with fewer shards doesn't keep the shards of the first run
+    raw_tables(tmp_path / "raw", 2, participants=("a",))
+    make_dataset_cli(str(tmp_path / "raw"), sharded, "--workers", "2", "--participants_per_shard", "1")
+    assert set(processed(sharded)["participant_id"]) == {"a"}
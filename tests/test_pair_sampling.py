@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.data.pair_sampling import PairSamplingDataset
+
+
+def write_windows(path, n_participants=4, n_windows=6, window_length=8):
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(n_participants):
+        starts = pd.date_range("2020-01-01", periods=n_windows, freq="D")
+        for j, start in enumerate(starts):
+            rows.append({"participant_id": f"p{i}", "start": start,
+                         "end": start + pd.Timedelta(days=1),
+                         "id": i * n_windows + j,
+                         "heart_rate": rng.normal(size=window_length)})
+    pq.write_table(pa.Table.from_pandas(pd.DataFrame(rows), preserve_index=False), str(path))
+
+
+def same_participant(participant_id_l, start_l, end_l, participant_id_r, start_r, end_r):
+    return participant_id_l == participant_id_r
+
+
+def get_pairs(dataset):
+    return [(item["id_l"], item["id_r"]) for item in dataset]
+
+
+def test_epoch_is_set_from_outside(tmp_path):
+    write_windows(tmp_path / "windows.parquet")
+    dataset = PairSamplingDataset(str(tmp_path / "windows.parquet"), ["heart_rate"],
+                                  same_participant, n_pairs=16)
+    first = get_pairs(dataset)
+    # Iterating doesn't advance the epoch, since workers only iterate copies
+    assert dataset.epoch == 0
+    assert get_pairs(dataset) == first
+    dataset.set_epoch(1)
+    assert get_pairs(dataset) != first
+    dataset.set_epoch(0)
+    assert get_pairs(dataset) == first
+
+
+def test_no_resampling(tmp_path):
+    write_windows(tmp_path / "windows.parquet")
+    dataset = PairSamplingDataset(str(tmp_path / "windows.parquet"), ["heart_rate"],
+                                  same_participant, n_pairs=16, resample_each_epoch=False)
+    first = get_pairs(dataset)
+    dataset.set_epoch(3)
+    assert get_pairs(dataset) == first
+
+
+def write_partitioned_windows(path, n_participants=4, n_windows=6, window_length=8):
+    """Same windows as `write_windows`, partitioned by participant with
+    several row groups per file"""
+    write_windows(path / "flat.parquet", n_participants, n_windows, window_length)
+    windows = pd.read_parquet(path / "flat.parquet")
+    for participant_id, participant_windows in windows.groupby("participant_id"):
+        os.makedirs(path / "partitioned" / f"participant_id={participant_id}")
+        pq.write_table(pa.Table.from_pandas(participant_windows.drop(columns=["participant_id"]),
+                                            preserve_index=False),
+                       str(path / "partitioned" / f"participant_id={participant_id}" / "part-0.parquet"),
+                       row_group_size=4)
+    return windows.set_index("id")
+
+
+def sequential(participant_id_l, start_l, end_l, participant_id_r, start_r, end_r):
+    # Same as SequentialLabler
+    return (start_r - end_l).days == 0 and participant_id_l == participant_id_r
+
+
+def test_values_are_read_by_row_group(tmp_path):
+    windows = write_partitioned_windows(tmp_path)
+    dataset = PairSamplingDataset(str(tmp_path / "partitioned"), ["heart_rate"],
+                                  same_participant, n_pairs=32, normalize_numerical=False,
+                                  cache_size=2)
+    assert len(dataset.row_groups.row_groups) == 8
+    assert dataset.window_length == 8
+    # Only the row group needed for the window length has been read
+    assert len(dataset.row_groups.cache) == 1
+    for item in dataset:
+        for side in ["l", "r"]:
+            expected = windows.loc[item[f"id_{side}"]]
+            assert item[f"participant_id_{side}"] == expected["participant_id"]
+            np.testing.assert_allclose(item[f"inputs_embeds_{side}"][:, 0], expected["heart_rate"],
+                                       rtol=1e-6)
+    assert len(dataset.row_groups.cache) <= 2
+
+
+def test_same_participant_pairs(tmp_path):
+    write_windows(tmp_path / "windows.parquet")
+    dataset = PairSamplingDataset(str(tmp_path / "windows.parquet"), ["heart_rate"],
+                                  same_participant, positive_frac=0.25, n_pairs=2000)
+    items = list(dataset)
+    assert len(items) == 2000
+    assert all(item["id_l"] != item["id_r"] for item in items)
+    labels = np.array([item["label"] for item in items])
+    assert all(label == (item["participant_id_l"] == item["participant_id_r"])
+               for label, item in zip(labels, items))
+    assert abs(labels.mean() - 0.25) < 0.04
+
+
+def test_sequential_pairs(tmp_path):
+    write_windows(tmp_path / "windows.parquet")
+    dataset = PairSamplingDataset(str(tmp_path / "windows.parquet"), ["heart_rate"],
+                                  sequential, task="sequential", positive_frac=0.7, n_pairs=2000)
+    # Windows are one day long, so each is followed by the one ending a day later
+    assert dataset.next_row.tolist() == [i + 1 if (i + 1) % 6 else -1 for i in range(24)]
+    assert dataset.end_index[(0, pd.Timestamp("2020-01-03"))] == 1
+
+    items = list(dataset)
+    assert len(items) == 2000
+    for item in items:
+        assert item["participant_id_l"] == item["participant_id_r"]
+        assert item["id_l"] != item["id_r"]
+        assert item["label"] == (item["id_r"] == item["id_l"] + 1)
+    labels = np.array([item["label"] for item in items])
+    assert abs(labels.mean() - 0.7) < 0.04
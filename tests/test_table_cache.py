@@ -0,0 +1,117 @@
+import os
+
+import pandas as pd
+import pytest
+
+from src.data import table_cache, utils
+from src.data.table_cache import TableCache, get_frame_bytes
+from src.data.utils import load_processed_table, write_processed_table
+
+
+def write_table(path, n_rows=10, value=0):
+    df = pd.DataFrame({"x": [value] * n_rows})
+    df.to_csv(path, index=False)
+    return df
+
+
+class CountingLoader(object):
+    def __init__(self, path):
+        self.path = path
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return pd.read_csv(self.path)
+
+
+def test_hits_and_misses(tmp_path):
+    write_table(tmp_path / "a.csv")
+    cache, loader = TableCache(), CountingLoader(tmp_path / "a.csv")
+    first = cache.get("a", tmp_path / "a.csv", loader)
+    second = cache.get("a", tmp_path / "a.csv", loader)
+    assert loader.calls == 1
+    pd.testing.assert_frame_equal(first, second)
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    # The same file under another name (e.g. with filters) is its own entry
+    cache.get("a:filtered", tmp_path / "a.csv", loader)
+    assert loader.calls == 2 and cache.stats()["entries"] == 2
+
+
+def test_rewritten_file_is_reloaded(tmp_path):
+    path = tmp_path / "a.csv"
+    write_table(path, value=1)
+    cache, loader = TableCache(), CountingLoader(path)
+    cache.get("a", path, loader)
+
+    write_table(path, value=2)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.get("a", path, loader)["x"].tolist() == [2] * 10
+    assert loader.calls == 2
+    # The stale version is dropped rather than waiting to be evicted
+    assert cache.stats()["entries"] == 1
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    loaders = {}
+    for name in "abc":
+        write_table(tmp_path / f"{name}.csv")
+        loaders[name] = CountingLoader(tmp_path / f"{name}.csv")
+    size = get_frame_bytes(pd.read_csv(tmp_path / "a.csv"))
+    cache = TableCache(max_bytes=2 * size)
+
+    cache.get("a", tmp_path / "a.csv", loaders["a"])
+    cache.get("b", tmp_path / "b.csv", loaders["b"])
+    cache.get("a", tmp_path / "a.csv", loaders["a"])
+    cache.get("c", tmp_path / "c.csv", loaders["c"])
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 2 * size
+
+    cache.get("a", tmp_path / "a.csv", loaders["a"])
+    cache.get("b", tmp_path / "b.csv", loaders["b"])
+    assert loaders["a"].calls == 1 and loaders["b"].calls == 2
+
+
+def test_tables_larger_than_the_cache_are_not_cached(tmp_path):
+    write_table(tmp_path / "a.csv", n_rows=1000)
+    cache, loader = TableCache(max_bytes=100), CountingLoader(tmp_path / "a.csv")
+    assert len(cache.get("a", tmp_path / "a.csv", loader)) == 1000
+    cache.get("a", tmp_path / "a.csv", loader)
+    assert loader.calls == 2
+    assert cache.stats()["entries"] == 0 and cache.stats()["evictions"] == 0
+
+
+def test_callers_get_their_own_copy(tmp_path):
+    write_table(tmp_path / "a.csv")
+    cache, loader = TableCache(), CountingLoader(tmp_path / "a.csv")
+    df = cache.get("a", tmp_path / "a.csv", loader)
+    df["x"] = df["x"] + 1
+    df["y"] = 0
+    again = cache.get("a", tmp_path / "a.csv", loader)
+    assert again["x"].tolist() == [0] * 10 and "y" not in again.columns
+
+
+@pytest.fixture
+def fresh_table_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv("DEBUG_DATA", raising=False)
+    monkeypatch.setattr(utils, "PROCESSED_DATA_PATH", str(tmp_path))
+    cache = TableCache()
+    monkeypatch.setattr(table_cache, "_TABLE_CACHE", cache)
+    return cache
+
+
+def test_load_processed_table_uses_the_cache(fresh_table_cache):
+    df = pd.DataFrame({"participant_id": ["a", "b"], "date": ["2020-01-01", "2020-01-02"]})
+    write_processed_table(df, "lab_results", write_csv=False)
+    load_processed_table("lab_results")
+    load_processed_table("lab_results")
+    load_processed_table("lab_results", use_cache=False)
+    assert fresh_table_cache.stats()["hits"] == 1
+    assert fresh_table_cache.stats()["misses"] == 1
+
+    write_processed_table(df.iloc[:1], "lab_results", write_csv=False)
+    path = utils.resolve_processed_table_path("lab_results")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert len(load_processed_table("lab_results")) == 1
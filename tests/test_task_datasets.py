@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.task_datasets import (ActivityArrayStore, ActivtyDataset, DayLevelActivityReader,
+                                    get_valid_window_ends)
+
+
+def original_day_level_valid_dates(dates_with_data, day_window_size, max_missing_days_in_window):
+    """The per-participant loop `DayLevelActivityReader.get_valid_dates` used to run"""
+    min_days_with_data = day_window_size - max_missing_days_in_window
+    if len(dates_with_data) < min_days_with_data:
+        return pd.DatetimeIndex([])
+    starts = pd.date_range(dates_with_data.min(), dates_with_data.max() - pd.Timedelta(days=day_window_size))
+    ends = starts + pd.Timedelta(days=day_window_size)
+    mask = [len(dates_with_data[(dates_with_data >= a) & (dates_with_data < b)]) >= min_days_with_data
+            for a, b in zip(starts, ends)]
+    return ends[mask]
+
+
+def original_minute_level_valid_dates(dates_with_data, day_window_size, max_missing_days_in_window):
+    """The per-participant loop `MinuteLevelActivityReader.get_valid_dates` used to run"""
+    min_days_with_data = day_window_size - max_missing_days_in_window
+    if len(dates_with_data) < min_days_with_data:
+        return pd.DatetimeIndex([])
+    starts = pd.date_range(dates_with_data.min(), dates_with_data.max() - pd.Timedelta(days=day_window_size - 1))
+    ends = starts + pd.Timedelta(days=day_window_size - 1)
+    mask = [len(dates_with_data[(dates_with_data >= a) & (dates_with_data <= b)]) >= min_days_with_data
+            for a, b in zip(starts, ends)]
+    return ends[mask]
+
+
+def make_days_with_data(n_participants=5, n_days=40, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(n_participants):
+        dates = pd.date_range("2020-01-01", periods=n_days) + pd.Timedelta(days=int(rng.integers(0, 10)))
+        keep = rng.random(n_days) < (0.3 + 0.15 * i)
+        frames.append(pd.DataFrame({"participant_id": f"participant_{i}", "date": dates[keep]}))
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.mark.parametrize("day_window_size,max_missing_days_in_window", [(1, 0), (3, 1), (7, 2), (7, 7), (28, 5)])
+@pytest.mark.parametrize("inclusive_end", [False, True])
+def test_get_valid_window_ends(day_window_size, max_missing_days_in_window, inclusive_end):
+    days_with_data = make_days_with_data()
+    original = original_minute_level_valid_dates if inclusive_end else original_day_level_valid_dates
+    expected = []
+    for participant_id, group in days_with_data.groupby("participant_id"):
+        ends = original(pd.DatetimeIndex(group["date"]), day_window_size, max_missing_days_in_window)
+        expected.append(pd.DataFrame({"participant_id": participant_id, "end_date": ends}))
+    expected = pd.concat(expected, ignore_index=True)
+
+    result = get_valid_window_ends(days_with_data, day_window_size, max_missing_days_in_window,
+                                   inclusive_end=inclusive_end)
+    assert result["participant_id"].tolist() == expected["participant_id"].tolist()
+    np.testing.assert_array_equal(result["end_date"].values.astype("datetime64[ns]"),
+                                  expected["end_date"].values.astype("datetime64[ns]"))
+
+
+def make_activity_frame():
+    """Minute-level rows of an evenly spaced participant and of one with a gap"""
+    frames = []
+    for participant_id, drop in [("even", []), ("gappy", [100, 101, 102])]:
+        timestamps = pd.date_range("2020-01-01", periods=3 * 24 * 60, freq="min").delete(drop)
+        frames.append(pd.DataFrame({"participant_id": participant_id, "timestamp": timestamps,
+                                    "steps": np.arange(len(timestamps), dtype=np.float32),
+                                    "heart_rate": np.linspace(60, 90, len(timestamps), dtype=np.float32)}))
+    return pd.concat(frames).set_index(["participant_id", "timestamp"])
+
+
+def test_array_store_matches_frame():
+    frame = make_activity_frame()
+    store = ActivityArrayStore(frame, step="1min")
+    assert store.evenly_spaced.tolist() == [True, False]
+    for participant_id in ["even", "gappy"]:
+        for start, end in [("2020-01-01 00:00", "2020-01-01 23:59"),
+                           ("2020-01-01 01:00", "2020-01-02 12:00"),
+                           ("2020-01-02 00:00", "2020-01-05 00:00")]:
+            values, times = store.get_window(participant_id, pd.Timestamp(start), pd.Timestamp(end))
+            expected = frame.loc[(participant_id, start):(participant_id, end)]
+            np.testing.assert_array_equal(values, expected.values)
+            np.testing.assert_array_equal(times.astype("datetime64[ns]"),
+                                          expected.index.get_level_values(1).values)
+    pd.testing.assert_frame_equal(store.to_frame(), frame, check_freq=False, check_index_type=False)
+
+    # Exact lookups need both ends, like Index.get_loc
+    with pytest.raises(KeyError):
+        store.get_window("gappy", pd.Timestamp("2020-01-01 01:40"), pd.Timestamp("2020-01-01 02:00"),
+                         exact=True)
+
+
+class UnlabeledDataset(ActivtyDataset):
+    def get_label(self, participant_id, start_date, end_date):
+        return 0
+
+
+def test_array_storage_items(day_level_table):
+    path, _ = day_level_table()
+    reader = DayLevelActivityReader(day_window_size=3, max_missing_days_in_window=1, scaler=None,
+                                    data_location=path)
+    dataset = UnlabeledDataset(reader, None, reader.participant_dates, storage="array", cache=False)
+    assert dataset.array_store is reader.to_array_store()
+    for index in range(len(dataset)):
+        item = dataset[index]
+        end = item["end_date"]
+        expected = reader.activity_data.loc[(item["participant_id"], end - pd.Timedelta(days=2)):
+                                            (item["participant_id"], end)]
+        np.testing.assert_array_equal(item["inputs_embeds"], expected.values.astype(np.float32))
+
+    # Items are copies, so changing one leaves the store alone
+    before = dataset.array_store.values.copy()
+    dataset[0]["inputs_embeds"][:] = -1
+    np.testing.assert_array_equal(dataset.array_store.values, before)
+
+    with pytest.raises(ValueError):
+        UnlabeledDataset(reader, None, reader.participant_dates, storage="sparse")
@@ -0,0 +1,81 @@
+import os
+
+import pandas as pd
+
+from src.data.train_test_split_streaming import (SPLITS, get_participant_fraction,
+                                                 split_dataset)
+
+PARTICIPANTS = tuple(f"participant_{i}" for i in range(8))
+
+
+def load_split(out_path, split):
+    path = os.path.join(out_path, split)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=["participant_id", "timestamp"])
+    df = pd.read_parquet(path).drop(columns=["date"])
+    df["participant_id"] = df["participant_id"].astype(str)
+    return df.sort_values(["participant_id", "timestamp"]).reset_index(drop=True)
+
+
+def reference_spark_split(df, split_date, test_frac, seed=0, end_date=None):
+    """`train_test_split_spark` in pandas, with the participant's stable
+    fraction standing in for `rand()`"""
+    if end_date:
+        df = df[df["timestamp"] < pd.to_datetime(end_date)]
+    train = df[df["timestamp"] < pd.to_datetime(split_date)]
+    test_eval = df[df["timestamp"] >= pd.to_datetime(split_date)]
+    rand_val = test_eval["participant_id"].map(lambda p: get_participant_fraction(p, seed))
+    splits = {"train": train,
+              "eval": test_eval[rand_val >= test_frac],
+              "test": test_eval[rand_val < test_frac]}
+    return {split: rows.sort_values(["participant_id", "timestamp"]).reset_index(drop=True)
+            for split, rows in splits.items()}
+
+
+def assert_same_rows(result, expected):
+    assert len(result) == len(expected)
+    if len(expected):
+        pd.testing.assert_frame_equal(result, expected[result.columns], check_dtype=False)
+
+
+def test_split_date_matches_spark_split(tmp_path, minute_level):
+    in_path, df = minute_level(participants=PARTICIPANTS, n_days=4)
+    out_path = str(tmp_path / "split")
+    counts = split_dataset(in_path, out_path, split_date="2020-01-03", end_date="2020-01-04",
+                           test_frac=0.5, seed=1, workers=2)
+
+    expected = reference_spark_split(df, "2020-01-03", 0.5, seed=1, end_date="2020-01-04")
+    assert all(len(expected[split]) for split in SPLITS)
+    for split in SPLITS:
+        assert counts[split] == len(expected[split])
+        assert_same_rows(load_split(out_path, split), expected[split])
+
+
+def test_eval_frac_assigns_whole_participants(tmp_path, minute_level):
+    in_path, df = minute_level(participants=PARTICIPANTS, n_days=2)
+    out_path = str(tmp_path / "split")
+    split_dataset(in_path, out_path, eval_frac=0.5, test_frac=0.5, workers=1)
+
+    fractions = {p: get_participant_fraction(p) for p in PARTICIPANTS}
+    expected = {"test": {p for p, x in fractions.items() if x < 0.25},
+                "eval": {p for p, x in fractions.items() if 0.25 <= x < 0.5},
+                "train": {p for p, x in fractions.items() if x >= 0.5}}
+    for split in SPLITS:
+        rows = load_split(out_path, split)
+        assert set(rows["participant_id"]) == expected[split]
+        # Every row of a participant lands in its split
+        assert_same_rows(rows, df[df["participant_id"].isin(expected[split])]
+                                 .sort_values(["participant_id", "timestamp"])
+                                 .reset_index(drop=True))
+
+
+def test_rerun_replaces_earlier_splits(tmp_path, minute_level):
+    out_path = str(tmp_path / "split")
+    in_path, _ = minute_level(name="first", participants=PARTICIPANTS, n_days=2)
+    split_dataset(in_path, out_path, split_date="2020-01-02", workers=1)
+
+    in_path, df = minute_level(name="second", participants=PARTICIPANTS[:2], n_days=1)
+    split_dataset(in_path, out_path, split_date="2020-01-02", workers=1)
+    result = pd.concat([load_split(out_path, split) for split in SPLITS])
+    assert set(result["participant_id"]) == set(PARTICIPANTS[:2])
+    assert len(result) == len(df)
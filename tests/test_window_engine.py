@@ -0,0 +1,231 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data import window_engine
+from src.data.utils import load_normalization_stats, write_normalization_stats
+from src.data.window_engine import (MINS_IN_DAY, aggregate_windows, get_column_values,
+                                    read_shard, window_participant)
+
+
+def test_get_column_values_nullable():
+    df = pd.DataFrame({"steps": pd.array([1, None, 3], dtype="Int16"),
+                       "rate": pd.array([1.5, None, 2.0], dtype="Float64"),
+                       "plain": np.array([1, 2, 3], dtype=np.int8)})
+    steps = get_column_values(df, "steps")
+    assert steps.dtype == np.int16
+    assert steps.tolist() == [1, 0, 3]
+    rate = get_column_values(df, "rate")
+    assert rate.dtype == np.float64 and np.isnan(rate[1])
+    assert get_column_values(df, "plain").dtype == np.int8
+
+
+def test_window_participant_int16(minute_level):
+    path, df = minute_level()
+    shard = read_shard(path, ["a"], ["heart_rate", "steps"], {})
+    assert isinstance(shard["steps"].dtype, pd.Int16Dtype)
+
+    windows, n_complete = window_participant(shard, ["heart_rate", "steps"], 2)
+    assert n_complete == 2
+    assert windows["steps"].dtype == np.int16
+    assert windows["steps"].shape == (2, 2 * MINS_IN_DAY)
+    expected = df["steps"].to_numpy(dtype=np.int16, na_value=0)
+    np.testing.assert_array_equal(windows["steps"][0], expected[:2 * MINS_IN_DAY])
+    np.testing.assert_array_equal(windows["steps"][1], expected[MINS_IN_DAY:])
+    np.testing.assert_allclose(windows["heart_rate"][1], df["heart_rate"].values[MINS_IN_DAY:])
+
+
+def test_write_windowed_dataset_without_scale_columns(tmp_path, minute_level, no_petastorm_metadata):
+    path, _ = minute_level()
+    output_path = str(tmp_path / "windows")
+    stats = window_engine.write_windowed_dataset(path, output_path, None, ["steps"], [],
+                                                 day_window_size=2, workers=1)
+    assert stats == ({}, {})
+    write_normalization_stats(output_path, *stats)
+    assert load_normalization_stats(output_path) == ({}, {})
+    assert len(pd.read_parquet(output_path)) == 2
+
+
+def test_append_counts_existing_windows_toward_min_windows(tmp_path, minute_level, no_petastorm_metadata):
+    output_path = str(tmp_path / "windows")
+    three_days, _ = minute_level("three_days", n_days=3)
+    window_engine.write_windowed_dataset(three_days, output_path, None, ["steps"], [],
+                                         day_window_size=1, min_windows=3, workers=1)
+    assert window_engine.get_existing_windows(output_path)[1] == {"a": 3}
+
+    # Appending only reads the last existing day and the new one, which on
+    # their own are fewer than min_windows windows
+    four_days, _ = minute_level("four_days", n_days=4)
+    window_engine.write_windowed_dataset(four_days, output_path, None, ["steps"], [],
+                                         day_window_size=1, min_windows=3, workers=1, append=True)
+    ends, counts = window_engine.get_existing_windows(output_path)
+    assert counts == {"a": 4}
+    assert ends["a"] == np.datetime64("2020-01-05")
+
+
+def make_gappy_minute_level(seed=0):
+    """Three participants: a complete one, one with a gap and days without
+    heart rate, and one with too few days for min_windows"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for participant_id, n_days in [("complete", 8), ("gappy", 10), ("short", 3)]:
+        timestamps = pd.date_range("2020-01-01", periods=n_days * MINS_IN_DAY, freq="min")
+        df = pd.DataFrame({"participant_id": participant_id,
+                           "timestamp": timestamps,
+                           "heart_rate": rng.normal(70, 10, len(timestamps)),
+                           "steps": rng.integers(0, 100, len(timestamps)).astype(np.int16),
+                           "missing_heart_rate": rng.random(len(timestamps)) < 0.1})
+        if participant_id == "gappy":
+            day = df["timestamp"].dt.floor("D")
+            df.loc[day.isin(pd.to_datetime(["2020-01-03", "2020-01-04"])), "missing_heart_rate"] = True
+            df = df[~df["timestamp"].between("2020-01-08 10:00", "2020-01-08 10:30")]
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def reference_window_id(participant_id, start):
+    """Spark's shiftLeft(crc32(p), 15) | shiftRight(crc32(reverse(p)), 17),
+    shifted left by 16 bits and or'ed with the start's day since epoch"""
+    participant_hash = (zlib.crc32(participant_id.encode()) << 15) | (zlib.crc32(participant_id[::-1].encode()) >> 17)
+    return (participant_hash << 16) | (start - pd.Timestamp("1970-01-01")).days
+
+
+def reference_spark_windows(df, feature_columns, day_window_size, max_missing_days_in_window,
+                            min_windows, missing_column):
+    """Windows the way the Spark path builds them, one window at a time:
+    sliding day_window_size-day windows starting at every UTC midnight, kept
+    if every minute is present, enough days have data and the participant
+    has at least min_windows of them"""
+    window_length = day_window_size * MINS_IN_DAY
+    rows = []
+    for participant_id, group in df.groupby("participant_id"):
+        days = group["timestamp"].dt.floor("D")
+        windows = []
+        for start in pd.date_range(days.min() - pd.Timedelta(days=day_window_size - 1), days.max()):
+            end = start + pd.Timedelta(days=day_window_size)
+            window = group[(group["timestamp"] >= start) & (group["timestamp"] < end)]
+            if len(window) != window_length:
+                continue
+            has_data = (~window[missing_column]).groupby(window["timestamp"].dt.floor("D")).any()
+            if has_data.sum() < day_window_size - max_missing_days_in_window:
+                continue
+            windows.append({"participant_id": participant_id, "start": start, "end": end,
+                            "id": reference_window_id(participant_id, start),
+                            **{c: window[c].values for c in feature_columns}})
+        if len(windows) >= min_windows:
+            rows.extend(windows)
+    return pd.DataFrame(rows)
+
+
+def load_windows(path):
+    df = pd.read_parquet(path)
+    df["start"] = pd.to_datetime(df["start"]).dt.tz_localize(None)
+    return df.sort_values(["participant_id", "start"]).reset_index(drop=True)
+
+
+def test_window_engine_matches_spark_semantics(tmp_path, minute_level, no_petastorm_metadata):
+    path, df = minute_level(df=make_gappy_minute_level())
+    df = df.copy()
+    feature_columns = ["heart_rate", "steps", "missing_heart_rate"]
+    window_engine.write_windowed_dataset(path, str(tmp_path / "windows"), None,
+                                         feature_columns, ["heart_rate"], day_window_size=3,
+                                         max_missing_days_in_window=1, min_windows=2,
+                                         missing_column="missing_heart_rate", workers=2,
+                                         participants_per_shard=1)
+    result = load_windows(tmp_path / "windows")
+
+    # StandardScaler divides by the sample standard deviation
+    df["heart_rate"] = df["heart_rate"] / df["heart_rate"].std()
+    expected = reference_spark_windows(df, feature_columns, 3, 1, 2, "missing_heart_rate")
+    assert set(expected["participant_id"]) == {"complete", "gappy"}
+
+    assert result["participant_id"].tolist() == expected["participant_id"].tolist()
+    assert result["start"].tolist() == expected["start"].tolist()
+    assert result["id"].tolist() == expected["id"].tolist()
+    for column in feature_columns:
+        for values, expected_values in zip(result[column], expected[column]):
+            np.testing.assert_allclose(np.asarray(values, dtype=np.float64),
+                                       expected_values.astype(np.float64), rtol=1e-6, err_msg=column)
+
+
+def test_window_ids_are_stable(tmp_path, minute_level, no_petastorm_metadata):
+    three_days, _ = minute_level("three_days", n_days=3)
+    four_days, _ = minute_level("four_days", n_days=4)
+
+    appended = str(tmp_path / "appended")
+    window_engine.write_windowed_dataset(three_days, appended, None, ["steps"], [],
+                                         day_window_size=2, workers=1)
+    window_engine.write_windowed_dataset(four_days, appended, None, ["steps"], [],
+                                         day_window_size=2, workers=1, append=True)
+    rebuilt = str(tmp_path / "rebuilt")
+    window_engine.write_windowed_dataset(four_days, rebuilt, None, ["steps"], [],
+                                         day_window_size=2, workers=1)
+
+    appended, rebuilt = load_windows(appended), load_windows(rebuilt)
+    assert appended["id"].tolist() == rebuilt["id"].tolist()
+    assert appended["id"].is_unique
+    assert appended["id"].tolist() == [reference_window_id("a", start) for start in appended["start"]]
+
+
+def test_aggregate_windows_values():
+    start = np.array(["2020-01-01"], dtype="datetime64[ns]")
+    sleep_stage = [0, 1, 1, 2,   2, 2, 3, 3,   0, 0, 3, 3]
+    windows = {"start": start,
+               "heart_rate": np.array([[60, 70, 80, 90, 50, 50, 50, 50, 64, 66, 0, 0]], dtype=np.float64),
+               "missing_heart_rate": np.array([[0, 1, 0, 0, 1, 1, 1, 1, 0, 0, 1, 1]], dtype=bool),
+               "steps": np.array([[1, 2, 3, 4, 5, 5, 5, 5, 0, 0, 0, 1]], dtype=np.int16)}
+    for i in range(3):
+        windows[f"sleep_classic_{i}"] = np.array([[stage == i + 1 for stage in sleep_stage]])
+    feature_columns = [c for c in windows if c != "start"]
+
+    result = aggregate_windows(windows, feature_columns, 4)
+    assert result["start"] is start
+    # Heart rate is averaged over present minutes only, and 0 with none
+    np.testing.assert_allclose(result["heart_rate"], [[230 / 3, 0, 65]], rtol=1e-6)
+    np.testing.assert_allclose(result["missing_heart_rate"], [[0.25, 1, 0.5]])
+    assert result["steps"].dtype == np.int32
+    assert result["steps"].tolist() == [[10, 20, 1]]
+    # Ties go to the earlier stage, and to not being asleep
+    assert result["sleep_classic_0"].tolist() == [[True, False, False]]
+    assert result["sleep_classic_1"].tolist() == [[False, True, False]]
+    assert result["sleep_classic_2"].tolist() == [[False, False, False]]
+    for column in feature_columns:
+        assert result[column].shape == (1, 3), column
+    assert aggregate_windows(windows, feature_columns, 1) is windows
+
+
+def test_aggregated_windows_keep_minute_level_validity(tmp_path, minute_level, no_petastorm_metadata):
+    path, _ = minute_level(df=make_gappy_minute_level())
+    feature_columns = ["heart_rate", "steps", "missing_heart_rate"]
+    for resolution in [1, 60]:
+        window_engine.write_windowed_dataset(path, str(tmp_path / f"windows_{resolution}"), None,
+                                             feature_columns, [], day_window_size=3,
+                                             max_missing_days_in_window=1, min_windows=2,
+                                             missing_column="missing_heart_rate", workers=1,
+                                             resolution=resolution)
+    minutes, hours = load_windows(tmp_path / "windows_1"), load_windows(tmp_path / "windows_60")
+
+    # Windows are picked at minute level, so the same ones are kept
+    assert len(hours) > 0
+    assert hours["id"].tolist() == minutes["id"].tolist()
+    for (_, minute_row), (_, hour_row) in zip(minutes.iterrows(), hours.iterrows()):
+        heart_rate = np.asarray(minute_row["heart_rate"]).reshape(-1, 60)
+        missing = np.asarray(minute_row["missing_heart_rate"]).reshape(-1, 60)
+        steps = np.asarray(minute_row["steps"]).reshape(-1, 60)
+        assert len(hour_row["steps"]) == 3 * 24
+        np.testing.assert_array_equal(hour_row["steps"], steps.sum(axis=-1))
+        np.testing.assert_allclose(hour_row["missing_heart_rate"], missing.mean(axis=-1), rtol=1e-6)
+        present = (~missing).sum(axis=-1)
+        totals = np.where(missing, 0, heart_rate).sum(axis=-1)
+        expected = np.where(present > 0, totals / np.maximum(present, 1), 0)
+        np.testing.assert_allclose(hour_row["heart_rate"], expected, rtol=1e-5)
+
+
+def test_resolution_must_divide_a_day():
+    with pytest.raises(ValueError):
+        window_engine.check_resolution(7)
+    with pytest.raises(ValueError):
+        window_engine.check_resolution(0)
+    window_engine.check_resolution(30)